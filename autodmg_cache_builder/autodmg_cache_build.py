@@ -8,12 +8,20 @@ incorporate them into the image.
 import argparse
 import json
 import os
+import socket
 import sys
+import tempfile
 import urllib2
 import time
+from multiprocessing.pool import ThreadPool
 
 from autodmg_utility import run, build_pkg, populate_ds_repo, move_file
+import autodmg_utility
+import autodmg_cache_policy
+import autodmg_index
 import autodmg_org
+import autodmg_pipeline
+import autodmg_store
 
 # Append munkilib to the Python path
 with open('/private/etc/paths.d/munki', 'rb') as f:
@@ -39,6 +47,36 @@ PKGS_URL = MUNKI_URL + '/pkgs'
 ICONS_URL = MUNKI_URL + '/icons'
 BASIC_AUTH = pref('AdditionalHttpHeaders')
 CACHE = '/tmp'
+# Content-addressed store that cached files are linked from, None for none
+STORE = None
+# Icons fetched at once. Icons are small, so this is mostly waiting on the
+# server.
+ICON_JOBS = 8
+# Attempts per download, and the delay before the first retry, doubled after
+# each failed attempt. Partial downloads are resumed, not restarted.
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 10
+# Written to the logs directory when managed installs fail to download
+FAILURE_REPORT = 'download_failures.json'
+# Build stages run at once
+STAGE_JOBS = autodmg_pipeline.JOBS
+# Where the outputs of finished stages are kept for --resume
+PIPELINE_STATE = 'pipeline.json'
+# Written to the log path after every build
+REPORT_NAME = 'build_report.json'
+# What --plan estimates with when there's no earlier build report: MB/s
+# per download, seconds per package build, and seconds for AutoDMG
+PLAN_DOWNLOAD_RATE = 10
+PLAN_PKG_SECONDS = 60
+PLAN_AUTODMG_SECONDS = 45 * 60
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class BuildError(Error):
+  """Image build exceptions."""
 
 
 # download functions
@@ -55,26 +93,215 @@ def download_url_to_cache(url, cache, force=False):
       custom_headers=custom_headers,
       resume=True,
       expected_hash='no')
+  # Resume from the partial download of an earlier attempt, if there is one
   return getResourceIfChangedAtomically(
-    url, cache_path, custom_headers=custom_headers)
+    url, cache_path, custom_headers=custom_headers, resume=True)
+
+
+def verify_item(cache_path, item_name, changed, expected_hash):
+  """Add a downloaded item to the store, checking it matches expected_hash.
+
+  Raises StoreError if it doesn't.
+  """
+  if STORE:
+    if changed or os.stat(cache_path).st_nlink == 1:
+      # Files already linked to the store don't need hashing again
+      try:
+        autodmg_store.add(STORE, cache_path, expected_hash)
+      except (IOError, OSError) as err:
+        # The file itself is fine, it just isn't shared
+        print >> sys.stderr, "Could not add %s to store: %s" % (
+          item_name, err)
+  elif expected_hash and changed:
+    digest = getsha256hash(cache_path)
+    if digest != expected_hash.lower():
+      raise autodmg_store.StoreError(
+        "%s has hash %s, expected %s" % (item_name, digest, expected_hash))
+
+
+def download_item(item_name, item_url, download_dir, force_download,
+                  expected_hash=None, retries=DOWNLOAD_RETRIES):
+  """Download an item into the cache, returns a dict of the result.
+
+  If the content store already has expected_hash, the stored copy is linked
+  into download_dir without going to the network. Downloads are added to the
+  store, and must match expected_hash if it is given. Failed downloads are
+  tried up to retries times, waiting longer each time, and resume from
+  where the last attempt stopped.
+  """
+  result = {
+    'name': item_name,
+    'url': item_url,
+    'dir': download_dir,
+    'success': False,
+    'changed': False,
+    'stored': False,
+    'error': None,
+    'attempts': 0,
+    # Where the item came from: 'store', 'cache' or 'network'
+    'source': None,
+    'bytes': 0,
+  }
+  start = time.time()
+  cache_path = os.path.join(download_dir, urllib2.unquote(item_name))
+  if STORE and expected_hash and not force_download:
+    try:
+      if autodmg_store.link_from_store(STORE, expected_hash, cache_path):
+        print "Found in store: %s" % item_name
+        result['success'] = True
+        result['stored'] = True
+        result['source'] = 'store'
+        result['bytes'] = os.path.getsize(cache_path)
+        result['duration'] = time.time() - start
+        return result
+    except OSError as err:
+      print >> sys.stderr, "Could not link %s from store: %s" % (
+        item_name, err)
+  delay = DOWNLOAD_BACKOFF
+  for attempt in range(1, retries + 1):
+    result['attempts'] = attempt
+    try:
+      print "Downloading into %s: %s" % (download_dir, item_name)
+      changed = bool(download_url_to_cache(
+        item_url,
+        download_dir,
+        force_download
+      ))
+      result['changed'] = result['changed'] or changed
+      if not changed:
+        print "Found in cache: %s" % item_name
+      verify_item(cache_path, item_name, changed, expected_hash)
+      result['success'] = True
+      result['error'] = None
+      break
+    except MunkiDownloadError as err:
+      print >> sys.stderr, "Download error for %s (attempt %d): %s" % (
+        item_name, attempt, err)
+      result['error'] = str(err)
+    except autodmg_store.StoreError as err:
+      # Never image a file that doesn't match its pkginfo; download it
+      # again from scratch
+      print >> sys.stderr, "Hash mismatch for %s (attempt %d): %s" % (
+        item_name, attempt, err)
+      result['error'] = str(err)
+      if os.path.isfile(cache_path):
+        os.remove(cache_path)
+    except (IOError, OSError) as err:
+      print >> sys.stderr, "Could not download %s (attempt %d): %s" % (
+        item_name, attempt, err)
+      result['error'] = str(err)
+    if attempt < retries:
+      print "Retrying %s in %ds." % (item_name, delay)
+      time.sleep(delay)
+      delay *= 2
+  if result['success']:
+    result['source'] = 'network' if result['changed'] else 'cache'
+    result['bytes'] = os.path.getsize(cache_path)
+  result['duration'] = time.time() - start
+  return result
 
 
 def handle_dl(item_name, item_url, download_dir,
-              force_download):
-  """Download an item into the cache, returns True if downloaded."""
-  try:
-    print "Downloading into %s: %s" % (download_dir, item_name)
-    changed = download_url_to_cache(
-      item_url,
-      download_dir,
-      force_download
-    )
-    if not changed:
-      print "Found in cache"
-    return True
-  except MunkiDownloadError as err:
-    print >> sys.stderr, "Download error for %s: %s" % (item_name, err)
-  return False
+              force_download, results=None):
+  """Download an item into the cache, returns True if downloaded.
+
+  If results is a list, the result dict is added to it.
+  """
+  result = download_item(item_name, item_url, download_dir, force_download)
+  if results is not None:
+    results.append(result)
+  return result['success']
+
+
+def download_items(downloads, force_download, jobs=1):
+  """Download a list of items, up to jobs at a time.
+
+  Each download is a dict with the item 'name', 'url', download 'dir',
+  expected 'size' and, if known, its SHA-256 'hash'. The largest items are
+  started first, so a big download doesn't start last and hold up the
+  whole stage. The same file is only downloaded once. Returns the results
+  in the order of downloads.
+  """
+  unique = {}
+  for download in downloads:
+    key = (download['dir'], download['name'])
+    if key not in unique or download['size'] > unique[key]['size']:
+      unique[key] = download
+  order = sorted(
+    unique,
+    key=lambda key: (-unique[key]['size'], key)
+  )
+
+  def fetch(key):
+    """Download one item."""
+    download = unique[key]
+    return download_item(
+      download['name'], download['url'], download['dir'], force_download,
+      download.get('hash'))
+
+  if jobs > 1 and len(order) > 1:
+    pool = ThreadPool(min(jobs, len(order)))
+    try:
+      # One item per task, so the largest-first order is kept
+      results = pool.map(fetch, order, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = map(fetch, order)
+  by_key = dict(zip(order, results))
+  return [
+    by_key[(download['dir'], download['name'])] for download in downloads
+  ]
+
+
+def report_downloads(results):
+  """Print a summary of download results, and every failure."""
+  failed = [result for result in results if not result['success']]
+  cached = [
+    result for result in results
+    if result['success'] and not result['changed']
+  ]
+  stored = [result for result in cached if result.get('stored')]
+  print ("Downloads: %d downloaded, %d found in cache (%d in store), "
+         "%d failed." % (len(results) - len(failed) - len(cached),
+                         len(cached), len(stored), len(failed)))
+  for result in failed:
+    print >> sys.stderr, "Failed to download %s after %d attempts: %s" % (
+      result['name'], result['attempts'], result['error'])
+
+
+def write_failure_report(results, report_path):
+  """Write the failed downloads to report_path as JSON.
+
+  Returns the failures. If nothing failed, an old report is removed, so
+  the report only ever describes the last build.
+  """
+  failures = [
+    {
+      'name': result['name'],
+      'url': result['url'],
+      'dir': result['dir'],
+      'attempts': result['attempts'],
+      'error': result['error'],
+    }
+    for result in results if not result['success']
+  ]
+  if not failures:
+    if os.path.isfile(report_path):
+      os.remove(report_path)
+    return failures
+  report = {
+    'time': time.time(),
+    'failures': failures,
+  }
+  (handle, temp_path) = tempfile.mkstemp(
+    dir=os.path.dirname(report_path),
+    prefix='.' + os.path.basename(report_path))
+  with os.fdopen(handle, 'wb') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  os.rename(temp_path, report_path)
+  return failures
 
 
 # item functions
@@ -84,71 +311,125 @@ def get_item_url(item):
   return PKGS_URL + '/' + urllib2.quote(item["installer_item_location"])
 
 
-def download_icons(item_list, icon_dir):
-  """Download icons for items in the list.
-
-  Based on updatecheck.py, modified.
-  Copied from
-  https://github.com/munki/munki/blob/master/code/client/munkilib/updatecheck.py#L2824
+def icon_tasks(item_list, icon_dir):
+  """Return one icon to fetch per icon name used by the items in the list.
 
-  Attempts to download icons (actually png files) for items in
-     item_list
+  Several items often share an icon, so each icon is only fetched once.
   """
-  icon_list = []
   icon_known_exts = ['.bmp', '.gif', '.icns', '.jpg', '.jpeg', '.png', '.psd',
                      '.tga', '.tif', '.tiff', '.yuv']
   icon_base_url = (pref('IconURL') or
                    pref('SoftwareRepoURL') + '/icons/')
   icon_base_url = icon_base_url.rstrip('/') + '/'
+  tasks = {}
   for item in item_list:
     icon_name = item.get('icon_name') or item['name']
-    pkginfo_icon_hash = item.get('icon_hash')
     if not os.path.splitext(icon_name)[1] in icon_known_exts:
       icon_name += '.png'
-    icon_list.append(icon_name)
-    icon_url = icon_base_url + urllib2.quote(icon_name.encode('UTF-8'))
-    icon_path = os.path.join(icon_dir, icon_name)
-    if os.path.isfile(icon_path):
-      xattr_hash = getxattr(icon_path, XATTR_SHA)
-      if not xattr_hash:
-        xattr_hash = getsha256hash(icon_path)
-        writeCachedChecksum(icon_path, xattr_hash)
-    else:
-      xattr_hash = 'nonexistent'
-    icon_subdir = os.path.dirname(icon_path)
-    if not os.path.exists(icon_subdir):
-      try:
-          os.makedirs(icon_subdir, 0755)
-      except OSError, err:
-          print 'Could not create %s' % icon_subdir
-          continue
-    custom_headers = ['']
-    if BASIC_AUTH:
-      # custom_headers = ['Authorization: Basic %s' % BASIC_AUTH]
-      custom_headers = BASIC_AUTH
-    if pkginfo_icon_hash != xattr_hash:
-      item_name = item.get('display_name') or item['name']
-      message = 'Getting icon %s for %s...' % (icon_name, item_name)
-      try:
-        dummy_value = getResourceIfChangedAtomically(
-          icon_url, icon_path, custom_headers=custom_headers, message=message)
-      except MunkiDownloadError, err:
-        print ('Could not retrieve icon %s from the server: %s',
-               icon_name, err)
-      else:
-        if os.path.isfile(icon_path):
-            writeCachedChecksum(icon_path)
+    if icon_name in tasks:
+      if not tasks[icon_name]['icon_hash']:
+        tasks[icon_name]['icon_hash'] = item.get('icon_hash')
+      continue
+    tasks[icon_name] = {
+      'icon_name': icon_name,
+      'item_name': item.get('display_name') or item['name'],
+      'icon_hash': item.get('icon_hash'),
+      'url': icon_base_url + urllib2.quote(icon_name.encode('UTF-8')),
+      'path': os.path.join(icon_dir, icon_name),
+    }
+  return [tasks[name] for name in sorted(tasks)]
 
 
-def handle_icons(icon_dir, installinfo):
-  """Download icons and build the package."""
-  print "Downloading icons."
-  pkg_output_file = os.path.join(CACHE, 'munki_icons.pkg')
-  icon_list = installinfo['optional_installs']
+def fetch_icon(task):
+  """Fetch one icon unless the local copy matches its pkginfo hash.
+
+  Returns 'valid', 'downloaded' or 'failed'.
+  """
+  icon_path = task['path']
+  if task['icon_hash'] and os.path.isfile(icon_path):
+    # The cached hash is trusted, so valid icons are never read again
+    xattr_hash = getxattr(icon_path, XATTR_SHA)
+    if not xattr_hash:
+      xattr_hash = getsha256hash(icon_path)
+      writeCachedChecksum(icon_path, xattr_hash)
+    if xattr_hash == task['icon_hash']:
+      return 'valid'
+  icon_subdir = os.path.dirname(icon_path)
+  if not os.path.isdir(icon_subdir):
+    try:
+      os.makedirs(icon_subdir, 0755)
+    except OSError:
+      # Another worker may have created it first
+      if not os.path.isdir(icon_subdir):
+        print 'Could not create %s' % icon_subdir
+        return 'failed'
+  custom_headers = ['']
+  if BASIC_AUTH:
+    # custom_headers = ['Authorization: Basic %s' % BASIC_AUTH]
+    custom_headers = BASIC_AUTH
+  message = 'Getting icon %s for %s...' % (task['icon_name'], task['item_name'])
+  try:
+    getResourceIfChangedAtomically(
+      task['url'], icon_path, custom_headers=custom_headers, message=message)
+  except MunkiDownloadError as err:
+    print >> sys.stderr, 'Could not retrieve icon %s from the server: %s' % (
+      task['icon_name'], err)
+    return 'failed'
+  if os.path.isfile(icon_path):
+    writeCachedChecksum(icon_path)
+  return 'downloaded'
+
+
+def download_icons(item_list, icon_dir, jobs=ICON_JOBS):
+  """Download icons for items in the list.
+
+  Based on updatecheck.py, modified.
+  Copied from
+  https://github.com/munki/munki/blob/master/code/client/munkilib/updatecheck.py#L2824
+
+  Attempts to download icons (actually png files) for items in
+     item_list, up to jobs at a time. Returns a dict of icon name to
+     'valid', 'downloaded' or 'failed'.
+  """
+  tasks = icon_tasks(item_list, icon_dir)
+  if jobs > 1 and len(tasks) > 1:
+    pool = ThreadPool(min(jobs, len(tasks)))
+    try:
+      results = pool.map(fetch_icon, tasks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = [fetch_icon(task) for task in tasks]
+  icon_results = dict(
+    (task['icon_name'], result) for task, result in zip(tasks, results)
+  )
+  print "Icons: %d already valid, %d downloaded, %d failed." % (
+    results.count('valid'), results.count('downloaded'),
+    results.count('failed'))
+  return icon_results
+
+
+def icon_items(installinfo):
+  """Return the items whose icons go in the image."""
+  icon_list = list(installinfo['optional_installs'])
   icon_list.extend(installinfo['managed_installs'])
+  icon_list.extend(installinfo['managed_updates'])
   icon_list.extend(installinfo['removals'])
+  return icon_list
+
+
+def handle_icons(icon_dir, installinfo, icon_results=None):
+  """Download icons and build the package.
+
+  If icon_results is a dict, the result of each icon is added to it.
+  """
+  print "Downloading icons."
+  pkg_output_file = os.path.join(CACHE, 'munki_icons.pkg')
   # Downloads all icons into the icon directory in the Munki cache
-  download_icons(icon_list, icon_dir)
+  results = download_icons(icon_items(installinfo), icon_dir)
+  if icon_results is not None:
+    icon_results.update(results)
 
   # Build a package of optional Munki icons, so we don't need to cache
   success = build_pkg(
@@ -215,12 +496,24 @@ def prepare_local_paths(path_list):
   return fails
 
 
-def cleanup_local_cache(item_list, local_path):
-  """Remove items from local cache that aren't needed."""
+def unlink_unused(item_list, local_path):
+  """Remove items this build doesn't use from a cache directory.
+
+  Everything in the directory goes into the image, so only this build's
+  items may stay. The content of an item stays in the store, where the
+  cache policy evicts it once it's the least recently used, so a later
+  build that needs it again links it back instead of downloading it.
+  """
   for item in os.listdir(local_path):
     if item not in item_list:
+      path = os.path.join(local_path, item)
+      if STORE and os.stat(path).st_nlink == 1:
+        try:
+          autodmg_store.add(STORE, path)
+        except (IOError, OSError) as err:
+          print >> sys.stderr, "Could not add %s to store: %s" % (item, err)
       print "Removing: %s" % item
-      os.remove(os.path.join(local_path, item))
+      os.remove(path)
 
 
 def parse_extras(extras_file):
@@ -247,10 +540,14 @@ def parse_extras(extras_file):
   return extras
 
 
-def handle_extras(extras_file, exceptions_path, additions_path,
-                  force, exceptions, except_list, additions_list):
-  """Handle downloading and sorting the except/add file."""
-  extras = parse_extras(extras_file)
+def handle_extras(extras, exceptions_path, additions_path,
+                  force, exceptions, except_list, additions_list,
+                  results=None):
+  """Handle downloading and sorting the except/add lists.
+
+  extras is the dict returned by parse_extras. If results is a list, the
+  download results are added to it.
+  """
   # Check for additional packages
   if extras['additions']:
     print "Adding additional packages."
@@ -261,11 +558,11 @@ def handle_extras(extras_file, exceptions_path, additions_path,
         if item_name.endswith('.mobileconfig') and MUNKI_PROFILES is True:
           # profiles must be downloaded into the 'exceptions' directory
           if handle_dl(item_name, addition, exceptions_path,
-                       force):
+                       force, results):
             except_list.append(item_name)
         else:
           if handle_dl(item_name, addition, additions_path,
-                       force):
+                       force, results):
             additions_list.append(os.path.join(additions_path,
                                   item_name))
       else:
@@ -276,60 +573,698 @@ def handle_extras(extras_file, exceptions_path, additions_path,
       exceptions.append(exception)
 
 
+def classify_item(item, exceptions):
+  """Return how a managed install is cached, and a message about it.
+
+  The kind is 'normal', 'exception', 'profile' (cached as an exception) or
+  'nopkg' (not cached). The message is None for normal items.
+  """
+  if item['name'] in exceptions:
+    return ('exception', "Adding to exceptions list.")
+  elif 'installer_type' not in item:
+    # Assume it's a package
+    if (
+      'postinstall_script',
+      'preinstall_script',
+      'installcheck_script'
+    ) in item:
+      # We shouldn't try to do anything with Munki scripts
+      exception = True
+    exception = False
+  elif item['installer_type'] == 'nopkg':
+    # Obviously we don't attempt to handle these
+    return ('nopkg', "Nopkg found, skipping.")
+  elif item['installer_type'] == 'profile':
+    # Profiles go into the 'exceptions' dir automatically
+    return ('profile', "Profile found, adding to exceptions.")
+  elif item['installer_type'] == 'copy_from_dmg':
+    exception = False
+    if (
+      len(item['items_to_copy']) != 1 or
+      item['items_to_copy'][0]['destination_path'] != '/Applications'
+    ):
+      # Only copy_from_dmgs that have single items going
+      # into /Applications are supported
+      return ('exception',
+              "Complex copy_from_dmg found, adding to exceptions.")
+  else:
+    # It's probably something Adobe related
+    exception = True
+  return ('exception' if exception else 'normal', None)
+
+
+def item_download(item, kind, exceptions_path, download_path):
+  """Return the download dict of a managed install of the given kind."""
+  exception = kind != 'normal'
+  itemurl = get_item_url(item)
+  return {
+    'name': getURLitemBasename(itemurl),
+    'url': itemurl,
+    # Exceptions go into the exceptions directory
+    'dir': exceptions_path if exception else download_path,
+    'size': item.get('installer_item_size', 0),
+    'hash': item.get('installer_item_hash'),
+    'exception': exception,
+  }
+
+
 def process_managed_installs(install_list, exceptions, except_list, item_list,
-                             exceptions_path, download_path, force):
-  """Download managed_installs."""
+                             exceptions_path, download_path, force, jobs=1):
+  """Download managed_installs.
+
+  Items are sorted into exceptions and normal items first, then downloaded
+  up to jobs at a time. except_list and item_list are filled in the order
+  of install_list, however the downloads finish. Returns the download
+  results.
+  """
   print "Checking for managed installs..."
   print "Exceptions list: %s" % exceptions
+  downloads = []
   for item in install_list:
     print "Looking at: %s" % item['name']
-    if item['name'] in exceptions:
-      print "Adding to exceptions list."
-      exception = True
-    elif 'installer_type' not in item:
-      # Assume it's a package
-      if (
-        'postinstall_script',
-        'preinstall_script',
-        'installcheck_script'
-      ) in item:
-        # We shouldn't try to do anything with Munki scripts
-        exception = True
-      exception = False
-    elif item['installer_type'] == 'nopkg':
-      # Obviously we don't attempt to handle these
-      print "Nopkg found, skipping."
+    (kind, message) = classify_item(item, exceptions)
+    if message:
+      print message
+    if kind == 'nopkg':
       continue
-    elif item['installer_type'] == 'profile':
-      # Profiles go into the 'exceptions' dir automatically
-      print "Profile found, adding to exceptions."
-      exception = True
-    elif item['installer_type'] == 'copy_from_dmg':
-      exception = False
-      if (
-        len(item['items_to_copy']) != 1 or
-        item['items_to_copy'][0]['destination_path'] != '/Applications'
-      ):
-        # Only copy_from_dmgs that have single items going
-        # into /Applications are supported
-        print "Complex copy_from_dmg found, adding to exceptions."
-        exception = True
-    else:
-      # It's probably something Adobe related
-      exception = True
-    itemurl = get_item_url(item)
-    item_basename = getURLitemBasename(itemurl)
-    if exception:
-      # Try to download the exception into the exceptions directory
+    downloads.append(
+      item_download(item, kind, exceptions_path, download_path))
+  results = download_items(downloads, force, jobs)
+  for download, result in zip(downloads, results):
+    if not result['success']:
+      continue
+    if download['exception']:
       # Add it to the exceptions list
-      if handle_dl(item_basename, itemurl, exceptions_path,
-                   force):
-        except_list.append(urllib2.unquote(item_basename))
+      except_list.append(urllib2.unquote(download['name']))
     else:
       # Add it to the item list
-      if handle_dl(item_basename, itemurl, download_path,
-                   force):
-        item_list.append(urllib2.unquote(item_basename))
+      item_list.append(urllib2.unquote(download['name']))
+  report_downloads(results)
+  return results
+
+
+# build stages
+# Each takes the pipeline context: the parsed arguments, the cache
+# directories, the parsed extras and the output of every earlier stage.
+def stage_resolve(context):
+  """Load the manifest and catalogs, and resolve the items to cache.
+
+  The catalogs and the manifest closure are indexed once, and every
+  manifest key is resolved from the index in one pass.
+  """
+  args = context['args']
+  start = time.time()
+  # These are necessary to populate the globals used in updatecheck
+  keychain_obj = keychain.MunkiKeychain()  # pylint: disable=unused-variable
+  manifestpath = updatecheck.getPrimaryManifest(args.manifest)
+  updatecheck.getCatalogs([args.catalog])
+  condition = updatecheck.predicateEvaluatesAsTrue
+  catalog_index = autodmg_index.CatalogIndex(
+    autodmg_index.host_filter(condition=condition))
+  catalog_index.load(os.path.join(pref('ManagedInstallDir'), 'catalogs'),
+                     [args.catalog])
+
+  def fetch_manifest(name):
+    """Return the local path of a manifest, downloading included ones."""
+    if name == args.manifest:
+      return manifestpath
+    return updatecheck.getmanifest(name)
+
+  manifest_index = autodmg_index.ManifestIndex(fetch_manifest, condition)
+  closure = manifest_index.closure(args.manifest)
+  resolved = autodmg_index.resolve(closure, catalog_index, [args.catalog])
+  for name in resolved['missing']:
+    print >> sys.stderr, "%s is not in the %s catalog." % (name, args.catalog)
+  print ("Resolved %d managed installs, %d managed updates, %d managed "
+         "uninstalls and %d optional installs from %d manifests and %d "
+         "pkginfos in %.2fs." % (
+           len(resolved['managed_installs']),
+           len(resolved['managed_updates']),
+           len(resolved['managed_uninstalls']),
+           len(resolved['optional_installs']),
+           len(manifest_index.manifests), catalog_index.pkginfo_count,
+           time.time() - start))
+  installinfo = {
+    'managed_installs': resolved['managed_installs'],
+    'managed_updates': resolved['managed_updates'],
+    'optional_installs': resolved['optional_installs'],
+    'removals': resolved['managed_uninstalls'],
+  }
+  return {'install_list': resolved['managed_installs'],
+          'installinfo': installinfo}
+
+
+def stage_extras(context):
+  """Download the additions of the extras file."""
+  except_list = []
+  additions_list = []
+  results = []
+  if context['args'].extras:
+    # Additions are downloaded & added to the additions_list
+    # Downloaded exceptions are added to the except_list list.
+    handle_extras(
+      context['extras'],
+      context['dirs']['exceptions'],
+      context['dirs']['additions'],
+      context['args'].download,
+      [],
+      except_list,
+      additions_list,
+      results
+    )
+  return {'except_list': except_list, 'additions_list': additions_list,
+          'downloads': results}
+
+
+def stage_managed_installs(context):
+  """Download the managed installs.
+
+  Every managed install is required: if any are still missing after their
+  retries, they are written to the failure report and the stage fails, so
+  the image isn't built without them.
+  """
+  item_list = []
+  except_list = []
+  results = process_managed_installs(context['resolve']['install_list'],
+                           context['extras']['exceptions'],
+                           except_list, item_list,
+                           context['dirs']['exceptions'],
+                           context['dirs']['downloads'],
+                           context['args'].download,
+                           context['args'].jobs)
+  report_path = os.path.join(context['dirs']['logs'], FAILURE_REPORT)
+  failures = write_failure_report(results, report_path)
+  if failures:
+    raise BuildError(
+      "%d managed installs are missing, see %s: %s" % (
+        len(failures), report_path,
+        ', '.join(failure['name'] for failure in failures)))
+  return {'item_list': item_list, 'except_list': except_list,
+          'downloads': results}
+
+
+def stage_icons(context):
+  """Download icons and build the icon package.
+
+  Returns the package path, and the icons this build uses.
+  """
+  if context['args'].noicons:
+    return {'pkg': None, 'icons': [], 'results': {}}
+  installinfo = context['resolve']['installinfo']
+  icon_dir = context['dirs']['icons']
+  icon_results = {}
+  pkg = handle_icons(icon_dir, installinfo, icon_results)
+  return {
+    'pkg': pkg,
+    'icons': [
+      task['path'] for task in icon_tasks(icon_items(installinfo), icon_dir)
+    ],
+    'results': icon_results,
+  }
+
+
+def stage_custom(context):
+  """Build the Munki custom resources package, returns its path."""
+  return handle_custom(context['args'].custom)
+
+
+def stage_cleanup(context):
+  """Remove items we don't recognize from the image directories."""
+  unlink_unused(context['managed_installs']['item_list'],
+                context['dirs']['downloads'])
+  unlink_unused(context['managed_installs']['except_list'] +
+                context['download_extras']['except_list'],
+                context['dirs']['exceptions'])
+  return True
+
+
+def stage_evict(context):
+  """Evict the least recently used files once the cache is over its limit.
+
+  Returns the eviction report.
+  """
+  args = context['args']
+  used = list(context['icons']['icons'])
+  used.extend(
+    path for path in context['download_extras']['additions_list']
+    if path.startswith(context['dirs']['additions'] + os.sep)
+  )
+  # Everything else that went into the image
+  used.extend(
+    pkg for pkg in [context['icons']['pkg'], context['custom'],
+                    context['exceptions_pkg']] + list(context['org'] or [])
+    if pkg
+  )
+  report = autodmg_cache_policy.evict(
+    CACHE, int(args.cache_limit * 1073741824), used)
+  for line in autodmg_cache_policy.report_lines(report):
+    print line
+  return report
+
+
+def stage_exceptions_pkg(context):
+  """Build the package of exceptions, if any, returns its path."""
+  if not (context['managed_installs']['except_list'] or
+          context['download_extras']['except_list']):
+    return None
+  pkg_output_file = os.path.join(CACHE, 'munki_cache.pkg')
+  success = build_pkg(
+    context['dirs']['exceptions'],
+    'munki_cache',
+    'com.facebook.cpe.munki_exceptions',
+    '/Library/Managed Installs/Cache',
+    CACHE,
+    'Building exceptions package'
+  )
+  if success:
+    return pkg_output_file
+  print "Failed to build exceptions package!"
+  return None
+
+
+def stage_org(context):
+  """Run any extra code or package builds, returns the packages."""
+  sys.stdout.flush()
+  return autodmg_org.run_unique_code(context['args'])
+
+
+def stage_image(context):
+  """Write the AutoDMG template and build the image.
+
+  Returns the image path, its size and how long AutoDMG took.
+  """
+  args = context['args']
+  dir_struct = context['dirs']
+  additions_list = list(context['download_extras']['additions_list'])
+  for pkg in (context['icons']['pkg'], context['custom'],
+              context['exceptions_pkg']):
+    if pkg:
+      additions_list.append(pkg)
+  additions_list.extend(context['org'])
+  loglevel = str(args.loglevel)
+
+  # Now that cache is downloaded, let's add it to the AutoDMG template.
+  print "Creating AutoDMG-full.adtmpl."
+  templatepath = os.path.join(CACHE, 'AutoDMG-full.adtmpl')
+
+  plist = dict()
+  plist["ApplyUpdates"] = args.disableupdates
+  plist["SourcePath"] = args.source
+  plist["TemplateFormat"] = "1.0"
+  plist["VolumeName"] = args.volumename
+  plist["AdditionalPackages"] = [
+    os.path.join(
+      dir_struct['downloads'], f
+    ) for f in os.listdir(
+      dir_struct['downloads']
+    ) if (not f == '.DS_Store') and (f not in additions_list)
+  ]
+
+  if additions_list:
+    plist["AdditionalPackages"].extend(additions_list)
+
+  # Complete the AutoDMG-full.adtmpl template
+  plistlib.writePlist(plist, templatepath)
+  autodmg_cmd = [
+    '/Applications/AutoDMG.app/Contents/MacOS/AutoDMG'
+  ]
+  if os.getuid() == 0:
+    # We are running as root
+    print "Running as root."
+    autodmg_cmd.append('--root')
+  if args.update:
+    # Update the profiles plist too
+    print "Updating UpdateProfiles.plist..."
+    cmd = autodmg_cmd + ['update']
+    run(cmd)
+
+  logfile = os.path.join(args.logpath, 'build.log')
+  # Now kick off the AutoDMG build
+  dmg_output_path = os.path.join(CACHE, args.output)
+  sys.stdout.flush()
+  print "Building disk image..."
+  if os.path.isfile(dmg_output_path):
+    os.remove(dmg_output_path)
+  cmd = autodmg_cmd + [
+    '-L', loglevel,
+    '-l', logfile,
+    'build', templatepath,
+    '--download-updates',
+    '-o', dmg_output_path]
+  print "Full command: %s" % cmd
+  start = time.time()
+  run(cmd)
+  seconds = time.time() - start
+  if not os.path.isfile(dmg_output_path):
+    raise BuildError("Failed to create disk image!")
+  return {
+    'path': dmg_output_path,
+    'bytes': os.path.getsize(dmg_output_path),
+    'autodmg_seconds': seconds,
+  }
+
+
+def stage_deliver(context):
+  """Deliver the image to the DS repo and move target, if given."""
+  args = context['args']
+  deliveries = []
+  # Check the Deploystudio masters to see if this image already exists
+  sys.stdout.flush()
+  if args.dsrepo:
+    deliveries.append(
+      populate_ds_repo(context['image']['path'], args.dsrepo))
+
+  if args.movefile:
+    deliveries.append(move_file(context['image']['path'], args.movefile))
+  return deliveries
+
+
+def build_stages():
+  """Return the stages of a build, with what each of them requires."""
+  stage = autodmg_pipeline.Stage
+  return [
+    # Loads munkilib's catalogs and the index in memory, so it always runs
+    stage('resolve', stage_resolve, resumable=False),
+    # Named so its output doesn't replace the parsed extras in the context
+    stage('download_extras', stage_extras),
+    stage('managed_installs', stage_managed_installs, ['resolve']),
+    stage('icons', stage_icons, ['resolve']),
+    stage('custom', stage_custom, ['resolve']),
+    stage('org', stage_org),
+    stage('cleanup', stage_cleanup, ['managed_installs', 'download_extras']),
+    stage('exceptions_pkg', stage_exceptions_pkg, ['cleanup']),
+    stage('image', stage_image,
+          ['cleanup', 'icons', 'custom', 'exceptions_pkg', 'org'],
+          valid=lambda image: os.path.isfile(image['path'])),
+    stage('deliver', stage_deliver, ['image'], resumable=False),
+    # After the image, so a build never waits on it
+    stage('evict', stage_evict, ['image'], resumable=False),
+  ]
+
+
+def build_key(args):
+  """Return what identifies a build, for resuming it."""
+  settings = dict(
+    (key, value) for key, value in vars(args).iteritems()
+    if key not in ('resume', 'jobs', 'stage_jobs', 'cache_limit', 'report')
+  )
+  return json.dumps(settings, sort_keys=True)
+
+
+def rate(size, seconds):
+  """Return a throughput in MB/s, or None if it can't be measured."""
+  if not size or not seconds:
+    return None
+  return size / 1048576.0 / seconds
+
+
+def download_telemetry(context):
+  """Return the per-item download records and their totals."""
+  items = []
+  for (stage, phase) in (('managed_installs', 'managed_installs'),
+                         ('download_extras', 'extras')):
+    for result in (context.get(stage) or {}).get('downloads', []):
+      record = dict(
+        (key, result.get(key)) for key in (
+          'name', 'dir', 'success', 'source', 'bytes', 'duration',
+          'attempts', 'error'))
+      record['phase'] = phase
+      record['cache_hit'] = result.get('source') in ('store', 'cache')
+      if result.get('source') == 'network':
+        record['mb_per_second'] = rate(result['bytes'], result['duration'])
+      items.append(record)
+  network = [item for item in items if item['source'] == 'network']
+  totals = {
+    'items': len(items),
+    'bytes': sum(item['bytes'] or 0 for item in items),
+    'network_bytes': sum(item['bytes'] or 0 for item in network),
+    'hits': len([item for item in items if item['cache_hit']]),
+    'misses': len(network),
+    'failed': len([item for item in items if not item['success']]),
+    # Summed over items that may have run at once
+    'seconds': sum(item['duration'] or 0 for item in items),
+  }
+  return {'items': items, 'totals': totals}
+
+
+def build_report(context, pipeline, started, success, error=None):
+  """Return the telemetry of a build as a dict that can be written as JSON.
+
+  Covers what ran, even if the build failed part way.
+  """
+  args = context['args']
+  icon_results = (context.get('icons') or {}).get('results', {}).values()
+  image = context.get('image')
+  deliveries = []
+  for delivery in context.get('deliver') or []:
+    delivery = dict(delivery)
+    delivery['mb_per_second'] = rate(delivery['bytes'], delivery['seconds'])
+    deliveries.append(delivery)
+  return {
+    'host': socket.gethostname(),
+    'manifest': args.manifest,
+    'catalog': args.catalog,
+    'started': started,
+    'finished': time.time(),
+    'duration': time.time() - started,
+    'success': success,
+    'error': error,
+    'stages': pipeline.report,
+    'stage_wall_time': pipeline.wall_time,
+    'downloads': download_telemetry(context),
+    'icons': dict(
+      (status, icon_results.count(status))
+      for status in ('valid', 'downloaded', 'failed')),
+    'packages': list(autodmg_utility.PKG_BUILDS),
+    'image': image,
+    'deliveries': deliveries,
+    'eviction': context.get('evict'),
+  }
+
+
+def write_report(report, report_path):
+  """Atomically write a build report as JSON."""
+  report_dir = os.path.dirname(report_path)
+  if not os.path.isdir(report_dir):
+    os.makedirs(report_dir)
+  (handle, temp_path) = tempfile.mkstemp(
+    dir=report_dir, prefix='.' + os.path.basename(report_path))
+  with os.fdopen(handle, 'wb') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  os.rename(temp_path, report_path)
+
+
+# planning functions
+def item_state(download, force):
+  """Return where a build would get an item: 'store', 'cache' or 'download'.
+
+  Cached items are assumed to still match the server.
+  """
+  if force:
+    return 'download'
+  if STORE and download.get('hash') and autodmg_store.has(
+      STORE, download['hash']):
+    return 'store'
+  if os.path.isfile(
+      os.path.join(download['dir'], urllib2.unquote(download['name']))):
+    return 'cache'
+  return 'download'
+
+
+def plan_estimates(report_path):
+  """Return the rates and times to estimate a build with.
+
+  They come from the last build report if there is one, otherwise from the
+  PLAN_ defaults.
+  """
+  estimates = {
+    'source': 'defaults',
+    'download_rate': PLAN_DOWNLOAD_RATE,
+    'pkg_seconds': {},
+    'autodmg_seconds': PLAN_AUTODMG_SECONDS,
+  }
+  if not os.path.isfile(report_path):
+    return estimates
+  try:
+    with open(report_path, 'rb') as f:
+      report = json.load(f)
+  except (IOError, ValueError) as err:
+    print >> sys.stderr, "Ignoring unreadable build report: %s" % err
+    return estimates
+  estimates['source'] = report_path
+  network = [
+    item for item in report.get('downloads', {}).get('items', [])
+    if item.get('source') == 'network' and item.get('duration')
+  ]
+  measured = rate(sum(item['bytes'] for item in network),
+                  sum(item['duration'] for item in network))
+  if measured:
+    estimates['download_rate'] = measured
+  for pkg in report.get('packages', []):
+    if pkg['status'] == 'built':
+      estimates['pkg_seconds'][pkg['pkg']] = pkg['seconds']
+  if (report.get('image') or {}).get('autodmg_seconds'):
+    estimates['autodmg_seconds'] = report['image']['autodmg_seconds']
+  return estimates
+
+
+def plan_packages(context, items, extras):
+  """Return whether each package build_pkg makes would be rebuilt."""
+  args = context['args']
+  dirs = context['dirs']
+  packages = []
+  if not args.noicons:
+    tasks = icon_tasks(
+      icon_items(context['resolve']['installinfo']), dirs['icons'])
+    missing = [task for task in tasks if not os.path.isfile(task['path'])]
+    packages.append({
+      'pkg': os.path.join(CACHE, 'munki_icons.pkg'),
+      'rebuild': bool(missing) or not autodmg_utility.pkg_up_to_date(
+        dirs['icons'], 'munki_icons', 'com.facebook.cpe.munki_icons',
+        '/Library/Managed Installs/icons', CACHE),
+      'reason': '%d icons to download' % len(missing) if missing else None,
+    })
+  resource_dir = os.path.join(pref('ManagedInstallDir'), 'client_resources')
+  if os.path.isfile(os.path.join(resource_dir, 'custom.zip')):
+    # The build downloads the client resources again first
+    rebuild = not autodmg_utility.pkg_up_to_date(
+      resource_dir, 'munki_custom', 'com.facebook.cpe.munki_custom',
+      args.custom, CACHE)
+    packages.append({
+      'pkg': os.path.join(CACHE, 'munki_custom.pkg'),
+      'rebuild': rebuild,
+      'reason': None if rebuild else 'unless client resources changed',
+    })
+  exceptions = [
+    entry for entry in items + extras
+    if entry.get('dir') == dirs['exceptions']
+  ]
+  if exceptions:
+    wanted = set(urllib2.unquote(entry['file']) for entry in exceptions)
+    changed = (
+      wanted != set(os.listdir(dirs['exceptions'])) or
+      any(entry['state'] != 'cache' for entry in exceptions))
+    packages.append({
+      'pkg': os.path.join(CACHE, 'munki_cache.pkg'),
+      'rebuild': changed or not autodmg_utility.pkg_up_to_date(
+        dirs['exceptions'], 'munki_cache',
+        'com.facebook.cpe.munki_exceptions',
+        '/Library/Managed Installs/Cache', CACHE),
+      'reason': 'exceptions changed' if changed else None,
+    })
+  return packages
+
+
+def plan_build(context, report_path):
+  """Work out what a build would do, without downloading or building.
+
+  Resolves the manifest and catalogs, classifies every managed install the
+  way process_managed_installs does and checks the cache for it. Returns
+  a dict of the items, the packages and the estimated duration.
+  """
+  args = context['args']
+  dirs = context['dirs']
+  context['resolve'] = stage_resolve(context)
+  items = []
+  for item in context['resolve']['install_list']:
+    (kind, dummy_message) = classify_item(
+      item, context['extras']['exceptions'])
+    entry = {
+      'name': item['name'],
+      'version': item.get('version'),
+      'kind': kind,
+      'state': None,
+      'bytes': item.get('installer_item_size', 0) * 1024,
+    }
+    if kind != 'nopkg':
+      download = item_download(
+        item, kind, dirs['exceptions'], dirs['downloads'])
+      entry['file'] = download['name']
+      entry['dir'] = download['dir']
+      entry['state'] = item_state(download, args.download)
+    items.append(entry)
+  extras = []
+  for addition in context['extras']['additions']:
+    if "http" not in addition:
+      continue
+    item_name = getURLitemBasename(addition)
+    item_dir = dirs['additions']
+    if item_name.endswith('.mobileconfig') and MUNKI_PROFILES is True:
+      item_dir = dirs['exceptions']
+    extras.append({
+      'name': item_name,
+      'file': item_name,
+      'dir': item_dir,
+      'kind': 'addition',
+      'state': item_state(
+        {'name': item_name, 'dir': item_dir}, args.download),
+      # The extras file doesn't give sizes
+      'bytes': None,
+    })
+  packages = plan_packages(context, items, extras)
+  estimates = plan_estimates(report_path)
+  to_download = [
+    planned for planned in items + extras if planned['state'] == 'download'
+  ]
+  download_bytes = sum(planned['bytes'] or 0 for planned in to_download)
+  download_seconds = 0
+  if to_download:
+    download_seconds = (
+      download_bytes / 1048576.0 / estimates['download_rate'] /
+      max(1, min(args.jobs, len(to_download))))
+  pkg_seconds = sum(
+    estimates['pkg_seconds'].get(pkg['pkg'], PLAN_PKG_SECONDS)
+    for pkg in packages if pkg['rebuild'])
+  return {
+    'items': items,
+    'extras': extras,
+    'packages': packages,
+    'download_items': len(to_download),
+    'download_bytes': download_bytes,
+    'estimates': estimates,
+    'duration': {
+      'downloads': download_seconds,
+      'packages': pkg_seconds,
+      'autodmg': estimates['autodmg_seconds'],
+      'total': download_seconds + pkg_seconds + estimates['autodmg_seconds'],
+    },
+  }
+
+
+def plan_lines(plan):
+  """Return a build plan as a list of printable lines."""
+  lines = ["%-10s %-9s %10s  %s" % ('kind', 'state', 'MB', 'item')]
+  for entry in plan['items'] + plan['extras']:
+    size = '?'
+    if entry['bytes'] is not None:
+      size = '%.1f' % (entry['bytes'] / 1048576.0)
+    lines.append("%-10s %-9s %10s  %s" % (
+      entry['kind'], entry['state'] or '-', size, entry['name']))
+  kinds = [entry['kind'] for entry in plan['items']]
+  lines.append(
+    "%d managed installs: %d normal, %d exceptions, %d profiles, %d nopkg "
+    "(not cached)." % (
+      len(kinds), kinds.count('normal'), kinds.count('exception'),
+      kinds.count('profile'), kinds.count('nopkg')))
+  states = [entry['state'] for entry in plan['items'] + plan['extras']]
+  lines.append(
+    "To download: %d items, %.1f MB. In the store: %d. In the cache: %d." % (
+      plan['download_items'], plan['download_bytes'] / 1048576.0,
+      states.count('store'), states.count('cache')))
+  for pkg in plan['packages']:
+    status = 'rebuild' if pkg['rebuild'] else 'up to date'
+    if pkg['reason']:
+      status += ' (%s)' % pkg['reason']
+    lines.append("%s: %s" % (os.path.basename(pkg['pkg']), status))
+  lines.append("Org packages from autodmg_org aren't planned.")
+  duration = plan['duration']
+  lines.append(
+    "Estimated duration: %d min (downloads %d min at %.1f MB/s, packages "
+    "%d min, AutoDMG %d min), from %s." % (
+      duration['total'] / 60, duration['downloads'] / 60,
+      plan['estimates']['download_rate'], duration['packages'] / 60,
+      duration['autodmg'] / 60, plan['estimates']['source']))
+  return lines
 
 
 def wait_for_network():
@@ -405,6 +1340,30 @@ def main():
   parser.add_argument(
     '--extras', help='Path to JSON file containing additions '
                      ' and exceptions lists.')
+  parser.add_argument(
+    '-j', '--jobs', help='Number of managed installs to download at once. '
+                         'Defaults to 1.',
+    default=1, type=int)
+  parser.add_argument(
+    '--cache-limit', help='Size in GB the cache is kept under, evicting '
+                          'the least recently used files. 0 for no limit. '
+                          'Defaults to %d.' % autodmg_cache_policy.LIMIT_GB,
+    default=autodmg_cache_policy.LIMIT_GB, type=float)
+  parser.add_argument(
+    '--plan', help='Show what a build would download and rebuild, and '
+                   'how long it would take, without doing it.',
+    action='store_true', default=False)
+  parser.add_argument(
+    '--report', help='Path to write the JSON build report to. Defaults to '
+                     '%s in the log path.' % REPORT_NAME)
+  parser.add_argument(
+    '--stage-jobs', help='Number of build stages to run at once. '
+                         'Defaults to %d.' % STAGE_JOBS,
+    default=STAGE_JOBS, type=int)
+  parser.add_argument(
+    '--resume', help='Rerun the last build from the stages that failed, '
+                     'reusing what the other stages did.',
+    action='store_true', default=False)
   args = parser.parse_args()
 
   if args.installmobileconfig:
@@ -419,6 +1378,7 @@ def main():
     print >> sys.stderr, "Error: HTTPS was used but no auth provided."
     sys.exit(2)
 
+  started = time.time()
   print time.strftime("%c")
   print "Starting run..."
   # Create the local cache directories
@@ -429,170 +1389,55 @@ def main():
     'exceptions': os.path.join(CACHE, 'exceptions'),
     'manifests': os.path.join(CACHE, 'manifests'),
     'icons': os.path.join(CACHE, 'icons'),
-    'logs': os.path.join(CACHE, 'logs')
+    'logs': os.path.join(CACHE, 'logs'),
+    'store': os.path.join(CACHE, 'store'),
   }
   path_creation = prepare_local_paths(dir_struct.values())
   if path_creation > 0:
     print "Error setting up local cache directories."
     sys.exit(-1)
+  global STORE
+  STORE = dir_struct['store']
 
-  # These are necessary to populate the globals used in updatecheck
-  keychain_obj = keychain.MunkiKeychain()
-  manifestpath = updatecheck.getPrimaryManifest(args.manifest)
-  updatecheck.getPrimaryManifestCatalogs(args.manifest)
-  updatecheck.getCatalogs([args.catalog])
-
-  installinfo = {}
-  installinfo['processed_installs'] = []
-  installinfo['processed_uninstalls'] = []
-  installinfo['managed_updates'] = []
-  installinfo['optional_installs'] = []
-  installinfo['managed_installs'] = []
-  installinfo['removals'] = []
-  updatecheck.processManifestForKey(manifestpath, 'managed_installs',
-                                    installinfo)
-  # installinfo['managed_installs'] now contains a list of all managed_installs
-  install_list = []
-  for item in installinfo['managed_installs']:
-    detail = updatecheck.getItemDetail(item['name'], [args.catalog])
-    if detail:
-      install_list.append(detail)
-
-  # Prior to downloading anything, populate the lists
-  additions_list = list()
-  item_list = list()
-  except_list = list()
-  exceptions = list()
-  # exceptions[] is a list of exceptions specified by the extras file
-  # except_list is a list of files downloaded into the exceptions dir
+  extras = {'exceptions': [], 'additions': []}
   if args.extras:
-    # Additions are downloaded & added to the additions_list
-    # Exceptions are added to the exceptions list,
-    # Downloaded exceptions are added to the except_list list.
-    handle_extras(
-      args.extras,
-      dir_struct['exceptions'],
-      dir_struct['additions'],
-      args.download,
-      exceptions,
-      except_list,
-      additions_list
-    )
-
-  # Check for managed_install items and download them
-  process_managed_installs(install_list, exceptions,
-                           except_list, item_list,
-                           dir_struct['exceptions'],
-                           dir_struct['downloads'],
-                           args.download)
-
-  # Icon handling
-  icon_pkg_file = False
-  if not args.noicons:
-    # Get icons for Managed Updates, Optional Installs and removals
-    updatecheck.processManifestForKey(manifestpath, 'managed_updates',
-                                    installinfo)
-    updatecheck.processManifestForKey(manifestpath, 'managed_uninstalls',
-                                    installinfo)
-    updatecheck.processManifestForKey(manifestpath, 'optional_installs',
-                                    installinfo)
-    icon_pkg_file = handle_icons(dir_struct['icons'], installinfo)
-  if icon_pkg_file:
-    additions_list.extend([icon_pkg_file])
-
-  # Munki custom resources handling
-  custom_pkg_file = handle_custom(args.custom)
-  if custom_pkg_file:
-    additions_list.extend([custom_pkg_file])
-
-  # Clean up cache of items we don't recognize
-  cleanup_local_cache(item_list, dir_struct['downloads'])
-  cleanup_local_cache(except_list, dir_struct['exceptions'])
-
-  # Build the package of exceptions, if any
-  if except_list:
-    pkg_output_file = os.path.join(CACHE, 'munki_cache.pkg')
-    success = build_pkg(
-      dir_struct['exceptions'],
-      'munki_cache',
-      'com.facebook.cpe.munki_exceptions',
-      '/Library/Managed Installs/Cache',
-      CACHE,
-      'Building exceptions package'
-    )
-    if success:
-      additions_list.extend([pkg_output_file])
-    else:
-      print "Failed to build exceptions package!"
-
-  loglevel = str(args.loglevel)
-
-  # Run any extra code or package builds
-  sys.stdout.flush()
-  pkg_list = autodmg_org.run_unique_code(args)
-  additions_list.extend(pkg_list)
-
-  # Now that cache is downloaded, let's add it to the AutoDMG template.
-  print "Creating AutoDMG-full.adtmpl."
-  templatepath = os.path.join(CACHE, 'AutoDMG-full.adtmpl')
-
-  plist = dict()
-  plist["ApplyUpdates"] = args.disableupdates
-  plist["SourcePath"] = args.source
-  plist["TemplateFormat"] = "1.0"
-  plist["VolumeName"] = args.volumename
-  plist["AdditionalPackages"] = [
-    os.path.join(
-      dir_struct['downloads'], f
-    ) for f in os.listdir(
-      dir_struct['downloads']
-    ) if (not f == '.DS_Store') and (f not in additions_list)
-  ]
-
-  if additions_list:
-    plist["AdditionalPackages"].extend(additions_list)
-
-  # Complete the AutoDMG-full.adtmpl template
-  plistlib.writePlist(plist, templatepath)
-  autodmg_cmd = [
-    '/Applications/AutoDMG.app/Contents/MacOS/AutoDMG'
-  ]
-  if os.getuid() == 0:
-    # We are running as root
-    print "Running as root."
-    autodmg_cmd.append('--root')
-  if args.update:
-    # Update the profiles plist too
-    print "Updating UpdateProfiles.plist..."
-    cmd = autodmg_cmd + ['update']
-    run(cmd)
+    # exceptions is a list of exceptions specified by the extras file
+    extras = parse_extras(args.extras)
 
-  logfile = os.path.join(args.logpath, 'build.log')
-  # Now kick off the AutoDMG build
-  dmg_output_path = os.path.join(CACHE, args.output)
-  sys.stdout.flush()
-  print "Building disk image..."
-  if os.path.isfile(dmg_output_path):
-    os.remove(dmg_output_path)
-  cmd = autodmg_cmd + [
-    '-L', loglevel,
-    '-l', logfile,
-    'build', templatepath,
-    '--download-updates',
-    '-o', dmg_output_path]
-  print "Full command: %s" % cmd
-  run(cmd)
-  if not os.path.isfile(dmg_output_path):
-    print >> sys.stderr, "Failed to create disk image!"
+  context = {'args': args, 'dirs': dir_struct, 'extras': extras}
+  pipeline = autodmg_pipeline.Pipeline(
+    build_stages(), args.stage_jobs,
+    os.path.join(CACHE, PIPELINE_STATE), build_key(args))
+  report_path = args.report or os.path.join(args.logpath, REPORT_NAME)
+  if args.plan:
+    for line in plan_lines(plan_build(context, report_path)):
+      print line
+    return
+  # Only a pipeline that finished cleanly counts, not one interrupted by
+  # any other exception
+  success = False
+  error = None
+  try:
+    pipeline.run(context, resume=args.resume)
+    success = True
+  except autodmg_pipeline.PipelineError as err:
+    error = str(err)
+    print >> sys.stderr, err
+    print >> sys.stderr, "Run again with --resume to retry from there."
     sys.exit(1)
-
-  # Check the Deploystudio masters to see if this image already exists
-  sys.stdout.flush()
-  if args.dsrepo:
-    populate_ds_repo(dmg_output_path, args.dsrepo)
-
-  if args.movefile:
-    move_file(dmg_output_path, args.movefile)
+  except BaseException as err:
+    error = str(err) or repr(err)
+    raise
+  finally:
+    for line in pipeline.report_lines():
+      print line
+    try:
+      write_report(build_report(context, pipeline, started, success, error),
+                   report_path)
+      print "Build report written to %s" % report_path
+    except (IOError, OSError) as err:
+      print >> sys.stderr, "Could not write build report: %s" % err
+  pipeline.clear_state()
 
   print "Ending run."
   print time.strftime("%c")
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+"""Keep the AutoDMG cache under a size limit, evicting what went unused.
+
+Everything in the store, downloads, exceptions, additions and icons
+directories counts towards the limit, with hard links to the same file
+counted once. Each build records when it last used each file. Files the
+current build used, and everything in downloads and exceptions (which only
+ever hold the current build's items), are never evicted. Only files that can
+be fetched again, because they are in the store or are icons, are evicted;
+files placed in the cache by hand, such as org package sources in additions,
+are always kept. Once the cache is over the limit, the other files are
+evicted, least recently used first, until it fits again. Files that were
+unlinked from downloads when the manifest or catalog changed stay in the
+store until then, so switching back doesn't download them again.
+
+Run on its own, this reports the cache usage, and what would be evicted at
+a given limit.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Default size limit of the cache, in GB
+LIMIT_GB = 100
+# Records when each file was last used, in the cache directory
+USAGE_NAME = 'usage.json'
+# Directories that count towards the limit
+DIRS = ['store', 'downloads', 'exceptions', 'additions', 'icons']
+# Directories whose contents are always in use by the current build
+PINNED = ['downloads', 'exceptions']
+# Directories of files a build can fetch again; nothing else is evicted
+REFETCHABLE = ['store', 'icons']
+
+
+def gigabytes(size):
+  """Return a size in bytes as GB, for printing."""
+  return size / 1073741824.0
+
+
+def cache_files(cache, dirs=None):
+  """Return the files of the cache, grouped by the file they link to.
+
+  Returns a dict of (device, inode) to a dict with the file 'size' and the
+  'paths' that link to it, relative to cache.
+  """
+  files = {}
+  for name in dirs or DIRS:
+    top = os.path.join(cache, name)
+    for (root, dummy_dirs, names) in os.walk(top):
+      for filename in names:
+        path = os.path.join(root, filename)
+        try:
+          info = os.lstat(path)
+        except OSError:
+          continue
+        if not os.path.isfile(path) or os.path.islink(path):
+          continue
+        entry = files.setdefault(
+          (info.st_dev, info.st_ino), {'size': info.st_size, 'paths': []})
+        entry['paths'].append(os.path.relpath(path, cache))
+  return files
+
+
+def load_usage(path):
+  """Return the saved dict of relative path to when it was last used."""
+  if not os.path.isfile(path):
+    return {}
+  try:
+    with open(path, 'rb') as f:
+      return json.load(f)
+  except (IOError, ValueError) as err:
+    print >> sys.stderr, "Ignoring unreadable cache usage: %s" % err
+    return {}
+
+
+def save_usage(path, usage):
+  """Atomically write the usage dict."""
+  (handle, temp_path) = tempfile.mkstemp(
+    dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+  with os.fdopen(handle, 'wb') as f:
+    json.dump(usage, f, indent=2, sort_keys=True)
+  os.rename(temp_path, path)
+
+
+def in_use(paths, used):
+  """Return True if any of paths is pinned or used by this build."""
+  for path in paths:
+    if path.split(os.sep, 1)[0] in PINNED or path in used:
+      return True
+  return False
+
+
+def refetchable(paths):
+  """Return True if a build could fetch the file again once evicted."""
+  for path in paths:
+    if path.split(os.sep, 1)[0] in REFETCHABLE:
+      return True
+  return False
+
+
+def evict(cache, limit, used=None, dry_run=False, now=None):
+  """Record this build's usage, and evict until the cache fits in limit.
+
+  used is a list of paths (absolute, or relative to cache) the build used
+  outside of downloads and exceptions, such as additions and icons. A
+  limit of 0 or None keeps everything. Returns a report dict.
+  """
+  now = now or time.time()
+  used = set(
+    os.path.relpath(path, cache) if os.path.isabs(path) else path
+    for path in used or []
+  )
+  usage_path = os.path.join(cache, USAGE_NAME)
+  usage = load_usage(usage_path)
+  files = cache_files(cache)
+  total = sum(entry['size'] for entry in files.values())
+  candidates = []
+  for entry in files.values():
+    if in_use(entry['paths'], used):
+      for path in entry['paths']:
+        usage[path] = now
+    elif refetchable(entry['paths']):
+      entry['last_used'] = max(
+        [usage.get(path, 0) for path in entry['paths']])
+      candidates.append(entry)
+  # Least recently used first; of those, the largest
+  candidates.sort(key=lambda entry: (entry['last_used'], -entry['size']))
+  report = {
+    'limit': limit,
+    'before': total,
+    'evicted': [],
+    'reclaimed': 0,
+    'dry_run': dry_run,
+  }
+  for entry in candidates:
+    if not limit or total <= limit:
+      break
+    if not dry_run:
+      for path in entry['paths']:
+        try:
+          os.remove(os.path.join(cache, path))
+        except OSError as err:
+          print >> sys.stderr, "Could not evict %s: %s" % (path, err)
+        usage.pop(path, None)
+    total -= entry['size']
+    report['reclaimed'] += entry['size']
+    report['evicted'].append({
+      'paths': entry['paths'],
+      'size': entry['size'],
+      'last_used': entry['last_used'] or None,
+    })
+  report['after'] = total
+  if not dry_run:
+    # Forget files that are gone
+    known = set(path for entry in files.values() for path in entry['paths'])
+    usage = dict(
+      (path, when) for path, when in usage.iteritems() if path in known)
+    save_usage(usage_path, usage)
+  return report
+
+
+def report_lines(report):
+  """Return an eviction report as a list of printable lines."""
+  action = 'Would evict' if report['dry_run'] else 'Evicted'
+  lines = []
+  for entry in report['evicted']:
+    last_used = 'never recorded'
+    if entry['last_used']:
+      last_used = time.strftime(
+        '%Y-%m-%d', time.localtime(entry['last_used']))
+    lines.append("%s %s (%.1f MB, last used %s)" % (
+      action, ', '.join(entry['paths']), entry['size'] / 1048576.0,
+      last_used))
+  limit = 'no limit'
+  if report['limit']:
+    limit = 'limit %.1f GB' % gigabytes(report['limit'])
+  lines.append("Cache: %.2f GB -> %.2f GB (%s), %d files %s, %.2f GB "
+               "reclaimed." % (
+                 gigabytes(report['before']), gigabytes(report['after']),
+                 limit, len(report['evicted']),
+                 'to evict' if report['dry_run'] else 'evicted',
+                 gigabytes(report['reclaimed'])))
+  return lines
+
+
+def main():
+  """Report the cache usage, and optionally evict down to a limit."""
+  parser = argparse.ArgumentParser(
+    description='Evict least recently used files from the AutoDMG cache.')
+  parser.add_argument(
+    'cache', nargs='?', default='/Library/AutoDMG',
+    help='Path to the cache. Defaults to /Library/AutoDMG.')
+  parser.add_argument(
+    '--limit', type=float, default=LIMIT_GB,
+    help='Size limit in GB, 0 for none. Defaults to %d.' % LIMIT_GB)
+  parser.add_argument(
+    '-n', '--dry-run', action='store_true', default=False,
+    help='Only report what would be evicted.')
+  args = parser.parse_args()
+  report = evict(
+    args.cache, int(args.limit * 1073741824), dry_run=args.dry_run)
+  for line in report_lines(report):
+    print line
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+"""In-memory index of Munki catalogs and manifests for AutoDMG builds.
+
+Asking munkilib for each item separately walks the catalogs and included
+manifests again for every item. Instead, every pkginfo of the catalogs is
+indexed once by name, highest version first, and the manifest closure (the
+manifest, its included manifests and the conditional items that apply) is
+walked once. managed_installs, managed_updates, managed_uninstalls and
+optional_installs are then all resolved from the index in a single pass,
+including the items managed installs require and the updates for them.
+
+munkilib is only needed to fetch manifests and evaluate conditions; those
+are passed in, so the index itself is plain Python.
+"""
+
+import os
+import platform
+from distutils.version import LooseVersion
+
+try:
+  import FoundationPlist as plistlib
+except ImportError:
+  import plistlib
+
+# Manifest keys resolved from the closure, in the order munki processes them
+MANIFEST_KEYS = [
+  'managed_installs',
+  'managed_updates',
+  'managed_uninstalls',
+  'optional_installs',
+]
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class CatalogError(Error):
+  """Catalog and manifest index exceptions."""
+
+
+def split_name_version(name):
+  """Split a manifest item like 'Firefox-45.0' into name and version.
+
+  Returns (name, '') if no version is given.
+  """
+  for delimiter in ('--', '-'):
+    if delimiter in name:
+      (base, version) = name.rsplit(delimiter, 1)
+      if version[:1].isdigit():
+        return (base, version)
+  return (name, '')
+
+
+def version_key(version):
+  """Return a sortable key for a pkginfo version."""
+  return LooseVersion(str(version or '0'))
+
+
+def host_filter(os_version=None, arch=None, condition=None):
+  """Return a function that tells if a pkginfo applies to this host.
+
+  Checks minimum_os_version, maximum_os_version, supported_architectures
+  and, if condition is given, installable_condition, the way munki does.
+  """
+  os_version = os_version or platform.mac_ver()[0] or '0'
+  arch = arch or os.uname()[4]
+
+  def applies(item):
+    """Return True if item can be installed on this host."""
+    if ('minimum_os_version' in item and
+        version_key(os_version) < version_key(item['minimum_os_version'])):
+      return False
+    if ('maximum_os_version' in item and
+        version_key(os_version) > version_key(item['maximum_os_version'])):
+      return False
+    supported = item.get('supported_architectures')
+    if supported and arch not in supported:
+      # 64-bit Intel Macs run i386 items too
+      if not (arch == 'x86_64' and 'i386' in supported):
+        return False
+    if (condition and 'installable_condition' in item and
+        not condition(item['installable_condition'])):
+      return False
+    return True
+
+  return applies
+
+
+class CatalogIndex(object):
+  """Pkginfos of one or more catalogs, indexed by name and version."""
+
+  def __init__(self, applies=None):
+    # catalog name -> item name -> pkginfos, highest version first
+    self.named = {}
+    # catalog name -> update_for entry -> pkginfos that update it
+    self.updates = {}
+    self.applies = applies or (lambda item: True)
+    self.pkginfo_count = 0
+
+  def add_catalog(self, catalog, items):
+    """Index the pkginfos of a catalog."""
+    named = {}
+    updates = {}
+    for item in items:
+      if not item.get('name'):
+        continue
+      named.setdefault(item['name'], []).append(item)
+      for other in item.get('update_for', []):
+        updates.setdefault(other, []).append(item)
+    for versions in named.values():
+      versions.sort(key=lambda item: version_key(item.get('version')),
+                    reverse=True)
+    self.named[catalog] = named
+    self.updates[catalog] = updates
+    self.pkginfo_count += len(items)
+
+  def load(self, catalog_dir, catalogs):
+    """Read and index catalog plists from catalog_dir."""
+    for catalog in catalogs:
+      if catalog in self.named:
+        continue
+      path = os.path.join(catalog_dir, catalog)
+      try:
+        items = plistlib.readPlist(path)
+      except Exception as err:  # pylint: disable=broad-except
+        raise CatalogError("Can't read catalog %s: %s" % (path, err))
+      self.add_catalog(catalog, items)
+
+  def find(self, name, catalogs):
+    """Return the pkginfo a manifest item resolves to, or None.
+
+    name may include a version, like 'Firefox-45.0'. Catalogs are searched
+    in order, and the highest applicable version of the first catalog that
+    has one wins.
+    """
+    (base, version) = split_name_version(name)
+    for catalog in catalogs:
+      for item in self.named.get(catalog, {}).get(base, []):
+        if version and str(item.get('version')) != version:
+          continue
+        if self.applies(item):
+          return item
+    return None
+
+  def updates_for(self, item, catalogs):
+    """Return the pkginfos of the updates for a pkginfo, one per name.
+
+    Updates are for the item's name, or for its name and exact version.
+    """
+    keys = [item['name']]
+    if item.get('version'):
+      keys.append('%s-%s' % (item['name'], item['version']))
+      keys.append('%s--%s' % (item['name'], item['version']))
+    found = []
+    seen = set()
+    for catalog in catalogs:
+      for key in keys:
+        for update in self.updates.get(catalog, {}).get(key, []):
+          if update['name'] in seen:
+            continue
+          latest = self.find(update['name'], catalogs)
+          if latest is not None:
+            seen.add(update['name'])
+            found.append(latest)
+    return found
+
+
+class ManifestIndex(object):
+  """Manifests, fetched and parsed once each.
+
+  fetch(name) returns the local path of a manifest, and condition(predicate)
+  tells if a conditional_items condition is true.
+  """
+
+  def __init__(self, fetch, condition=None):
+    self.fetch = fetch
+    self.condition = condition or (lambda predicate: False)
+    self.manifests = {}
+
+  def get(self, name):
+    """Return the parsed manifest, fetching it the first time."""
+    if name not in self.manifests:
+      path = self.fetch(name)
+      if not path:
+        raise CatalogError("Can't get manifest %s" % name)
+      self.manifests[name] = plistlib.readPlist(path)
+    return self.manifests[name]
+
+  def closure(self, name):
+    """Return the items of every key of a manifest and what it includes.
+
+    Returns a dict of manifest key to a list of item names, in the order
+    munki would process them, each name once.
+    """
+    found = dict((key, []) for key in MANIFEST_KEYS)
+    seen = dict((key, set()) for key in MANIFEST_KEYS)
+    visited = set()
+
+    def walk(manifest):
+      """Add the items of a manifest, included manifests first."""
+      for included in manifest.get('included_manifests') or []:
+        if included in visited:
+          continue
+        visited.add(included)
+        walk(self.get(included))
+      for conditional in manifest.get('conditional_items') or []:
+        if 'condition' in conditional and self.condition(
+            conditional['condition']):
+          walk(conditional)
+      for key in MANIFEST_KEYS:
+        for item in manifest.get(key) or []:
+          if item not in seen[key]:
+            seen[key].add(item)
+            found[key].append(item)
+
+    visited.add(name)
+    walk(self.get(name))
+    return found
+
+
+def resolve(closure, catalog_index, catalogs):
+  """Resolve the items of a manifest closure to pkginfos in one pass.
+
+  Returns a dict with the pkginfos of each manifest key, and 'missing', the
+  items that aren't in the catalogs. Managed installs also include what
+  they require (before them) and their updates (after them).
+  """
+  resolved = dict((key, []) for key in MANIFEST_KEYS)
+  resolved['missing'] = []
+  added = dict((key, set()) for key in MANIFEST_KEYS)
+
+  def add(key, item):
+    """Add a pkginfo to a key once."""
+    ident = (item['name'], str(item.get('version')))
+    if ident in added[key]:
+      return False
+    added[key].add(ident)
+    resolved[key].append(item)
+    return True
+
+  def missing(name):
+    """Record an item that isn't in the catalogs."""
+    if name not in resolved['missing']:
+      resolved['missing'].append(name)
+
+  def add_install(key, name, chain):
+    """Add an install with its requirements and updates."""
+    item = catalog_index.find(name, catalogs)
+    if item is None:
+      missing(name)
+      return
+    if item['name'] in chain:
+      # Requirement cycle; munki stops here too
+      return
+    ident = (item['name'], str(item.get('version')))
+    if ident in added[key]:
+      return
+    for required in item.get('requires') or []:
+      add_install(key, required, chain + [item['name']])
+    if add(key, item):
+      for update in catalog_index.updates_for(item, catalogs):
+        add_install(key, update['name'], chain + [item['name']])
+
+  for key in MANIFEST_KEYS:
+    for name in closure[key]:
+      if key in ('managed_installs', 'managed_updates'):
+        add_install(key, name, [])
+        continue
+      item = catalog_index.find(name, catalogs)
+      if item is None:
+        missing(name)
+      else:
+        add(key, item)
+  return resolved
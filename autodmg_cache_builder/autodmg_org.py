@@ -3,10 +3,8 @@
 
 import os
 import sys
-import tempfile
-import shutil
 
-from autodmg_utility import build_pkg, run, populate_ds_repo, pkgbuild
+from autodmg_utility import build_pkg, run, populate_ds_repo, build_marker_pkg
 sys.path.append('/Library/CPE/lib/flib/modules')
 try:
   import FoundationPlist as plistlib
@@ -85,55 +83,22 @@ def build_bare_dmg(source, cache, logpath, loglevel, repo_path):
 # local management functions
 def munki_bootstrap(cache_path):
   """Build a Munki bootstrap package."""
-  pkg_output_file = os.path.join(cache_path, 'munki_bootstrap.pkg')
-  if not os.path.isfile(pkg_output_file):
-    print "Building Munki bootstrap package..."
-    temp_dir = tempfile.mkdtemp(prefix='munkiboot', dir='/tmp')
-    shared = os.path.join(temp_dir, 'Users/Shared')
-    os.makedirs(shared)
-    open(os.path.join(
-      shared, '.com.googlecode.munki.checkandinstallatstartup'
-    ), 'a').close()
-    pkgbuild(
-      temp_dir,
-      'com.facebook.cpe.munki.bootstrap',
-      '1.0',
-      pkg_output_file
-    )
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    if os.path.isfile(pkg_output_file):
-      return pkg_output_file
-    # If we failed for some reason, return None
-    return None
-  # Package already exists
-  return pkg_output_file
+  return build_marker_pkg(
+    ['Users/Shared/.com.googlecode.munki.checkandinstallatstartup'],
+    'com.facebook.cpe.munki.bootstrap',
+    os.path.join(cache_path, 'munki_bootstrap.pkg'),
+    'Building Munki bootstrap package...'
+  )
 
 
 def suppress_registration(cache_path):
   """Build a package to suppress Setup Assistant, returns path to it."""
-  pkg_output_file = os.path.join(cache_path, 'suppress_registration.pkg')
-  if not os.path.isfile(pkg_output_file):
-    print "Building registration suppression package..."
-    temp_dir = tempfile.mkdtemp(prefix='suppressreg', dir='/tmp')
-    receipt = os.path.join(temp_dir, 'Library/Receipts')
-    os.makedirs(receipt)
-    open(os.path.join(receipt, '.SetupRegComplete'), 'a').close()
-    vardb = os.path.join(temp_dir, 'private/var/db/')
-    os.makedirs(vardb)
-    open(os.path.join(vardb, '.AppleSetupDone'), 'a').close()
-    pkgbuild(
-      temp_dir,
-      'com.facebook.cpe.suppress_registration',
-      '1.0',
-      pkg_output_file
-    )
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    if os.path.isfile(pkg_output_file):
-      return pkg_output_file
-    # If we failed for some reason, return None
-    return None
-  # Package already exists
-  return pkg_output_file
+  return build_marker_pkg(
+    ['Library/Receipts/.SetupRegComplete', 'private/var/db/.AppleSetupDone'],
+    'com.facebook.cpe.suppress_registration',
+    os.path.join(cache_path, 'suppress_registration.pkg'),
+    'Building registration suppression package...'
+  )
 
 
 def run_unique_code(args):
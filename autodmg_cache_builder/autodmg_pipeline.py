@@ -0,0 +1,262 @@
+#!/usr/bin/python
+"""Run the phases of an AutoDMG build as a graph of dependent stages.
+
+Each stage declares the stages it requires. A stage starts as soon as
+everything it requires has finished, so independent stages (downloading
+managed installs, extras and icons, building packages, running org code)
+run at the same time. A stage that fails stops only the stages that depend
+on it; the others still run.
+
+The output of every stage is stored in the context under the stage's name.
+Outputs of resumable stages are saved to a state file as they finish, so a
+failed build can be rerun from the stages that failed, reusing the rest.
+"""
+
+import json
+import os
+import Queue
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# Stages run at once
+JOBS = 4
+# Seconds between checks for finished stages. Waiting without a timeout
+# would keep Ctrl-C from interrupting the build.
+POLL = 1
+# Stage statuses
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+REUSED = 'reused'
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class PipelineError(Error):
+  """Pipeline exceptions."""
+
+
+class Stage(object):
+  """One phase of the build.
+
+  func is called with the context dict, and its return value is stored in
+  the context under name. Outputs of resumable stages must be JSON
+  serializable; stages that set up state in memory, such as loading the
+  catalogs, must not be resumable, so they always run. If given,
+  valid(output) is called before a saved output is reused, and the stage
+  runs again if it returns False, such as when a file it made is gone.
+  """
+
+  def __init__(self, name, func, requires=(), resumable=True, valid=None):
+    self.name = name
+    self.func = func
+    self.requires = list(requires)
+    self.resumable = resumable
+    self.valid = valid
+
+  def reusable(self, saved):
+    """Return True if the saved output of this stage can be reused."""
+    if not self.resumable or self.name not in saved:
+      return False
+    return self.valid is None or bool(self.valid(saved[self.name]))
+
+
+class Pipeline(object):
+  """A set of stages, run in dependency order, jobs at a time."""
+
+  def __init__(self, stages, jobs=JOBS, state_path=None, key=None):
+    self.stages = list(stages)
+    self.by_name = dict((stage.name, stage) for stage in self.stages)
+    self.jobs = max(1, jobs)
+    self.state_path = state_path
+    # Identifies the build the state belongs to, such as its arguments
+    self.key = key
+    self.report = []
+    self.wall_time = 0
+    self._lock = threading.Lock()
+    self._state = {'key': key, 'outputs': {}}
+    self.check()
+
+  def check(self):
+    """Raise PipelineError for unknown requirements or cycles."""
+    if len(self.by_name) != len(self.stages):
+      raise PipelineError("Stage names must be unique")
+    for stage in self.stages:
+      for required in stage.requires:
+        if required not in self.by_name:
+          raise PipelineError(
+            "%s requires unknown stage %s" % (stage.name, required))
+    visiting = set()
+    visited = set()
+
+    def visit(name, path):
+      """Depth-first search for a cycle through name."""
+      if name in visited:
+        return
+      if name in visiting:
+        raise PipelineError(
+          "Stage cycle: %s" % ' -> '.join(path + [name]))
+      visiting.add(name)
+      for required in self.by_name[name].requires:
+        visit(required, path + [name])
+      visiting.remove(name)
+      visited.add(name)
+
+    for stage in self.stages:
+      visit(stage.name, [])
+
+  def load_state(self):
+    """Return the saved outputs of the last build, if it was the same."""
+    if not self.state_path or not os.path.isfile(self.state_path):
+      return {}
+    try:
+      with open(self.state_path, 'rb') as f:
+        state = json.load(f)
+    except (IOError, ValueError) as err:
+      print >> sys.stderr, "Ignoring unreadable pipeline state: %s" % err
+      return {}
+    if state.get('key') != self.key:
+      print "Pipeline state is from a different build, running every stage."
+      return {}
+    return state.get('outputs', {})
+
+  def clear_state(self):
+    """Remove the saved state, after a build that finished."""
+    if self.state_path and os.path.isfile(self.state_path):
+      os.remove(self.state_path)
+
+  def save_state(self):
+    """Atomically write the outputs of the finished resumable stages."""
+    if not self.state_path:
+      return
+    with self._lock:
+      data = json.dumps(self._state, indent=2, sort_keys=True)
+    (handle, temp_path) = tempfile.mkstemp(
+      dir=os.path.dirname(self.state_path),
+      prefix='.' + os.path.basename(self.state_path))
+    with os.fdopen(handle, 'wb') as f:
+      f.write(data)
+    os.rename(temp_path, self.state_path)
+
+  def _record(self, name, status, started, duration, error=None):
+    """Add a stage to the timing report."""
+    with self._lock:
+      self.report.append({
+        'stage': name,
+        'status': status,
+        'start': started,
+        'duration': duration,
+        'error': error,
+      })
+
+  def _run_stage(self, stage, context, done):
+    """Run one stage in a worker thread, then put it on the done queue."""
+    started = time.time()
+    try:
+      output = stage.func(context)
+    except BaseException as err:  # pylint: disable=broad-except
+      # Includes SystemExit, so a stage calling sys.exit can't hang the run
+      traceback.print_exc()
+      done.put((stage.name, FAILED, None, started, str(err) or repr(err)))
+      return
+    done.put((stage.name, OK, output, started, None))
+
+  def run(self, context, resume=False):
+    """Run every stage, storing their outputs in context.
+
+    With resume, resumable stages that finished in the last build of the
+    same key are not run again; their saved outputs are used. Raises
+    PipelineError once no more stages can run, if any failed.
+    """
+    saved = self.load_state() if resume else {}
+    self.report = []
+    begin = time.time()
+    status = {}
+    pending = [stage.name for stage in self.stages]
+    running = set()
+    done = Queue.Queue()
+    while pending or running:
+      waiting = len(pending)
+      for name in list(pending):
+        stage = self.by_name[name]
+        required = [status.get(other) for other in stage.requires]
+        if any(state in (FAILED, SKIPPED) for state in required):
+          pending.remove(name)
+          status[name] = SKIPPED
+          self._record(name, SKIPPED, None, 0)
+          print "Skipping %s, a stage it requires failed." % name
+          continue
+        if any(state is None for state in required):
+          continue
+        if stage.reusable(saved):
+          pending.remove(name)
+          status[name] = REUSED
+          context[name] = saved[name]
+          with self._lock:
+            self._state['outputs'][name] = saved[name]
+          self._record(name, REUSED, None, 0)
+          print "Reusing %s from the last build." % name
+          continue
+        if len(running) >= self.jobs:
+          continue
+        pending.remove(name)
+        running.add(name)
+        print "Starting stage %s." % name
+        worker = threading.Thread(
+          target=self._run_stage, args=(stage, context, done),
+          name='stage-%s' % name)
+        worker.daemon = True
+        worker.start()
+      if not running:
+        if len(pending) == waiting:
+          raise PipelineError("No stage can run: %s" % ', '.join(pending))
+        continue
+      try:
+        (name, result, output, started, error) = done.get(timeout=POLL)
+      except Queue.Empty:
+        continue
+      running.remove(name)
+      duration = time.time() - started
+      status[name] = result
+      self._record(name, result, started - begin, duration, error)
+      if result == OK:
+        context[name] = output
+        print "Finished stage %s in %.1fs." % (name, duration)
+        if self.by_name[name].resumable:
+          with self._lock:
+            self._state['outputs'][name] = output
+          self.save_state()
+      else:
+        print >> sys.stderr, "Stage %s failed after %.1fs: %s" % (
+          name, duration, error)
+    self.wall_time = time.time() - begin
+    self.save_state()
+    failed = [
+      entry['stage'] for entry in self.report if entry['status'] == FAILED
+    ]
+    if failed:
+      raise PipelineError("Stages failed: %s" % ', '.join(failed))
+    return context
+
+  def report_lines(self):
+    """Return the timing report of the last run as printable lines."""
+    lines = ["%-20s %-8s %9s %9s" % ('stage', 'status', 'start', 'time')]
+    order = [stage.name for stage in self.stages]
+    for entry in sorted(
+        self.report, key=lambda entry: order.index(entry['stage'])):
+      if entry['start'] is None:
+        lines.append("%-20s %-8s %9s %9s" % (
+          entry['stage'], entry['status'], '-', '-'))
+      else:
+        lines.append("%-20s %-8s %8.1fs %8.1fs" % (
+          entry['stage'], entry['status'], entry['start'],
+          entry['duration']))
+    busy = sum(entry['duration'] for entry in self.report)
+    lines.append("Wall time %.1fs for %.1fs of stages." % (
+      self.wall_time, busy))
+    return lines
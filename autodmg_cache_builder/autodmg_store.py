@@ -0,0 +1,200 @@
+#!/usr/bin/python
+"""Content-addressed store for the files cached by AutoDMG builds.
+
+Files are kept once, under their SHA-256 digest (the same hash Munki records
+as installer_item_hash), at <store>/<aa>/<digest>. The downloads, exceptions
+and additions directories hold hard links to them, so a payload used in
+several of them takes up space once, and an item whose hash is already
+stored never needs to be downloaded again.
+
+Run on its own, this re-hashes everything in a store in parallel, reporting
+(and optionally removing) objects that don't match their digest.
+"""
+
+import argparse
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+READ_SIZE = 1024 * 1024
+# Objects hashed at once by verify
+JOBS = 4
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class StoreError(Error):
+  """Content store exceptions."""
+
+
+def hash_file(path):
+  """Return the SHA-256 hex digest of a file, read in chunks."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(READ_SIZE)
+      if not data:
+        break
+      digest.update(data)
+  return digest.hexdigest()
+
+
+def object_path(store, digest):
+  """Return the path of an object in the store."""
+  return os.path.join(store, digest[:2], digest)
+
+
+def same_file(path, other):
+  """Return True if both paths are links to the same file."""
+  try:
+    return os.path.samefile(path, other)
+  except OSError:
+    return False
+
+
+def link(source, target):
+  """Atomically replace target with a hard link to source.
+
+  Falls back to copying if they are on different devices.
+  """
+  target_dir = os.path.dirname(target)
+  (handle, temp_path) = tempfile.mkstemp(
+    dir=target_dir, prefix='.' + os.path.basename(target))
+  os.close(handle)
+  os.remove(temp_path)
+  try:
+    os.link(source, temp_path)
+  except OSError as err:
+    if err.errno != errno.EXDEV:
+      raise
+    shutil.copyfile(source, temp_path)
+  try:
+    os.rename(temp_path, target)
+  except OSError:
+    os.remove(temp_path)
+    raise
+
+
+def has(store, digest):
+  """Return True if an object is in the store."""
+  return bool(digest) and os.path.isfile(object_path(store, digest))
+
+
+def link_from_store(store, digest, target):
+  """Link a stored object to target. Returns False if it isn't stored."""
+  if not has(store, digest):
+    return False
+  source = object_path(store, digest)
+  if not same_file(source, target):
+    link(source, target)
+  return True
+
+
+def add(store, path, expected_digest=None):
+  """Add a file to the store, and link it back to the stored object.
+
+  If expected_digest is given, the file must match it. Returns the digest.
+  """
+  digest = hash_file(path)
+  if expected_digest and digest != expected_digest.lower():
+    raise StoreError(
+      "%s has hash %s, expected %s" % (path, digest, expected_digest))
+  source = object_path(store, digest)
+  if os.path.isfile(source):
+    # Already stored, share the stored copy
+    if not same_file(source, path):
+      link(source, path)
+    return digest
+  if not os.path.isdir(os.path.dirname(source)):
+    try:
+      os.makedirs(os.path.dirname(source))
+    except OSError:
+      # Another worker may have created it first
+      if not os.path.isdir(os.path.dirname(source)):
+        raise
+  link(path, source)
+  return digest
+
+
+def objects(store):
+  """Return the (digest, path) of every object in the store."""
+  found = []
+  if not os.path.isdir(store):
+    return found
+  for prefix in sorted(os.listdir(store)):
+    prefix_dir = os.path.join(store, prefix)
+    if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+      continue
+    for name in sorted(os.listdir(prefix_dir)):
+      if name.startswith(prefix) and not name.startswith('.'):
+        found.append((name, os.path.join(prefix_dir, name)))
+  return found
+
+
+def _verify_object(entry):
+  """Hash one object. Run by the worker pool."""
+  (digest, path) = entry
+  try:
+    return (digest, path, hash_file(path) == digest, None)
+  except (IOError, OSError) as err:
+    return (digest, path, False, str(err))
+
+
+def verify(store, jobs=JOBS, remove=False):
+  """Re-hash every object in the store, jobs at a time.
+
+  Returns the list of (digest, path, error) of objects that didn't match.
+  With remove, those objects are deleted, so they are downloaded again.
+  """
+  entries = objects(store)
+  if not entries:
+    return []
+  pool = ThreadPool(max(1, min(jobs, len(entries))))
+  try:
+    results = pool.map(_verify_object, entries, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  bad = []
+  for (digest, path, valid, error) in results:
+    if valid:
+      continue
+    bad.append((digest, path, error))
+    if remove and os.path.exists(path):
+      os.remove(path)
+  return bad
+
+
+def main():
+  """Verify a content store."""
+  parser = argparse.ArgumentParser(
+    description='Verify the AutoDMG content store.')
+  parser.add_argument(
+    'store', nargs='?', default='/Library/AutoDMG/store',
+    help='Path to the store. Defaults to /Library/AutoDMG/store.')
+  parser.add_argument(
+    '-j', '--jobs', type=int, default=JOBS,
+    help='Number of objects to hash at once. Defaults to %d.' % JOBS)
+  parser.add_argument(
+    '--remove', action='store_true', default=False,
+    help='Remove objects that fail verification.')
+  args = parser.parse_args()
+  total = len(objects(args.store))
+  bad = verify(args.store, args.jobs, args.remove)
+  for (digest, path, error) in bad:
+    print >> sys.stderr, "Bad object %s: %s" % (
+      path, error or 'content does not match %s' % digest)
+  print "Verified %d objects, %d bad%s." % (
+    total, len(bad), ' (removed)' if bad and args.remove else '')
+  if bad:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,24 +1,47 @@
 #!/usr/bin/python
 """Utility functions used by other parts of the AutoDMG build tools."""
 
-import subprocess
+import errno
+import hashlib
+import json
 import os
+import sys
 import tempfile
+import time
 import shutil
 
+# Append the shared CPE modules to the Python path
+sys.path.append('/Library/CPE/lib/flib/modules')
+try:
+  import process_tools
+except ImportError:
+  print "Can't find process_tools!"
+  sys.exit(1)
+
+# How build_pkg stages package payloads: 'link' hard links files into the
+# payload, 'clone' makes copy-on-write clones (APFS), 'copy' copies them.
+# Linking and cloning fall back to copying when they aren't possible.
+STAGING = 'link'
+# Suffix of the file recording the inputs a package was built from
+FINGERPRINT_SUFFIX = '.fingerprint'
+# Bytes copied at a time when an image is delivered to another volume
+COPY_CHUNK = 8 * 1024 * 1024
+# Every package build_pkg and build_marker_pkg were asked for, in order,
+# with how long it took, for the build report
+PKG_BUILDS = []
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class DeliveryError(Error):
+  """Image delivery exceptions."""
+
 
 def run(cmd):
   """Run a command with subprocess, printing output in realtime."""
-  proc = subprocess.Popen(
-    cmd,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.STDOUT
-  )
-  while proc.poll() is None:
-    l = proc.stdout.readline()
-    print l,
-  print proc.stdout.read()
-  return proc.returncode
+  return process_tools.run_live(cmd)
 
 
 def pkgbuild(root_dir, identifier, version, pkg_output_file):
@@ -32,19 +55,174 @@ def pkgbuild(root_dir, identifier, version, pkg_output_file):
   run(cmd)
 
 
+def stage_file(source, target, mode):
+  """Put one file in place, returning how it was done.
+
+  Returns 'linked', 'cloned' or 'copied'.
+  """
+  if mode == 'link':
+    try:
+      os.link(source, target)
+      return 'linked'
+    except OSError as err:
+      # Other devices, too many links, or links not allowed here
+      if err.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+        raise
+  elif mode == 'clone':
+    results = process_tools.run(['/bin/cp', '-c', '-p', source, target])
+    if results['success']:
+      return 'cloned'
+  shutil.copy2(source, target)
+  return 'copied'
+
+
+def stage_tree(source, target, mode=None):
+  """Recreate the source directory at target, without copying if possible.
+
+  Like shutil.copytree, symlinks are followed. Returns a dict of the number
+  of files and of the bytes linked, cloned and copied.
+  """
+  mode = mode or STAGING
+  stats = {'files': 0, 'linked': 0, 'cloned': 0, 'copied': 0}
+  dirs = []
+  for root, dummy_dirs, files in os.walk(source, followlinks=True):
+    target_root = os.path.normpath(
+      os.path.join(target, os.path.relpath(root, source)))
+    if not os.path.isdir(target_root):
+      os.makedirs(target_root)
+    dirs.append((root, target_root))
+    for name in files:
+      # Link the file itself, not a symlink to it
+      source_file = os.path.realpath(os.path.join(root, name))
+      how = stage_file(source_file, os.path.join(target_root, name), mode)
+      stats['files'] += 1
+      stats[how] += os.path.getsize(source_file)
+  # Set directory times last, since adding files changes them
+  for (source_dir, target_dir) in reversed(dirs):
+    shutil.copystat(source_dir, target_dir)
+  return stats
+
+
+def staging_dir(source, cache_dir, prefix):
+  """Make a temp dir to stage a payload in, on the source's device if we can.
+
+  Hard links only work within a device, so the cache dir is used when the
+  source is on the same device as it.
+  """
+  parent = '/tmp'
+  try:
+    if os.stat(source).st_dev == os.stat(cache_dir).st_dev:
+      parent = cache_dir
+  except OSError:
+    pass
+  return tempfile.mkdtemp(prefix=prefix, dir=parent)
+
+
+# Incremental builds
+def tree_listing(source):
+  """Return the path, size and mtime of every file under source."""
+  listing = []
+  for root, dummy_dirs, files in os.walk(source, followlinks=True):
+    for name in files:
+      path = os.path.join(root, name)
+      info = os.stat(path)
+      listing.append(
+        (os.path.relpath(path, source), info.st_size, int(info.st_mtime)))
+  return sorted(listing)
+
+
+def fingerprint(inputs):
+  """Return a digest of everything a package is built from."""
+  return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def fingerprint_path(pkg_output_file):
+  """Return the path the fingerprint of a package is kept at."""
+  return pkg_output_file + FINGERPRINT_SUFFIX
+
+
+def is_up_to_date(pkg_output_file, digest):
+  """Return True if the package exists and was built from the same inputs."""
+  if not os.path.isfile(pkg_output_file):
+    return False
+  try:
+    with open(fingerprint_path(pkg_output_file), 'rb') as f:
+      return f.read().strip() == digest
+  except IOError:
+    return False
+
+
+def save_fingerprint(pkg_output_file, digest):
+  """Record the inputs a package was built from."""
+  path = fingerprint_path(pkg_output_file)
+  with open(path + '.tmp', 'wb') as f:
+    f.write(digest + '\n')
+  os.rename(path + '.tmp', path)
+
+
+def forget_fingerprint(pkg_output_file):
+  """Remove a package and its fingerprint before it is rebuilt."""
+  for path in (fingerprint_path(pkg_output_file), pkg_output_file):
+    if os.path.exists(path):
+      os.remove(path)
+
+
+def record_pkg_build(pkg_output_file, start, status):
+  """Add a package to PKG_BUILDS.
+
+  status is 'built', 'up to date' or 'failed'.
+  """
+  PKG_BUILDS.append({
+    'pkg': pkg_output_file,
+    'status': status,
+    'seconds': time.time() - start,
+  })
+
+
+def pkg_fingerprint(source, receipt, destination):
+  """Return the fingerprint build_pkg records for a package."""
+  return fingerprint({
+    'files': tree_listing(source),
+    'receipt': receipt,
+    'destination': destination,
+    'version': '1.0',
+  })
+
+
+def pkg_up_to_date(source, output, receipt, destination, cache_dir):
+  """Return True if build_pkg would find the package up to date."""
+  if not (os.path.isdir(source) and os.listdir(source)):
+    return False
+  return is_up_to_date(os.path.join(cache_dir, '%s.pkg' % output),
+                       pkg_fingerprint(source, receipt, destination))
+
+
 def build_pkg(source, output, receipt, destination, cache_dir, comment=''):
-  """Construct package using pkgbuild."""
+  """Construct package using pkgbuild.
+
+  The package isn't rebuilt if the files in source, the receipt and the
+  destination are the same as when it was last built.
+  """
   if os.path.isdir(source) and os.listdir(source):
-    print comment
+    start = time.time()
     pkg_name = '%s.pkg' % output
-    # We must copy the contents into a temp folder and build
+    output_file = os.path.join(cache_dir, pkg_name)
+    digest = pkg_fingerprint(source, receipt, destination)
+    if is_up_to_date(output_file, digest):
+      print "%s is up to date." % pkg_name
+      record_pkg_build(output_file, start, 'up to date')
+      return output_file
+    print comment
+    forget_fingerprint(output_file)
+    # We must stage the contents in a temp folder and build
     prefix = 'cpe_%s' % receipt.split('.')[-1]
-    temp_dir = tempfile.mkdtemp(prefix=prefix, dir='/tmp')
+    temp_dir = staging_dir(source, cache_dir, '.' + prefix)
     pkg_dir = os.path.join(temp_dir, destination.lstrip('/'))
-    # Copy the contents of the folder into place
-    shutil.copytree(source, pkg_dir)
+    # Put the contents of the folder into place
+    stats = stage_tree(source, pkg_dir)
+    print "Staged %d files: %d bytes linked, %d cloned, %d copied." % (
+      stats['files'], stats['linked'], stats['cloned'], stats['copied'])
     # Build the package
-    output_file = os.path.join(cache_dir, pkg_name)
     pkgbuild(
       temp_dir,
       receipt,
@@ -55,13 +233,167 @@ def build_pkg(source, output, receipt, destination, cache_dir, comment=''):
     shutil.rmtree(temp_dir, ignore_errors=True)
     # Return the path to the package
     if os.path.isfile(output_file):
+      save_fingerprint(output_file, digest)
+      record_pkg_build(output_file, start, 'built')
       return output_file
+    record_pkg_build(output_file, start, 'failed')
   # If nothing was built, return empty string
   return ''
 
 
+def build_marker_pkg(marker_files, identifier, pkg_output_file, comment=''):
+  """Build a package that installs empty marker files.
+
+  marker_files are paths relative to the root of the target volume. The
+  package isn't rebuilt if it was last built with the same files and
+  identifier. Returns the path to the package, or None if it failed.
+  """
+  start = time.time()
+  digest = fingerprint({
+    'markers': sorted(marker_files),
+    'identifier': identifier,
+    'version': '1.0',
+  })
+  if is_up_to_date(pkg_output_file, digest):
+    print "%s is up to date." % os.path.basename(pkg_output_file)
+    record_pkg_build(pkg_output_file, start, 'up to date')
+    return pkg_output_file
+  print comment
+  forget_fingerprint(pkg_output_file)
+  temp_dir = tempfile.mkdtemp(prefix='cpe_markers', dir='/tmp')
+  for marker in marker_files:
+    marker_path = os.path.join(temp_dir, marker.lstrip('/'))
+    if not os.path.isdir(os.path.dirname(marker_path)):
+      os.makedirs(os.path.dirname(marker_path))
+    open(marker_path, 'a').close()
+  pkgbuild(
+    temp_dir,
+    identifier,
+    '1.0',
+    pkg_output_file
+  )
+  shutil.rmtree(temp_dir, ignore_errors=True)
+  if os.path.isfile(pkg_output_file):
+    save_fingerprint(pkg_output_file, digest)
+    record_pkg_build(pkg_output_file, start, 'built')
+    return pkg_output_file
+  record_pkg_build(pkg_output_file, start, 'failed')
+  # If we failed for some reason, return None
+  return None
+
+
+def hash_file(path):
+  """Return the SHA-256 hex digest of a file."""
+  digest = hashlib.sha256()
+  buf = bytearray(COPY_CHUNK)
+  view = memoryview(buf)
+  with open(path, 'rb') as f:
+    while True:
+      count = f.readinto(buf)
+      if not count:
+        break
+      digest.update(view[:count])
+  return digest.hexdigest()
+
+
+def copy_with_hash(source, target):
+  """Copy source to target in one pass, hashing the data as it goes.
+
+  The target is fsynced before returning the SHA-256 hex digest.
+  """
+  digest = hashlib.sha256()
+  buf = bytearray(COPY_CHUNK)
+  view = memoryview(buf)
+  with open(source, 'rb') as src, open(target, 'wb') as dst:
+    while True:
+      count = src.readinto(buf)
+      if not count:
+        break
+      digest.update(view[:count])
+      dst.write(view[:count])
+    dst.flush()
+    os.fsync(dst.fileno())
+  return digest.hexdigest()
+
+
+def sync_dir(path):
+  """fsync a directory, so a rename in it is on disk."""
+  try:
+    handle = os.open(path, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(handle)
+  except OSError:
+    pass
+  finally:
+    os.close(handle)
+
+
+def deliver_image(image_path, target, old_target):
+  """Put a built image at target, keeping any previous one as old_target.
+
+  On the same volume the image is hard linked into place, which is instant
+  and leaves the image in the cache for any other delivery; main removes it
+  before the next build, so the link is never written through. Otherwise it
+  is copied to a temp file next to the target, hashing as it copies, then
+  fsynced and verified before it is renamed into place, so target is never
+  a partial image. Returns a dict describing the delivery.
+  """
+  target_dir = os.path.dirname(target)
+  size = os.path.getsize(image_path)
+  start = time.time()
+  (handle, temp_path) = tempfile.mkstemp(
+    dir=target_dir, prefix='.' + os.path.basename(target))
+  os.close(handle)
+  os.remove(temp_path)
+  try:
+    digest = None
+    try:
+      os.link(image_path, temp_path)
+      method = 'link'
+    except OSError as err:
+      if err.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP):
+        raise
+      method = 'copy'
+      digest = copy_with_hash(image_path, temp_path)
+      if os.path.getsize(temp_path) != size:
+        raise DeliveryError(
+          "Copy of %s is %d bytes, expected %d" % (
+            image_path, os.path.getsize(temp_path), size))
+      if hash_file(temp_path) != digest:
+        raise DeliveryError(
+          "Copy of %s does not match the image" % image_path)
+    if os.path.isfile(target):
+      # If the target already exists, name it "-OLD"
+      print "Renaming old image to %s" % old_target
+      os.rename(target, old_target)
+    os.rename(temp_path, target)
+  except (IOError, OSError) as err:
+    raise DeliveryError("Failed to deliver %s: %s" % (image_path, err))
+  finally:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+  sync_dir(target_dir)
+  seconds = time.time() - start
+  result = {
+    'source': image_path,
+    'target': target,
+    'method': method,
+    'bytes': size,
+    'seconds': seconds,
+    'sha256': digest,
+  }
+  if method == 'link':
+    print "Linked image into place in %.2fs." % seconds
+  else:
+    print "Copied and verified %.1f MB in %.1fs (%.1f MB/s)." % (
+      size / 1048576.0, seconds, size / 1048576.0 / max(seconds, 0.001))
+  return result
+
+
 def populate_ds_repo(image_path, repo):
-  """Move a built image into the DS repo."""
+  """Move a built image into the DS repo. Returns the delivery dict."""
   repo_hfs = os.path.join(repo, 'Masters', 'HFS')
   image_name = os.path.basename(image_path)
   if not image_path.endswith('.hfs.dmg') and image_path.endswith('.dmg'):
@@ -69,29 +401,19 @@ def populate_ds_repo(image_path, repo):
     print 'Renaming image to ".hfs.dmg" for DS support'
     image_name = image_name.split('.dmg')[0] + '.hfs.dmg'
   repo_target = os.path.join(repo_hfs, image_name)
-  if os.path.isfile(repo_target):
-    # If the target already exists, name it "-OLD"
-    newname = repo_target.split('.hfs.dmg')[0] + '-OLD.hfs.dmg'
-    print "Renaming old image to %s" % newname
-    os.rename(repo_target, newname)
-  # now copy the newly built image over
+  newname = repo_target.split('.hfs.dmg')[0] + '-OLD.hfs.dmg'
   print "Copying new image to DS Repo."
   print "Image path: %s" % image_path
   print "Repo target: %s" % repo_target
-  shutil.copyfile(image_path, repo_target)
+  return deliver_image(image_path, repo_target, newname)
 
 
 def move_file(image_path, target):
-  """Move a built image into a target directory."""
+  """Move a built image into a target directory. Returns the delivery dict."""
   image_name = os.path.basename(image_path)
   repo_target = os.path.join(target, image_name)
-  if os.path.isfile(repo_target):
-    # If the target already exists, name it "-OLD"
-    newname = repo_target.split('.dmg')[0] + '-OLD.dmg'
-    print "Renaming old image to %s" % newname
-    os.rename(repo_target, newname)
-  # now copy the newly built image over
+  newname = repo_target.split('.dmg')[0] + '-OLD.dmg'
   print "Copying new image to target."
   print "Image path: %s" % image_path
   print "Repo target: %s" % repo_target
-  shutil.copyfile(image_path, repo_target)
+  return deliver_image(image_path, repo_target, newname)
@@ -0,0 +1,411 @@
+#!/usr/bin/python
+"""Benchmark the overhead autopkg_tools adds around AutoPkg.
+
+A throwaway Munki repo is created in a git repo of the requested size, along
+with a fake autopkg command that prints canned output and writes report
+plists, importing or failing for the requested number of recipes. Each
+recipe is then put through handle_recipe, and the time spent outside of
+AutoPkg itself (branches, commits, logging, report parsing) is reported.
+
+With more than one job, the recipes are split between worker processes,
+each with its own clone of the scratch repo, the way sharded hosts split a
+runlist.
+
+No real recipes or Munki repo are used, and AutoPkg preferences are never
+read. Where Foundation or FoundationPlist can't be imported (e.g. on Linux),
+minimal stand-ins are used.
+"""
+
+import argparse
+import imp
+import json
+import os
+import plistlib
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import autopkg_history
+import autopkg_shard
+
+# The shared CPE modules, when run from a checkout of this repo
+MODULES_DIR = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+  'code', 'lib', 'modules'
+)
+GIT = '/usr/bin/git'
+RECIPE_FORMAT = 'Bench%05d.munki'
+
+FAKE_AUTOPKG = r'''#!%(python)s
+"""Fake autopkg: print canned output and write a report plist."""
+import json
+import os
+import plistlib
+import sys
+import time
+
+with open(%(config)r, 'rb') as f:
+  CONFIG = json.load(f)
+args = sys.argv[1:]
+recipe = args[2]
+report_path = args[args.index('--report-plist') + 1]
+name = recipe.split('.munki')[0]
+for line in range(CONFIG['lines']):
+  print 'Processing %%s... step %%d' %% (recipe, line)
+  sys.stdout.flush()
+if CONFIG['delay']:
+  time.sleep(CONFIG['delay'])
+version = '%%d.%%d' %% (time.time(), os.getpid())
+report = {'failures': [], 'summary_results': {}}
+if recipe in CONFIG['failures']:
+  report['failures'].append({
+    'recipe': recipe,
+    'message': 'Error in %%s: benchmark failure' %% recipe,
+  })
+elif recipe in CONFIG['imports']:
+  # The Munki repo is the working directory autopkg_tools runs us in
+  download = os.path.join(CONFIG['cache'], '%%s.dmg' %% name)
+  with open(download, 'wb') as f:
+    f.write('\0' * CONFIG['pkg_size'])
+  pkginfo_path = os.path.join('bench', '%%s-%%s.plist' %% (name, version))
+  pkg_path = os.path.join('bench', '%%s-%%s.dmg' %% (name, version))
+  for subdir in ('pkgsinfo', 'pkgs'):
+    if not os.path.isdir(os.path.join(subdir, 'bench')):
+      os.makedirs(os.path.join(subdir, 'bench'))
+  with open(os.path.join('pkgs', pkg_path), 'wb') as f:
+    f.write('\0' * CONFIG['pkg_size'])
+  plistlib.writePlist({
+    'name': name,
+    'version': version,
+    'catalogs': ['testing'],
+    'installer_item_location': pkg_path,
+  }, os.path.join('pkgsinfo', pkginfo_path))
+  report['summary_results'] = {
+    'url_downloader_summary_result': {
+      'data_rows': [{'download_path': download}],
+    },
+    'munki_importer_summary_result': {
+      'data_rows': [{
+        'name': name,
+        'version': version,
+        'catalogs': 'testing',
+        'pkginfo_path': pkginfo_path,
+        'pkg_repo_path': pkg_path,
+      }],
+    },
+  }
+plistlib.writePlist(report, report_path)
+'''
+
+
+def git(args, cwd, stdin=None):
+  """Run git for scratch repo setup, returning its output."""
+  proc = subprocess.Popen(
+    [GIT] + args, cwd=cwd, stdin=subprocess.PIPE,
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE
+  )
+  (stdout, stderr) = proc.communicate(stdin)
+  if proc.returncode != 0:
+    raise RuntimeError('git %s failed: %s' % (' '.join(args), stderr))
+  return stdout
+
+
+def init_repo(path, items, branches):
+  """Create a Munki git repo with items pkginfos and branches old branches."""
+  os.makedirs(path)
+  git(['init', '-q'], path)
+  git(['symbolic-ref', 'HEAD', 'refs/heads/master'], path)
+  for subdir in ('pkgsinfo', 'catalogs', 'icons', 'pkgs'):
+    os.makedirs(os.path.join(path, subdir))
+  with open(os.path.join(path, '.gitignore'), 'wb') as f:
+    f.write('pkgs/\n')
+  for index in range(items):
+    item_dir = os.path.join(path, 'pkgsinfo', 'apps%02d' % (index % 50))
+    if not os.path.isdir(item_dir):
+      os.makedirs(item_dir)
+    plistlib.writePlist(
+      {'name': 'Item%d' % index, 'version': '1.0', 'catalogs': ['testing']},
+      os.path.join(item_dir, 'Item%d-1.0.plist' % index)
+    )
+  plistlib.writePlist([], os.path.join(path, 'catalogs', 'all'))
+  git(['add', '-A'], path)
+  commit(path, 'Scratch Munki repo')
+  head = git(['rev-parse', 'HEAD'], path).strip()
+  git(['update-ref', '--stdin'], path, ''.join(
+    'create refs/heads/Old%05d-1.0 %s\n' % (index, head)
+    for index in range(branches)
+  ))
+
+
+def commit(path, message):
+  """Commit everything staged, with a scratch identity."""
+  git(['-c', 'user.name=AutoPkg Benchmark', '-c', 'user.email=bench@localhost',
+       'commit', '-q', '-m', message], path)
+
+
+def clone_repo(source, path):
+  """Clone the scratch repo for one worker."""
+  git(['clone', '-q', '--local', source, path], os.path.dirname(path))
+  git(['config', 'user.name', 'AutoPkg Benchmark'], path)
+  git(['config', 'user.email', 'bench@localhost'], path)
+  head = git(['rev-parse', 'HEAD'], path).strip()
+  # Bring the old branches along, as local branches
+  refs = git(['for-each-ref', '--format=%(refname:short)',
+              'refs/remotes/origin'], path).split()
+  git(['update-ref', '--stdin'], path, ''.join(
+    'create refs/heads/%s %s\n' % (ref[len('origin/'):], head)
+    for ref in refs if ref not in ('origin/HEAD', 'origin/master')
+  ))
+  os.makedirs(os.path.join(path, 'pkgs'))
+
+
+def write_fake_autopkg(scratch, config):
+  """Write the fake autopkg command and its config. Returns its path."""
+  config_path = os.path.join(scratch, 'fake_autopkg.json')
+  with open(config_path, 'wb') as f:
+    json.dump(config, f)
+  path = os.path.join(scratch, 'autopkg')
+  with open(path, 'wb') as f:
+    f.write(FAKE_AUTOPKG % {'python': sys.executable, 'config': config_path})
+  os.chmod(path, 0755)
+  return path
+
+
+# Stand-ins for the modules autopkg_tools needs
+def stand_in(name, **attrs):
+  """Register a module with the given attributes as name."""
+  module = imp.new_module(name)
+  module.__dict__.update(attrs)
+  sys.modules[name] = module
+  return module
+
+
+def load_tools(fake_autopkg):
+  """Import autopkg_tools against stand-in AutoPkg modules."""
+  try:
+    imp.find_module('Foundation')
+  except ImportError:
+    stand_in(
+      'Foundation',
+      NSDate=type('NSDate', (object,), {}),
+      CFPreferencesAppSynchronize=lambda *args: True,
+      CFPreferencesCopyAppValue=lambda *args: None,
+      CFPreferencesSetValue=lambda *args: None,
+      kCFPreferencesCurrentUser=None,
+      kCFPreferencesCurrentHost=None,
+    )
+  try:
+    imp.find_module('FoundationPlist')
+  except ImportError:
+    sys.modules['FoundationPlist'] = plistlib
+  # Never read the real AutoPkg preferences or recipes
+  prefs = {}
+  stand_in('autopkglib', PREFS=prefs, get_pref=prefs.get)
+  stand_in(
+    'autopkg',
+    get_override_dirs=lambda: [],
+    get_search_dirs=lambda: [],
+    # Every recipe is found, with no parents
+    load_recipe=lambda identifier, *args, **kwargs: {
+      'RECIPE_PATH': identifier, 'PARENT_RECIPES': []},
+  )
+  sys.path.append(MODULES_DIR)
+  import autopkg_tools
+  autopkg_tools.AUTOPKG = fake_autopkg
+  autopkg_tools.DEV = True
+  return autopkg_tools
+
+
+def run_worker(job):
+  """Run a list of recipes through handle_recipe in one repo clone."""
+  tools = sys.modules['autopkg_tools']
+  tools.autopkglib.PREFS.update({
+    'MUNKI_REPO': job['repo'],
+    'RECIPE_REPO_DIR': os.path.join(job['work'], 'RecipeRepos'),
+    'RECIPE_OVERRIDE_DIRS': [os.path.join(job['work'], 'RecipeOverrides')],
+  })
+  tools.REPO_DIR = job['repo']
+  tools.HISTORY_DB = os.path.join(job['work'], 'history.db')
+  tools.RUN_ID = job['run_id']
+  tools.VERBOSE = job['verbose']
+  tools.GIT_REPO = None
+  tools.RUN_SUMMARY = None
+  os.chdir(job['repo'])
+  # autopkg_tools logs to stdout; keep it out of the report
+  stdout = sys.stdout
+  sys.stdout = open(os.path.join(job['work'], 'autopkg_tools.log'), 'ab')
+  try:
+    if job['batch']:
+      tools.BATCH_BRANCH = tools.create_run_branch()
+    for recipe in job['recipes']:
+      tools.handle_recipe(recipe)
+    if job['batch']:
+      tools.finish_run_branch(tools.BATCH_BRANCH)
+    tools.run_summary().finish()
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+  conn = autopkg_history.connect(tools.HISTORY_DB)
+  try:
+    return [dict(row) for row in conn.execute('SELECT * FROM runs')]
+  finally:
+    conn.close()
+
+
+def percentile(values, fraction):
+  """Return the value at a fraction of the sorted values."""
+  if not values:
+    return 0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def report(jobs, wall, records):
+  """Print the timings of one benchmark run."""
+  durations = [record['duration'] for record in records]
+  overheads = [
+    record['duration'] - (record['autopkg_time'] or 0) for record in records
+  ]
+  print "jobs: %d, recipes: %d, wall: %.2fs, %.2f recipes/s" % (
+    jobs, len(records), wall, len(records) / wall if wall else 0)
+  print "  handle_recipe: mean %.3fs, p50 %.3fs, p95 %.3fs, max %.3fs" % (
+    sum(durations) / len(durations), percentile(durations, 0.5),
+    percentile(durations, 0.95), max(durations))
+  print "  overhead:      mean %.3fs, p50 %.3fs, p95 %.3fs" % (
+    sum(overheads) / len(overheads), percentile(overheads, 0.5),
+    percentile(overheads, 0.95))
+  for phase in ('branch_time', 'autopkg_time', 'commit_time'):
+    times = [record[phase] for record in records if record[phase] is not None]
+    if times:
+      print "  %-13s  mean %.3fs over %d recipes" % (
+        phase + ':', sum(times) / len(times), len(times))
+  outcomes = {}
+  for record in records:
+    outcomes.setdefault(record['outcome'], []).append(record['duration'])
+  for outcome in sorted(outcomes):
+    print "  %-13s  %d recipes, mean %.3fs" % (
+      outcome + ':', len(outcomes[outcome]),
+      sum(outcomes[outcome]) / len(outcomes[outcome]))
+
+
+def benchmark(args, jobs, scratch, source, fake_autopkg, recipes):
+  """Run all recipes with a number of jobs and return the run records."""
+  shards = autopkg_shard.assign_shards(recipes, jobs)
+  work = []
+  for index, shard in enumerate(shards, 1):
+    work_dir = os.path.join(scratch, 'jobs%d' % jobs, 'worker%d' % index)
+    os.makedirs(os.path.join(work_dir, 'RecipeRepos'))
+    repo = os.path.join(work_dir, 'munki')
+    clone_repo(source, repo)
+    work.append({
+      'repo': repo,
+      'work': work_dir,
+      'recipes': shard,
+      'run_id': 'bench-%d' % jobs,
+      'verbose': args.verbose,
+      'batch': args.batch,
+    })
+  start = time.time()
+  if jobs == 1:
+    results = [run_worker(work[0])]
+  else:
+    pool = Pool(jobs)
+    try:
+      results = pool.map(run_worker, work)
+    finally:
+      pool.close()
+      pool.join()
+  wall = time.time() - start
+  records = [record for result in results for record in result]
+  report(jobs, wall, records)
+  return records
+
+
+def main():
+  """Build the scratch environment and run the benchmark."""
+  parser = argparse.ArgumentParser(
+    description='Time autopkg_tools against a fake autopkg and scratch repo.')
+  parser.add_argument(
+    '-n', '--recipes', type=int, default=20,
+    help='Number of recipes to run. Defaults to 20.')
+  parser.add_argument(
+    '--imports', type=int, default=5,
+    help='Number of recipes that import something. Defaults to 5.')
+  parser.add_argument(
+    '--failures', type=int, default=2,
+    help='Number of recipes that fail. Defaults to 2.')
+  parser.add_argument(
+    '--repo-items', type=int, default=1000,
+    help='Number of pkginfo files in the scratch repo. Defaults to 1000.')
+  parser.add_argument(
+    '--branches', type=int, default=100,
+    help='Number of existing branches in the scratch repo. Defaults to 100.')
+  parser.add_argument(
+    '--lines', type=int, default=50,
+    help='Lines of output printed by each fake autopkg run. Defaults to 50.')
+  parser.add_argument(
+    '--delay', type=float, default=0,
+    help='Seconds each fake autopkg run sleeps for. Defaults to 0.')
+  parser.add_argument(
+    '--pkg-size', type=int, default=1024 * 1024,
+    help='Size in bytes of each imported package. Defaults to 1MB.')
+  parser.add_argument(
+    '-j', '--jobs', type=int, nargs='+', default=[1, 4],
+    help=('Number of parallel workers to benchmark with, one run for each '
+          'value. Defaults to 1 4.'))
+  parser.add_argument(
+    '--batch', action='store_true', default=False,
+    help='Benchmark batch mode, with one branch for the whole run.')
+  parser.add_argument(
+    '--seed', type=int, default=0,
+    help='Seed for picking which recipes import and fail.')
+  parser.add_argument(
+    '--json', help='Also write every run record to this JSON file.')
+  parser.add_argument(
+    '--keep', action='store_true', default=False,
+    help='Keep the scratch directory, including the autopkg_tools logs.')
+  parser.add_argument(
+    '-v', '--verbose', action='store_true', default=False,
+    help='Run autopkg_tools with verbose logging.')
+  args = parser.parse_args()
+  if args.imports + args.failures > args.recipes:
+    parser.error('--imports plus --failures is more than --recipes')
+  recipes = [RECIPE_FORMAT % index for index in range(args.recipes)]
+  picked = random.Random(args.seed).sample(
+    recipes, args.imports + args.failures)
+  scratch = os.path.realpath(tempfile.mkdtemp(prefix='autopkg_bench.'))
+  try:
+    os.makedirs(os.path.join(scratch, 'cache'))
+    fake_autopkg = write_fake_autopkg(scratch, {
+      'imports': picked[:args.imports],
+      'failures': picked[args.imports:],
+      'lines': args.lines,
+      'delay': args.delay,
+      'pkg_size': args.pkg_size,
+      'cache': os.path.join(scratch, 'cache'),
+    })
+    source = os.path.join(scratch, 'source')
+    print "Creating scratch repo with %d items and %d branches..." % (
+      args.repo_items, args.branches)
+    init_repo(source, args.repo_items, args.branches)
+    load_tools(fake_autopkg)
+    all_records = {}
+    for jobs in args.jobs:
+      all_records[jobs] = benchmark(
+        args, jobs, scratch, source, fake_autopkg, recipes)
+    if args.json:
+      with open(args.json, 'wb') as f:
+        json.dump(all_records, f, indent=2, sort_keys=True)
+  finally:
+    if args.keep:
+      print "Scratch directory kept at %s" % scratch
+    else:
+      shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+"""Record and query the history of autopkg_tools recipe runs."""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+DEFAULT_DB = '/Users/Shared/autopkg_history.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  run_id TEXT,
+  hostname TEXT,
+  recipe TEXT NOT NULL,
+  start REAL NOT NULL,
+  end REAL,
+  duration REAL,
+  branch_time REAL,
+  autopkg_time REAL,
+  commit_time REAL,
+  outcome TEXT,
+  version TEXT,
+  failures INTEGER DEFAULT 0,
+  failure_message TEXT,
+  bytes_downloaded INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_recipe ON runs (recipe, start);
+"""
+
+COLUMNS = [
+  'run_id',
+  'hostname',
+  'recipe',
+  'start',
+  'end',
+  'duration',
+  'branch_time',
+  'autopkg_time',
+  'commit_time',
+  'outcome',
+  'version',
+  'failures',
+  'failure_message',
+  'bytes_downloaded',
+]
+
+# Outcomes recorded for each recipe run
+OUTCOME_NOCHANGE = 'nochange'
+OUTCOME_IMPORTED = 'imported'
+OUTCOME_FAILED = 'failed'
+OUTCOME_TIMEOUT = 'timeout'
+
+
+def connect(db_path=DEFAULT_DB):
+  """Open the history database, creating the schema if necessary."""
+  db_dir = os.path.dirname(db_path)
+  if db_dir and not os.path.isdir(db_dir):
+    os.makedirs(db_dir)
+  conn = sqlite3.connect(db_path)
+  conn.row_factory = sqlite3.Row
+  conn.executescript(SCHEMA)
+  return conn
+
+
+def new_record(recipe, run_id=None, hostname=None):
+  """Return an empty run record for a recipe, with the start time set."""
+  record = dict.fromkeys(COLUMNS)
+  record['run_id'] = run_id
+  record['hostname'] = hostname
+  record['recipe'] = recipe
+  record['start'] = time.time()
+  record['failures'] = 0
+  record['bytes_downloaded'] = 0
+  return record
+
+
+def finish_record(record, outcome):
+  """Set the outcome, end time and total duration of a run record."""
+  record['outcome'] = outcome
+  record['end'] = time.time()
+  record['duration'] = record['end'] - record['start']
+  return record
+
+
+def record_run(record, db_path=DEFAULT_DB):
+  """Persist a single run record to the history database."""
+  conn = connect(db_path)
+  try:
+    with conn:
+      conn.execute(
+        'INSERT INTO runs (%s) VALUES (%s)' % (
+          ', '.join(COLUMNS),
+          ', '.join('?' * len(COLUMNS))
+        ),
+        [record.get(column) for column in COLUMNS]
+      )
+  finally:
+    conn.close()
+
+
+# Queries
+def slowest_recipes(conn, limit=10, since=None):
+  """Return recipes ordered by their average run duration."""
+  return conn.execute(
+    'SELECT recipe, COUNT(*) AS runs, AVG(duration) AS avg_duration, '
+    'MAX(duration) AS max_duration, AVG(branch_time) AS avg_branch, '
+    'AVG(autopkg_time) AS avg_autopkg, AVG(commit_time) AS avg_commit '
+    'FROM runs WHERE start >= ? GROUP BY recipe '
+    'ORDER BY avg_duration DESC LIMIT ?',
+    (since or 0, limit)
+  ).fetchall()
+
+
+def failure_rates(conn, limit=10, since=None):
+  """Return recipes ordered by the fraction of runs that failed."""
+  return conn.execute(
+    'SELECT recipe, COUNT(*) AS runs, '
+    'SUM(outcome IN (?, ?)) AS failed, '
+    'CAST(SUM(outcome IN (?, ?)) AS REAL) / COUNT(*) AS failure_rate '
+    'FROM runs WHERE start >= ? GROUP BY recipe '
+    'HAVING failed > 0 ORDER BY failure_rate DESC, runs DESC LIMIT ?',
+    (OUTCOME_FAILED, OUTCOME_TIMEOUT, OUTCOME_FAILED, OUTCOME_TIMEOUT,
+     since or 0, limit)
+  ).fetchall()
+
+
+def recipe_trend(conn, recipe, limit=20):
+  """Return the most recent runs of a recipe, newest first."""
+  return conn.execute(
+    'SELECT * FROM runs WHERE recipe = ? ORDER BY start DESC LIMIT ?',
+    (recipe, limit)
+  ).fetchall()
+
+
+def daily_trend(conn, days=30):
+  """Return per-day run counts, failures and total duration."""
+  since = time.time() - days * 86400
+  return conn.execute(
+    "SELECT date(start, 'unixepoch', 'localtime') AS day, "
+    'COUNT(*) AS runs, SUM(outcome IN (?, ?)) AS failed, '
+    'SUM(outcome = ?) AS imported, SUM(duration) AS total_duration, '
+    'SUM(bytes_downloaded) AS bytes_downloaded '
+    'FROM runs WHERE start >= ? GROUP BY day ORDER BY day',
+    (OUTCOME_FAILED, OUTCOME_TIMEOUT, OUTCOME_IMPORTED, since)
+  ).fetchall()
+
+
+def average_durations(conn, since=None):
+  """Return a dict of recipe to average run duration in seconds."""
+  rows = conn.execute(
+    'SELECT recipe, AVG(duration) AS avg_duration FROM runs '
+    'WHERE start >= ? AND duration IS NOT NULL GROUP BY recipe',
+    (since or 0,)
+  ).fetchall()
+  return dict((row['recipe'], row['avg_duration']) for row in rows)
+
+
+# Output formatting
+def format_seconds(value):
+  """Format a number of seconds for display."""
+  if value is None:
+    return '-'
+  return '%.1fs' % value
+
+
+def print_table(headers, rows):
+  """Print rows as a simple left-aligned table."""
+  widths = [len(header) for header in headers]
+  for row in rows:
+    for index, value in enumerate(row):
+      widths[index] = max(widths[index], len(value))
+  line = '  '.join('%%-%ds' % width for width in widths)
+  print (line % tuple(headers)).rstrip()
+  for row in rows:
+    print (line % tuple(row)).rstrip()
+
+
+def show_slowest(conn, args):
+  """Print the slowest recipes."""
+  rows = slowest_recipes(conn, args.limit, args.since)
+  print_table(
+    ['recipe', 'runs', 'avg', 'max', 'branch', 'autopkg', 'commit'],
+    [[row['recipe'], str(row['runs']),
+      format_seconds(row['avg_duration']),
+      format_seconds(row['max_duration']),
+      format_seconds(row['avg_branch']),
+      format_seconds(row['avg_autopkg']),
+      format_seconds(row['avg_commit'])] for row in rows]
+  )
+
+
+def show_failures(conn, args):
+  """Print the recipes that fail most often."""
+  rows = failure_rates(conn, args.limit, args.since)
+  print_table(
+    ['recipe', 'runs', 'failed', 'rate'],
+    [[row['recipe'], str(row['runs']), str(row['failed']),
+      '%.0f%%' % (row['failure_rate'] * 100)] for row in rows]
+  )
+
+
+def show_trend(conn, args):
+  """Print the recent history of one recipe, or per-day totals."""
+  if args.recipe:
+    rows = recipe_trend(conn, args.recipe, args.limit)
+    print_table(
+      ['start', 'outcome', 'version', 'duration', 'autopkg', 'bytes'],
+      [[time.strftime('%Y-%m-%d %H:%M', time.localtime(row['start'])),
+        str(row['outcome']), str(row['version'] or '-'),
+        format_seconds(row['duration']),
+        format_seconds(row['autopkg_time']),
+        str(row['bytes_downloaded'] or 0)] for row in rows]
+    )
+    return
+  rows = daily_trend(conn, args.days)
+  print_table(
+    ['day', 'runs', 'failed', 'imported', 'duration', 'bytes'],
+    [[row['day'], str(row['runs']), str(row['failed']),
+      str(row['imported']), format_seconds(row['total_duration']),
+      str(row['bytes_downloaded'] or 0)] for row in rows]
+  )
+
+
+def show_weights(conn, args):
+  """Print the average duration of each recipe as JSON."""
+  print json.dumps(
+    average_durations(conn, args.since), indent=2, sort_keys=True)
+
+
+def main():
+  """Query the run history database."""
+  parser = argparse.ArgumentParser(
+    description='Query the autopkg_tools run history.')
+  parser.add_argument(
+    '--db', help='Path to the history database. Defaults to %s.' % DEFAULT_DB,
+    default=DEFAULT_DB)
+  subparsers = parser.add_subparsers(dest='command')
+  slowest = subparsers.add_parser('slowest', help='Slowest recipes.')
+  slowest.set_defaults(func=show_slowest)
+  failures = subparsers.add_parser('failures', help='Recipe failure rates.')
+  failures.set_defaults(func=show_failures)
+  weights = subparsers.add_parser(
+    'weights', help='Average recipe durations as JSON, for sharding.')
+  weights.set_defaults(func=show_weights)
+  for subparser in (slowest, failures):
+    subparser.add_argument(
+      '-n', '--limit', help='Number of recipes to show.',
+      type=int, default=10)
+  for subparser in (slowest, failures, weights):
+    subparser.add_argument(
+      '--days', help='Only consider runs in the last N days.', type=int)
+  trend = subparsers.add_parser(
+    'trend', help='Per-day totals, or the recent runs of one recipe.')
+  trend.add_argument('recipe', nargs='?', help='Recipe to show.')
+  trend.add_argument(
+    '-n', '--limit', help='Number of runs to show.', type=int, default=20)
+  trend.add_argument(
+    '--days', help='Number of days to show.', type=int, default=30)
+  trend.set_defaults(func=show_trend)
+  args = parser.parse_args()
+  args.since = None
+  if args.command != 'trend' and args.days:
+    args.since = time.time() - args.days * 86400
+  if not os.path.isfile(args.db):
+    print >> sys.stderr, "No history database found at %s" % args.db
+    sys.exit(1)
+  conn = connect(args.db)
+  try:
+    args.func(conn, args)
+  finally:
+    conn.close()
+
+
+if __name__ == '__main__':
+  main()
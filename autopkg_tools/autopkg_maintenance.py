@@ -0,0 +1,306 @@
+#!/usr/bin/python
+"""Keep the AutoPkg Munki git repo fast as branches and objects pile up.
+
+Every recipe run leaves a branch behind, and over months thousands of them
+accumulate, along with loose objects. Maintenance deletes the branches
+autopkg_tools made that are merged into master or haven't been committed to
+in max_age days, packs the refs and objects, and writes the commit-graph and
+multi-pack-index so git doesn't have to walk loose files. The report compares
+ref and object counts, and the time it takes to list branches, before and
+after.
+
+It can be run on its own, or at the end of an autopkg_tools run with
+--maintain.
+"""
+
+import argparse
+import fnmatch
+import os
+import sys
+import time
+
+# Append the shared CPE modules to the Python path
+sys.path.append('/Library/CPE/lib/flib/modules')
+try:
+  import process_tools
+except ImportError:
+  print "Can't find process_tools!"
+  sys.exit(1)
+
+GIT = '/usr/bin/git'
+# Days without a commit after which an unmerged branch is deleted
+MAX_AGE = 90
+# Branches deleted per git process
+DELETE_CHUNK = 200
+# Times branches are listed to get a stable timing
+TIMING_RUNS = 5
+# Branches that are never deleted
+PROTECTED = ['master']
+# Branches that may always be deleted: the run branches of --batch. Recipe
+# branches are named after the recipes, so their patterns are passed in.
+RUN_BRANCHES = ['autopkg-run-*']
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class GitError(Error):
+  """Git exceptions."""
+
+
+def git(repo, args):
+  """Run git in repo and return its output."""
+  results = process_tools.run([GIT] + list(args), cwd=repo)
+  if not results['success']:
+    raise GitError("git %s failed: %s" % (args[0], results['stderr']))
+  return results['stdout']
+
+
+def git_dir(repo):
+  """Return the absolute path of the .git directory of repo."""
+  return os.path.join(repo, git(repo, ['rev-parse', '--git-dir']).strip())
+
+
+def branch_dates(repo):
+  """Return a dict of local branch name to its last commit time."""
+  output = git(repo, [
+    'for-each-ref', '--format=%(refname:short) %(committerdate:unix)',
+    'refs/heads'
+  ])
+  branches = {}
+  for line in output.splitlines():
+    (name, date) = line.rsplit(' ', 1)
+    branches[name] = int(date)
+  return branches
+
+
+def merged_branches(repo, base='master'):
+  """Return the set of local branches already merged into base."""
+  return set(git(repo, [
+    'for-each-ref', '--format=%(refname:short)', '--merged', base,
+    'refs/heads'
+  ]).split())
+
+
+def current_branch(repo):
+  """Return the checked out branch, or None if HEAD is detached."""
+  results = process_tools.run(
+    [GIT, 'symbolic-ref', '--short', '-q', 'HEAD'], cwd=repo)
+  return results['stdout'].strip() or None
+
+
+def stale_branches(repo, base='master', max_age=MAX_AGE, keep=None,
+                   prune=None):
+  """Return the (merged, expired) lists of branches that can be deleted.
+
+  Only branches matching RUN_BRANCHES or one of the prune patterns are
+  considered, so branches made by hand are left alone. Of those, branches
+  merged into base are always stale. Unmerged branches are stale once their
+  last commit is more than max_age days old; a max_age of 0 keeps all of
+  them. base, the checked out branch and branches matching any of the keep
+  patterns are never included.
+  """
+  keep = PROTECTED + [base] + list(keep or [])
+  prune = RUN_BRANCHES + list(prune or [])
+  head = current_branch(repo)
+  merged = merged_branches(repo, base)
+  cutoff = time.time() - max_age * 86400
+  (stale_merged, stale_expired) = ([], [])
+  for name, date in sorted(branch_dates(repo).iteritems()):
+    if name == head or any(fnmatch.fnmatch(name, kept) for kept in keep):
+      continue
+    if not any(fnmatch.fnmatch(name, pattern) for pattern in prune):
+      continue
+    if name in merged:
+      stale_merged.append(name)
+    elif max_age and date < cutoff:
+      stale_expired.append(name)
+  return (stale_merged, stale_expired)
+
+
+def delete_branches(repo, branches):
+  """Force-delete local branches, a chunk at a time."""
+  for index in range(0, len(branches), DELETE_CHUNK):
+    git(repo, ['branch', '-D', '--'] + branches[index:index + DELETE_CHUNK])
+
+
+def ref_counts(repo):
+  """Return the number of loose and packed refs in repo."""
+  directory = git_dir(repo)
+  loose = 0
+  for dummy_root, dummy_dirs, files in os.walk(os.path.join(directory, 'refs')):
+    loose += len([name for name in files if not name.endswith('.lock')])
+  packed = 0
+  packed_refs = os.path.join(directory, 'packed-refs')
+  if os.path.isfile(packed_refs):
+    with open(packed_refs, 'rb') as f:
+      for line in f:
+        if not line.startswith('#') and not line.startswith('^'):
+          packed += 1
+  return {'loose_refs': loose, 'packed_refs': packed}
+
+
+def object_counts(repo):
+  """Return the loose object and pack counts from git count-objects."""
+  counts = {}
+  for line in git(repo, ['count-objects', '-v']).splitlines():
+    (key, value) = line.split(':', 1)
+    counts[key.strip()] = int(value)
+  return {
+    'loose_objects': counts.get('count', 0),
+    'loose_kb': counts.get('size', 0),
+    'packs': counts.get('packs', 0),
+    'pack_kb': counts.get('size-pack', 0),
+  }
+
+
+def list_branches(repo):
+  """List the branches of repo the way git does."""
+  return git(repo, ['for-each-ref', '--format=%(refname:short)', 'refs/heads'])
+
+
+def time_listing(repo, lister=None, runs=TIMING_RUNS):
+  """Return the fastest of several timings of listing branches."""
+  lister = lister or list_branches
+  best = None
+  for dummy_run in range(runs):
+    start = time.time()
+    lister(repo)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def snapshot(repo, lister=None):
+  """Return the ref, object and branch listing numbers of repo."""
+  state = {'branches': len(branch_dates(repo))}
+  state.update(ref_counts(repo))
+  state.update(object_counts(repo))
+  state['branch_list_time'] = time_listing(repo, lister)
+  return state
+
+
+# Each step is (name, git arguments, required). Steps that aren't required
+# need a newer git, and are skipped if it doesn't support them.
+def repack_steps(full=False):
+  """Return the maintenance steps to run after branches are pruned."""
+  repack = ['repack', '-d', '-l']
+  if full:
+    repack.insert(1, '-a')
+  return [
+    ('pack-refs', ['pack-refs', '--all', '--prune'], True),
+    ('repack', repack, True),
+    ('prune', ['prune', '--expire=2.weeks.ago'], True),
+    ('commit-graph', ['commit-graph', 'write', '--reachable'], False),
+    ('multi-pack-index', ['multi-pack-index', 'write'], False),
+  ]
+
+
+def maintain(repo, base='master', max_age=MAX_AGE, keep=None, full=False,
+             dry_run=False, lister=None, prune=None):
+  """Prune stale branches and repack repo. Returns a report dict.
+
+  prune is a list of patterns of the recipe branches that may be deleted, on
+  top of RUN_BRANCHES. lister(repo) is timed to measure listing branches
+  before and after; it defaults to git for-each-ref. With dry_run, only the
+  branches that would be deleted are reported.
+  """
+  report = {'repo': repo, 'dry_run': dry_run, 'steps': []}
+  report['before'] = snapshot(repo, lister)
+  (merged, expired) = stale_branches(repo, base, max_age, keep, prune)
+  report['merged'] = merged
+  report['expired'] = expired
+  if dry_run:
+    return report
+  start = time.time()
+  delete_branches(repo, merged + expired)
+  report['steps'].append(('delete-branches', time.time() - start, None))
+  for (name, args, required) in repack_steps(full):
+    start = time.time()
+    try:
+      git(repo, args)
+      report['steps'].append((name, time.time() - start, None))
+    except GitError as err:
+      if required:
+        raise
+      report['steps'].append((name, time.time() - start, str(err).strip()))
+  report['after'] = snapshot(repo, lister)
+  return report
+
+
+def report_lines(report):
+  """Return a maintenance report as a list of printable lines."""
+  lines = []
+  action = 'Would delete' if report['dry_run'] else 'Deleted'
+  lines.append("%s %d merged and %d expired branches" % (
+    action, len(report['merged']), len(report['expired'])))
+  for (name, seconds, skipped) in report['steps']:
+    if skipped:
+      lines.append("  %s skipped: %s" % (name, skipped))
+    else:
+      lines.append("  %s took %.2fs" % (name, seconds))
+  before = report['before']
+  after = report.get('after')
+  for key in ('branches', 'loose_refs', 'packed_refs', 'loose_objects',
+              'packs'):
+    if after:
+      lines.append("%-14s %8d -> %d" % (key + ':', before[key], after[key]))
+    else:
+      lines.append("%-14s %8d" % (key + ':', before[key]))
+  if after:
+    lines.append("%-14s %7.1fms -> %.1fms (%.1fms saved)" % (
+      'branch list:', before['branch_list_time'] * 1000,
+      after['branch_list_time'] * 1000,
+      (before['branch_list_time'] - after['branch_list_time']) * 1000))
+  else:
+    lines.append("%-14s %7.1fms" % (
+      'branch list:', before['branch_list_time'] * 1000))
+  return lines
+
+
+def main():
+  """Run maintenance on a repo from the command line."""
+  parser = argparse.ArgumentParser(
+    description='Prune stale AutoPkg branches and repack the Munki git repo.')
+  parser.add_argument('repo', help='Path to the git repo.')
+  parser.add_argument(
+    '--base', default='master',
+    help='Branch that merged branches are merged into. Defaults to master.')
+  parser.add_argument(
+    '--max-age', type=int, default=MAX_AGE,
+    help=('Days after which unmerged branches are deleted, 0 to keep them. '
+          'Defaults to %d.' % MAX_AGE))
+  parser.add_argument(
+    '--keep', action='append', default=[],
+    help='Pattern of branches to never delete. May be given more than once.')
+  parser.add_argument(
+    '--prune', action='append', default=[],
+    help=('Pattern of branches that may be deleted, such as Firefox-*. '
+          '%s branches always may be. May be given more than once.' %
+          ', '.join(RUN_BRANCHES)))
+  parser.add_argument(
+    '--full', action='store_true', default=False,
+    help='Repack every object into one pack, instead of only loose objects.')
+  parser.add_argument(
+    '-n', '--dry-run', action='store_true', default=False,
+    help='Only report the branches that would be deleted.')
+  parser.add_argument(
+    '-v', '--verbose', action='store_true', default=False,
+    help='List the branches that are deleted.')
+  args = parser.parse_args()
+  report = maintain(
+    os.path.abspath(args.repo), args.base, args.max_age, args.keep,
+    args.full, args.dry_run, prune=args.prune)
+  if args.verbose or args.dry_run:
+    for name in report['merged']:
+      print "merged:  %s" % name
+    for name in report['expired']:
+      print "expired: %s" % name
+  for line in report_lines(report):
+    print line
+
+
+if __name__ == '__main__':
+  main()
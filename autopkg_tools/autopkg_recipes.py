@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""In-process index of AutoPkg recipes, for resolving recipes and parents.
+
+AutoPkg resolves a recipe by walking every override and search directory and
+parsing plists until it finds a match, then does the same again for every
+parent. The index walks the directories once, maps names and identifiers to
+paths, and keeps parsed recipes around, so resolving the whole runlist costs
+one walk. It is rebuilt if any of the directories it read changes.
+"""
+
+import os
+import sys
+
+try:
+  import FoundationPlist as plistlib
+except ImportError:
+  import plistlib
+
+RECIPE_EXTENSIONS = ('.recipe', '.recipe.plist')
+
+
+def recipe_name(filename):
+  """Return the recipe name for a file name, or None if it isn't a recipe."""
+  for extension in RECIPE_EXTENSIONS:
+    if filename.endswith(extension):
+      return filename[:-len(extension)]
+  return None
+
+
+class RecipeIndex(object):
+  """Map recipe names and identifiers to paths and parsed recipes.
+
+  Directories are searched in order, overrides first, and like AutoPkg only
+  the directory itself and its immediate subdirectories are searched. The
+  first recipe found for a name or identifier wins.
+  """
+
+  def __init__(self, override_dirs, search_dirs):
+    self.dirs = [
+      os.path.expanduser(path) for path in
+      list(override_dirs or []) + list(search_dirs or [])
+    ]
+    self.by_name = {}
+    self.by_identifier = {}
+    self._mtimes = {}
+    self._recipes = {}
+    self.build()
+
+  def _scan_dir(self, directory, paths):
+    """Add the recipe files directly in a directory to paths."""
+    try:
+      self._mtimes[directory] = os.stat(directory).st_mtime
+      names = sorted(os.listdir(directory))
+    except OSError:
+      self._mtimes[directory] = None
+      return []
+    subdirs = []
+    for name in names:
+      path = os.path.join(directory, name)
+      if recipe_name(name):
+        paths.append(path)
+      elif os.path.isdir(path):
+        subdirs.append(path)
+    return subdirs
+
+  def build(self):
+    """Walk the recipe directories and index every recipe found."""
+    self.by_name = {}
+    self.by_identifier = {}
+    self._mtimes = {}
+    for directory in self.dirs:
+      paths = []
+      for subdir in self._scan_dir(directory, paths):
+        self._scan_dir(subdir, paths)
+      for path in paths:
+        self.by_name.setdefault(recipe_name(os.path.basename(path)), path)
+        recipe = self.read(path)
+        if recipe and recipe.get('Identifier'):
+          self.by_identifier.setdefault(recipe['Identifier'], path)
+
+  def is_stale(self):
+    """Return True if any indexed directory has changed since the build."""
+    for directory, mtime in self._mtimes.iteritems():
+      try:
+        current = os.stat(directory).st_mtime
+      except OSError:
+        current = None
+      if current != mtime:
+        return True
+    return False
+
+  def read(self, path):
+    """Return the parsed recipe at path, parsing it at most once."""
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      return None
+    cached = self._recipes.get(path)
+    if cached and cached[0] == mtime:
+      return cached[1]
+    try:
+      recipe = plistlib.readPlist(path)
+    except Exception as err:  # pylint: disable=broad-except
+      print >> sys.stderr, "Unable to parse recipe %s: %s" % (path, err)
+      recipe = None
+    self._recipes[path] = (mtime, recipe)
+    return recipe
+
+  def find(self, name_or_identifier):
+    """Return the path of a recipe given a path, name or identifier."""
+    if os.path.isfile(name_or_identifier):
+      return name_or_identifier
+    name = recipe_name(name_or_identifier) or name_or_identifier
+    return (
+      self.by_name.get(name) or
+      self.by_identifier.get(name_or_identifier)
+    )
+
+  def recipe_chain(self, name_or_identifier):
+    """Return the recipe paths from the root parent down to the recipe.
+
+    This is the same list AutoPkg builds from PARENT_RECIPES plus
+    RECIPE_PATH. Returns an empty list if the recipe can't be found.
+    """
+    chain = []
+    path = self.find(name_or_identifier)
+    while path and path not in chain:
+      chain.insert(0, path)
+      recipe = self.read(path) or {}
+      parent = recipe.get('ParentRecipe')
+      if not parent:
+        break
+      path = self.by_identifier.get(parent)
+      if not path:
+        print >> sys.stderr, "Parent recipe %s not found" % parent
+        return []
+    return chain
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+"""Aggregate per-recipe AutoPkg reports into a summary of the whole run.
+
+Each recipe of a run writes its report plist to the run's report directory.
+As each recipe finishes, its results are added to a RunSummary, which
+rewrites summary.json and summary.plist in the same directory, atomically, so
+dashboards can read the state of a run (even one still in progress) without
+parsing every report plist.
+
+Run on its own, this rebuilds the summary of a run directory from the report
+plists in it, for example after a run that was killed.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+try:
+  import FoundationPlist as plistlib
+except ImportError:
+  import plistlib
+
+SUMMARY_NAME = 'summary'
+# Outcomes, matching autopkg_history
+OUTCOME_NOCHANGE = 'nochange'
+OUTCOME_IMPORTED = 'imported'
+OUTCOME_FAILED = 'failed'
+OUTCOME_TIMEOUT = 'timeout'
+
+
+def recipe_key(recipe):
+  """Return the name a recipe, given by name or path, is summarized as."""
+  return os.path.basename(recipe.rstrip(os.sep))
+
+
+def report_name(recipe):
+  """Return the report plist file name for a recipe name or path."""
+  return recipe_key(recipe) + '.plist'
+
+
+def read_report(path):
+  """Parse a report plist into lists of imported, failed and downloaded."""
+  report_data = plistlib.readPlist(path)
+  summary_results = report_data.get('summary_results') or {}
+  return {
+    'imported': list(
+      summary_results.get('munki_importer_summary_result', {}).get(
+        'data_rows', [])
+    ),
+    'failed': list(report_data.get('failures') or []),
+    'downloaded': [
+      item['download_path'] for item in
+      summary_results.get('url_downloader_summary_result', {}).get(
+        'data_rows', [])
+    ],
+  }
+
+
+def outcome_of(results):
+  """Return the outcome of a parsed report."""
+  if results['failed']:
+    return OUTCOME_FAILED
+  if results['imported']:
+    return OUTCOME_IMPORTED
+  return OUTCOME_NOCHANGE
+
+
+def without_none(value):
+  """Return value with None removed from dicts and lists, for plists."""
+  if isinstance(value, dict):
+    return dict(
+      (key, without_none(item)) for key, item in value.iteritems()
+      if item is not None
+    )
+  if isinstance(value, (list, tuple)):
+    return [without_none(item) for item in value if item is not None]
+  return value
+
+
+def atomic_write(path, write):
+  """Call write(temp_path), then move the temp file to path."""
+  (handle, temp_path) = tempfile.mkstemp(
+    dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+  os.close(handle)
+  try:
+    write(temp_path)
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, path)
+  except BaseException:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    raise
+
+
+class RunSummary(object):
+  """Summary of a run, updated and rewritten as each recipe finishes."""
+
+  def __init__(self, report_dir, run_id=None, hostname=None):
+    self.report_dir = report_dir
+    self.summary = {
+      'run_id': run_id,
+      'hostname': hostname or socket.gethostname(),
+      'started': time.time(),
+      'updated': None,
+      'finished': None,
+      'totals': {
+        'recipes': 0,
+        'duration': 0.0,
+        OUTCOME_NOCHANGE: 0,
+        OUTCOME_IMPORTED: 0,
+        OUTCOME_FAILED: 0,
+        OUTCOME_TIMEOUT: 0,
+      },
+      'recipes': {},
+      'imports': [],
+      'failures': [],
+    }
+    if not os.path.isdir(report_dir):
+      os.makedirs(report_dir)
+
+  def path(self, extension):
+    """Return the path of the summary file with the given extension."""
+    return os.path.join(self.report_dir, SUMMARY_NAME + extension)
+
+  def add(self, recipe, outcome, results=None, duration=None, write=True):
+    """Merge the results of one recipe into the summary.
+
+    results is a parsed report as returned by read_report, or None if the
+    recipe didn't get as far as writing one.
+    """
+    recipe = recipe_key(recipe)
+    results = results or {'imported': [], 'failed': [], 'downloaded': []}
+    totals = self.summary['totals']
+    previous = self.summary['recipes'].get(recipe)
+    if previous:
+      # A recipe run twice in the run replaces its earlier entry
+      self._remove(recipe, previous)
+    entry = {
+      'outcome': outcome,
+      'duration': duration,
+      'imported': [
+        {
+          'name': item.get('name'),
+          'version': str(item.get('version')),
+          'pkginfo_path': item.get('pkginfo_path'),
+          'pkg_repo_path': item.get('pkg_repo_path'),
+        }
+        for item in results['imported']
+      ],
+      'failures': [str(item.get('message')) for item in results['failed']],
+    }
+    self.summary['recipes'][recipe] = entry
+    totals['recipes'] += 1
+    totals[outcome] = totals.get(outcome, 0) + 1
+    totals['duration'] += duration or 0
+    for item in entry['imported']:
+      self.summary['imports'].append(dict(item, recipe=recipe))
+    for message in entry['failures']:
+      self.summary['failures'].append({'recipe': recipe, 'message': message})
+    if write:
+      self.write()
+
+  def _remove(self, recipe, entry):
+    """Take an earlier entry of a recipe back out of the totals."""
+    totals = self.summary['totals']
+    totals['recipes'] -= 1
+    totals[entry['outcome']] -= 1
+    totals['duration'] -= entry['duration'] or 0
+    self.summary['imports'] = [
+      item for item in self.summary['imports'] if item['recipe'] != recipe
+    ]
+    self.summary['failures'] = [
+      item for item in self.summary['failures'] if item['recipe'] != recipe
+    ]
+
+  def finish(self):
+    """Mark the run as finished and write the summary."""
+    self.summary['finished'] = time.time()
+    self.write()
+
+  def write(self):
+    """Atomically rewrite summary.json and summary.plist."""
+    self.summary['updated'] = time.time()
+
+    def write_json(temp_path):
+      """Write the summary as JSON."""
+      with open(temp_path, 'wb') as f:
+        json.dump(self.summary, f, indent=2, sort_keys=True)
+
+    atomic_write(self.path('.json'), write_json)
+    atomic_write(
+      self.path('.plist'),
+      lambda temp_path: plistlib.writePlist(
+        without_none(self.summary), temp_path)
+    )
+
+
+def rebuild(report_dir):
+  """Rebuild the summary of a run directory from its report plists."""
+  known_recipes = {}
+  previous = {}
+  json_path = os.path.join(report_dir, SUMMARY_NAME + '.json')
+  if os.path.isfile(json_path):
+    # Keep what only the run itself knew: durations, timeouts, run ID
+    with open(json_path, 'rb') as f:
+      previous = json.load(f)
+    for recipe, entry in previous.get('recipes', {}).iteritems():
+      known_recipes[recipe] = entry
+  summary = RunSummary(
+    report_dir, previous.get('run_id'), previous.get('hostname'))
+  if previous.get('started'):
+    summary.summary['started'] = previous['started']
+  seen = set()
+  for name in sorted(os.listdir(report_dir)):
+    if not name.endswith('.plist') or name.startswith(SUMMARY_NAME + '.'):
+      continue
+    recipe = name[:-len('.plist')]
+    try:
+      results = read_report(os.path.join(report_dir, name))
+    except Exception as err:  # pylint: disable=broad-except
+      print >> sys.stderr, "Skipping unreadable report %s: %s" % (name, err)
+      continue
+    known = known_recipes.get(recipe, {})
+    summary.add(recipe, outcome_of(results), results,
+                known.get('duration'), write=False)
+    seen.add(recipe)
+  # Recipes that never wrote a report, such as ones that timed out
+  for recipe, entry in sorted(known_recipes.iteritems()):
+    if recipe not in seen:
+      results = {
+        'imported': [],
+        'failed': [
+          {'message': message} for message in entry.get('failures', [])
+        ],
+        'downloaded': [],
+      }
+      summary.add(recipe, entry['outcome'], results, entry.get('duration'),
+                  write=False)
+  summary.summary['finished'] = previous.get('finished')
+  summary.write()
+  return summary
+
+
+def main():
+  """Rebuild the summary of a run from its report plists."""
+  parser = argparse.ArgumentParser(
+    description='Rebuild the summary of an AutoPkg run from its reports.')
+  parser.add_argument('report_dir', help='Report directory of the run.')
+  args = parser.parse_args()
+  summary = rebuild(args.report_dir)
+  totals = summary.summary['totals']
+  print "%d recipes: %d imported, %d failed, %d timed out, %d unchanged" % (
+    totals['recipes'], totals[OUTCOME_IMPORTED], totals[OUTCOME_FAILED],
+    totals[OUTCOME_TIMEOUT], totals[OUTCOME_NOCHANGE])
+  print "Summary written to %s" % summary.path('.json')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""Split an AutoPkg runlist across several build hosts.
+
+Every host is given the same runlist and its own shard (--shard i/N), and
+works out which recipes are its own without talking to the others. Recipes
+are placed by a stable hash of their name, or, when a weights file of
+historical runtimes is given, by balancing the expected runtime of each
+shard. Every host must use the same weights file to get the same split.
+
+Each host writes a status file for its shard to a shared directory, which
+the status command reads to report which shards of a run have finished.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+try:
+  import FoundationPlist as plistlib
+except ImportError:
+  import plistlib
+
+STATE_RUNNING = 'running'
+STATE_FINISHED = 'finished'
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class ShardError(Error):
+  """Invalid shard specification."""
+
+
+def parse_shard(spec):
+  """Parse an 'i/N' shard spec into a (index, count) tuple, 1 <= i <= N."""
+  try:
+    (index, count) = [int(part) for part in spec.split('/')]
+  except ValueError:
+    raise ShardError("Shard must look like 'i/N': %s" % spec)
+  if count < 1 or not 1 <= index <= count:
+    raise ShardError("Shard %s is out of range" % spec)
+  return (index, count)
+
+
+def entry_name(entry):
+  """Return the recipe name of a runlist entry (a name or a dict)."""
+  if isinstance(entry, basestring):
+    return entry
+  return entry['recipe']
+
+
+def recipe_hash(recipe):
+  """Return a hash of a recipe name that is the same on every host."""
+  return int(hashlib.sha1(recipe.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def assign_shards(runlist, count, weights=None):
+  """Split runlist entries into count lists, one per shard.
+
+  Without weights, each recipe goes to the shard picked by its hash. With
+  weights (recipe name to seconds), the heaviest recipes are placed first,
+  each on the shard with the least total weight so far. Recipes missing
+  from the weights count as an average recipe. The order of the runlist is
+  kept within each shard.
+  """
+  shards = [[] for dummy_index in range(count)]
+  if not weights:
+    for entry in runlist:
+      shards[recipe_hash(entry_name(entry)) % count].append(entry)
+    return shards
+  known = [weight for weight in weights.values() if weight]
+  default = sum(known) / len(known) if known else 1
+  names = [entry_name(entry) for entry in runlist]
+  ordered = sorted(
+    range(len(runlist)),
+    key=lambda pos: (
+      -(weights.get(names[pos]) or default),
+      recipe_hash(names[pos]),
+      names[pos],
+    )
+  )
+  placed = [[] for dummy_index in range(count)]
+  loads = [0] * count
+  for pos in ordered:
+    shard = min(range(count), key=lambda index: (loads[index], index))
+    placed[shard].append(pos)
+    loads[shard] += weights.get(names[pos]) or default
+  for (shard, positions) in zip(shards, placed):
+    shard.extend(runlist[pos] for pos in sorted(positions))
+  return shards
+
+
+def select_shard(runlist, index, count, weights=None):
+  """Return the runlist entries that belong to shard index (1-based)."""
+  return assign_shards(runlist, count, weights)[index - 1]
+
+
+def load_weights(path):
+  """Read a JSON file of recipe name to expected runtime in seconds."""
+  with open(path, 'rb') as f:
+    return json.load(f)
+
+
+# Shard status
+def status_path(status_dir, run_id, index, count):
+  """Return the path of the status file of one shard of a run."""
+  return os.path.join(
+    status_dir, str(run_id), 'shard-%d-of-%d.json' % (index, count)
+  )
+
+
+def write_status(status_dir, run_id, index, count, state, **info):
+  """Atomically write the status of this host's shard."""
+  path = status_path(status_dir, run_id, index, count)
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  status = {
+    'run_id': run_id,
+    'shard': index,
+    'count': count,
+    'state': state,
+    'hostname': socket.gethostname(),
+    'updated': time.time(),
+  }
+  status.update(info)
+  (handle, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+  with os.fdopen(handle, 'wb') as f:
+    json.dump(status, f, indent=2, sort_keys=True)
+  os.rename(temp_path, path)
+  return status
+
+
+def shard_report(status_dir, run_id, count):
+  """Return the status of every shard of a run, None for missing shards."""
+  report = []
+  for index in range(1, count + 1):
+    path = status_path(status_dir, run_id, index, count)
+    if os.path.isfile(path):
+      with open(path, 'rb') as f:
+        report.append(json.load(f))
+    else:
+      report.append(None)
+  return report
+
+
+def read_runlist(path):
+  """Read a JSON or plist runlist."""
+  if path.endswith('.json'):
+    with open(path, 'rb') as f:
+      return json.load(f)
+  return plistlib.readPlist(path)
+
+
+def show_status(args):
+  """Print which shards of a run have finished. Exit 1 if any haven't."""
+  report = shard_report(args.status_dir, args.run_id, args.count)
+  finished = 0
+  for index, status in enumerate(report, 1):
+    if status is None:
+      print "shard %d/%d: not started" % (index, args.count)
+      continue
+    line = "shard %d/%d: %s on %s" % (
+      index, args.count, status['state'], status['hostname'])
+    if status['state'] == STATE_FINISHED:
+      finished += 1
+      line += " in %.0fs, %s recipes, %s imported, %s failed" % (
+        status.get('duration', 0), status.get('recipes', 0),
+        status.get('imported', 0), status.get('failed', 0))
+    print line
+  print "%d of %d shards finished." % (finished, args.count)
+  if finished != args.count:
+    sys.exit(1)
+
+
+def show_plan(args):
+  """Print the recipes each shard of a runlist would run."""
+  weights = load_weights(args.weights) if args.weights else None
+  shards = assign_shards(read_runlist(args.list), args.count, weights)
+  for index, shard in enumerate(shards, 1):
+    names = [entry_name(entry) for entry in shard]
+    total = ''
+    if weights:
+      total = ' (%.0fs expected)' % sum(
+        weights.get(name) or 0 for name in names)
+    print "shard %d/%d: %d recipes%s" % (index, args.count, len(names), total)
+    for name in names:
+      print "  %s" % name
+
+
+def main():
+  """Report on sharded runs."""
+  parser = argparse.ArgumentParser(
+    description='Plan and check runlists sharded across AutoPkg hosts.')
+  subparsers = parser.add_subparsers(dest='command')
+  status = subparsers.add_parser(
+    'status', help='Report which shards of a run have finished.')
+  status.add_argument('status_dir', help='Shared shard status directory.')
+  status.add_argument('run_id', help='Run ID shared by all shards.')
+  status.add_argument('count', type=int, help='Number of shards.')
+  status.set_defaults(func=show_status)
+  plan = subparsers.add_parser(
+    'plan', help='Show the recipes each shard would run.')
+  plan.add_argument('list', help='Path to a plist or JSON runlist.')
+  plan.add_argument('count', type=int, help='Number of shards.')
+  plan.add_argument('--weights', help='JSON file of recipe runtimes.')
+  plan.set_defaults(func=show_plan)
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+"""Content-addressed storage for binaries imported by AutoPkg.
+
+Packages are stored under their SHA-256 digest, so a package that has already
+been uploaded is never sent again. Large files are uploaded in fixed-size
+parts by a pool of workers, and parts that are already present are skipped,
+so an interrupted upload resumes where it left off.
+
+Backends are looked up by URL scheme in BACKENDS. To add one (S3, an internal
+blob store, ...), subclass Backend and register it:
+
+  BACKENDS['s3'] = S3Backend
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+# Size of each uploaded part, and of each read while hashing
+CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+# Number of parts uploaded at once
+JOBS = 4
+# Key used to record the storage pointer in the pkginfo
+POINTER_KEY = 'binary_storage'
+
+
+class Error(Exception):
+  """Base class for domain-specific exceptions."""
+
+
+class StorageError(Error):
+  """Storage backend exceptions."""
+
+
+def hash_file(path, read_size=READ_SIZE):
+  """Return the SHA-256 hex digest and size of a file, read in chunks."""
+  digest = hashlib.sha256()
+  size = 0
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(read_size)
+      if not data:
+        break
+      digest.update(data)
+      size += len(data)
+  return (digest.hexdigest(), size)
+
+
+def part_count(size, chunk_size=CHUNK_SIZE):
+  """Return the number of parts a file of this size is uploaded in."""
+  return max(1, (size + chunk_size - 1) // chunk_size)
+
+
+def part_size(index, size, chunk_size=CHUNK_SIZE):
+  """Return the size of one part of a file."""
+  return min(chunk_size, size - index * chunk_size)
+
+
+class Backend(object):
+  """Interface for content-addressed storage backends."""
+
+  scheme = None
+
+  def __init__(self, url):
+    self.url = url
+
+  def exists(self, digest):
+    """Return True if the complete object is already stored."""
+    raise NotImplementedError
+
+  def uploaded_parts(self, digest):
+    """Return a dict of part index to size for parts already uploaded."""
+    return {}
+
+  def upload_part(self, digest, index, data):
+    """Store one part of an object."""
+    raise NotImplementedError
+
+  def complete(self, digest, parts, size):
+    """Assemble the uploaded parts into the final object."""
+    raise NotImplementedError
+
+  def object_url(self, digest):
+    """Return the URL of a stored object."""
+    raise NotImplementedError
+
+
+class LocalBackend(Backend):
+  """Store objects in a local (or mounted) directory.
+
+  Objects live at objects/<aa>/<digest>, and in-progress uploads keep their
+  parts in partial/<digest>/ until they are assembled.
+  """
+
+  scheme = 'file'
+
+  def __init__(self, url):
+    super(LocalBackend, self).__init__(url)
+    self.root = urlparse.urlparse(url).path
+
+  def _object_path(self, digest):
+    """Path to a complete object."""
+    return os.path.join(self.root, 'objects', digest[:2], digest)
+
+  def _partial_dir(self, digest):
+    """Directory holding the parts of an in-progress upload."""
+    return os.path.join(self.root, 'partial', digest)
+
+  def _part_path(self, digest, index):
+    """Path to a single uploaded part."""
+    return os.path.join(self._partial_dir(digest), '%06d' % index)
+
+  def exists(self, digest):
+    """Return True if the complete object is already stored."""
+    return os.path.isfile(self._object_path(digest))
+
+  def uploaded_parts(self, digest):
+    """Return a dict of part index to size for parts already uploaded."""
+    parts = {}
+    partial_dir = self._partial_dir(digest)
+    if not os.path.isdir(partial_dir):
+      return parts
+    for name in os.listdir(partial_dir):
+      if name.isdigit():
+        parts[int(name)] = os.path.getsize(os.path.join(partial_dir, name))
+    return parts
+
+  def upload_part(self, digest, index, data):
+    """Write one part, atomically, so a partial write is never reused."""
+    partial_dir = self._partial_dir(digest)
+    if not os.path.isdir(partial_dir):
+      try:
+        os.makedirs(partial_dir)
+      except OSError:
+        # Another worker may have created it first
+        if not os.path.isdir(partial_dir):
+          raise
+    part_path = self._part_path(digest, index)
+    temp_path = part_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+      f.write(data)
+    os.rename(temp_path, part_path)
+
+  def complete(self, digest, parts, size):
+    """Concatenate the parts, verify the digest and move the object in."""
+    object_path = self._object_path(digest)
+    object_dir = os.path.dirname(object_path)
+    if not os.path.isdir(object_dir):
+      os.makedirs(object_dir)
+    (handle, temp_path) = tempfile.mkstemp(dir=object_dir)
+    check = hashlib.sha256()
+    with os.fdopen(handle, 'wb') as f:
+      for index in range(parts):
+        with open(self._part_path(digest, index), 'rb') as part:
+          while True:
+            data = part.read(READ_SIZE)
+            if not data:
+              break
+            check.update(data)
+            f.write(data)
+    if check.hexdigest() != digest or os.path.getsize(temp_path) != size:
+      os.remove(temp_path)
+      shutil.rmtree(self._partial_dir(digest), ignore_errors=True)
+      raise StorageError('Uploaded parts of %s do not match its hash' % digest)
+    os.rename(temp_path, object_path)
+    shutil.rmtree(self._partial_dir(digest), ignore_errors=True)
+
+  def object_url(self, digest):
+    """Return the file:// URL of a stored object."""
+    return 'file://' + self._object_path(digest)
+
+
+BACKENDS = {
+  'file': LocalBackend,
+}
+
+
+def get_backend(url):
+  """Return the backend for a storage URL, based on its scheme."""
+  scheme = urlparse.urlparse(url).scheme or 'file'
+  if scheme not in BACKENDS:
+    raise StorageError('No storage backend for %s URLs' % scheme)
+  return BACKENDS[scheme](url)
+
+
+def _upload_part(args):
+  """Read one part of a file and upload it. Run by the worker pool."""
+  (backend, path, digest, index, chunk_size) = args
+  with open(path, 'rb') as f:
+    f.seek(index * chunk_size)
+    data = f.read(chunk_size)
+  backend.upload_part(digest, index, data)
+  return len(data)
+
+
+def upload_file(path, backend, chunk_size=CHUNK_SIZE, jobs=JOBS):
+  """Upload a file to the backend unless its content is already stored.
+
+  Returns a pointer dict with the digest, size and URL of the object, and
+  whether anything was actually uploaded.
+  """
+  (digest, size) = hash_file(path)
+  pointer = {
+    'sha256': digest,
+    'size': size,
+    'url': backend.object_url(digest),
+    'uploaded': False,
+  }
+  if backend.exists(digest):
+    return pointer
+  parts = part_count(size, chunk_size)
+  done = backend.uploaded_parts(digest)
+  todo = [
+    (backend, path, digest, index, chunk_size)
+    for index in range(parts)
+    if done.get(index) != part_size(index, size, chunk_size)
+  ]
+  if todo:
+    pool = ThreadPool(min(jobs, len(todo)))
+    try:
+      pool.map(_upload_part, todo)
+    finally:
+      pool.close()
+      pool.join()
+  backend.complete(digest, parts, size)
+  pointer['uploaded'] = True
+  pointer['resumed_parts'] = parts - len(todo)
+  return pointer
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3:
+    print >> sys.stderr, 'Usage: %s <storage URL> <file>' % sys.argv[0]
+    sys.exit(1)
+  print upload_file(sys.argv[2], get_backend(sys.argv[1]))
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""Deliver tasks/tickets in the background, off the recipe critical path.
+
+Tasks are written to a spool directory as soon as they are queued, one JSON
+file each, and a worker thread hands them to the delivery function. A task
+is only removed from the spool once it has been delivered, so tasks left
+behind by a crash or by an unreachable ticketing system are delivered on the
+next run. Tasks with the same title and description are only filed once.
+
+In digest mode nothing is delivered while the run goes on; when the queue is
+closed, everything queued is filed as a single summary task.
+"""
+
+import hashlib
+import json
+import os
+import Queue
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_SPOOL = '/Users/Shared/autopkg_tasks'
+# Delivery attempts per task, and the delay before the first retry
+RETRIES = 3
+BACKOFF = 5
+
+
+def task_key(title, description):
+  """Return the key used to de-duplicate tasks."""
+  return hashlib.sha1(
+    ('%s\n%s' % (title, description)).encode('utf-8')
+  ).hexdigest()
+
+
+class TaskQueue(object):
+  """Spool tasks to disk and deliver them from a background thread.
+
+  deliver is called as deliver(title, description) and must raise an
+  exception if the task could not be filed.
+  """
+
+  def __init__(self, deliver, spool_dir=DEFAULT_SPOOL, digest=False,
+               retries=RETRIES, backoff=BACKOFF):
+    self.deliver = deliver
+    self.spool_dir = spool_dir
+    self.digest = digest
+    self.retries = retries
+    self.backoff = backoff
+    self.delivered = set()
+    self.failed = []
+    self._queue = Queue.Queue()
+    self._pending = {}
+    self._lock = threading.Lock()
+    self._worker = None
+    if not os.path.isdir(spool_dir):
+      os.makedirs(spool_dir)
+
+  def _spool_path(self, key):
+    """Path of the spool file of a task."""
+    return os.path.join(self.spool_dir, '%s.json' % key)
+
+  def _write(self, task):
+    """Atomically write a task to the spool."""
+    (handle, temp_path) = tempfile.mkstemp(dir=self.spool_dir)
+    with os.fdopen(handle, 'wb') as f:
+      json.dump(task, f)
+    os.rename(temp_path, self._spool_path(task['key']))
+
+  def _remove(self, key):
+    """Remove a delivered task from the spool."""
+    try:
+      os.remove(self._spool_path(key))
+    except OSError:
+      pass
+
+  def start(self):
+    """Queue any tasks left in the spool and start the worker."""
+    for name in sorted(os.listdir(self.spool_dir)):
+      if not name.endswith('.json'):
+        continue
+      try:
+        with open(os.path.join(self.spool_dir, name), 'rb') as f:
+          task = json.load(f)
+      except (IOError, ValueError) as err:
+        print >> sys.stderr, "Skipping unreadable task %s: %s" % (name, err)
+        continue
+      self._enqueue(task)
+    if not self.digest:
+      self._worker = threading.Thread(target=self._run, name='task-queue')
+      self._worker.daemon = True
+      self._worker.start()
+
+  def _enqueue(self, task):
+    """Queue a task unless the same one is already pending or delivered."""
+    with self._lock:
+      if task['key'] in self._pending or task['key'] in self.delivered:
+        return False
+      self._pending[task['key']] = task
+    if not self.digest:
+      self._queue.put(task)
+    return True
+
+  def put(self, title, description):
+    """Spool a task for delivery. Returns False for duplicates."""
+    task = {
+      'key': task_key(title, description),
+      'title': title,
+      'description': description,
+      'queued': time.time(),
+    }
+    if task['key'] in self._pending or task['key'] in self.delivered:
+      return False
+    self._write(task)
+    return self._enqueue(task)
+
+  def _deliver(self, title, description):
+    """Deliver one task, retrying with backoff. Returns True on success."""
+    delay = self.backoff
+    for attempt in range(1, self.retries + 1):
+      try:
+        self.deliver(title, description)
+        return True
+      except Exception as err:  # pylint: disable=broad-except
+        print >> sys.stderr, "Filing task '%s' failed (attempt %d): %s" % (
+          title, attempt, err)
+        if attempt < self.retries:
+          time.sleep(delay)
+          delay *= 2
+    return False
+
+  def _run(self):
+    """Worker loop: deliver queued tasks until a None is queued."""
+    while True:
+      task = self._queue.get()
+      if task is None:
+        break
+      if self._deliver(task['title'], task['description']):
+        self._remove(task['key'])
+        with self._lock:
+          self.delivered.add(task['key'])
+          del self._pending[task['key']]
+      else:
+        # Left in the spool for the next run
+        with self._lock:
+          self.failed.append(task)
+          del self._pending[task['key']]
+
+  def digest_task(self, tasks):
+    """Return the title and description of a summary of tasks."""
+    title = "AutoPkg run summary: %d items" % len(tasks)
+    description = '\n\n'.join(
+      '%s\n%s' % (task['title'], task['description']) for task in tasks
+    )
+    return (title, description)
+
+  def close(self):
+    """Deliver everything still queued and stop the worker."""
+    if self.digest:
+      tasks = sorted(self._pending.values(), key=lambda task: task['queued'])
+      if tasks and self._deliver(*self.digest_task(tasks)):
+        for task in tasks:
+          self._remove(task['key'])
+          self.delivered.add(task['key'])
+        self._pending = {}
+      else:
+        self.failed.extend(tasks)
+      return
+    if self._worker:
+      self._queue.put(None)
+      self._worker.join()
@@ -3,11 +3,12 @@
 
 import sys
 import imp
-import subprocess
 import os
 import json
 import time
 import argparse
+import socket
+import sqlite3
 
 try:
   from Foundation import NSDate
@@ -34,19 +35,68 @@ except ImportError:
   print "Can't find autopkglib!"
   sys.exit(1)
 
-imp.load_source('autopkg', '/usr/local/bin/autopkg')
+# Append the shared CPE modules to the Python path
+sys.path.append('/Library/CPE/lib/flib/modules')
+try:
+  import process_tools
+except ImportError:
+  print "Can't find process_tools!"
+  sys.exit(1)
+
+AUTOPKG = '/usr/local/bin/autopkg'
+# Load the autopkg command as a module, unless one was already provided
+if 'autopkg' not in sys.modules:
+  imp.load_source('autopkg', AUTOPKG)
 try:
   import autopkg
 except ImportError:
   print "Can't import autopkg!"
   sys.exit(1)
 
+import autopkg_history
+import autopkg_maintenance
+import autopkg_recipes
+import autopkg_reports
+import autopkg_shard
+import autopkg_tasks
+import autopkg_storage
+
 GIT = '/usr/bin/git'
+HOSTNAME = None
 VERBOSE = 0
 REPO_DIR = '/Users/Shared/autopkg'
 USE_ARCANIST = False
 DEV = False
 BUNDLE_ID = 'com.facebook.CPE.autopkg'
+HISTORY_DB = autopkg_history.DEFAULT_DB
+RUN_ID = None
+GIT_REPO = None
+RECIPE_INDEX = None
+BINARY_STORAGE = None
+# Seconds a recipe may run for in total, and without printing anything.
+# 0 disables the limit. AutoPkg is quiet while downloading, so the idle
+# limit is off by default.
+RECIPE_TIMEOUT = 7200
+RECIPE_IDLE_TIMEOUT = 0
+# Remote to push import branches to, None to leave them local
+PUSH_REMOTE = None
+# Background queue that tasks are filed through, None to file them inline
+TASK_QUEUE = None
+# In batch mode, the one branch every import of the run is committed to
+BATCH_BRANCH = None
+# Directory the report plists and summary of each run are written to, in a
+# directory per run ID. None puts it next to AutoPkg's RECIPE_REPO_DIR.
+REPORT_DIR = None
+RUN_SUMMARY = None
+
+# Keys of the Munki import summary, and the Munki repo directory they are in
+IMPORTED_PATH_KEYS = [
+  ('pkginfo_path', 'pkgsinfo'),
+  ('pkg_repo_path', 'pkgs'),
+  ('icon_repo_path', 'icons'),
+]
+# Small Munki repo directories that an import can change
+MUNKI_METADATA_DIRS = ['pkgsinfo', 'catalogs', 'icons']
 
 
 class Error(Exception):
@@ -69,10 +119,33 @@ class RunlistError(Error):
   """Unable to read the runlist."""
 
 
+class RecipeTimeoutError(RunError):
+  """A recipe ran longer than its time limit."""
+
+
 # AutoPkg recipe-handling
+def recipe_index():
+  """Return the recipe index for this run, rebuilding it if it's stale."""
+  global RECIPE_INDEX
+  if RECIPE_INDEX is None:
+    RECIPE_INDEX = autopkg_recipes.RecipeIndex(
+      autopkg.get_override_dirs(),
+      autopkg.get_search_dirs(),
+    )
+  elif RECIPE_INDEX.is_stale():
+    display_verbose("Recipe directories changed, rebuilding recipe index")
+    RECIPE_INDEX.build()
+  return RECIPE_INDEX
+
+
 def parent_recipes(identifier):
   """Get the list of all recipe files for a given identifier."""
   # display_verbose("Calling parent_recipes for %s" % identifier)
+  pathlist = recipe_index().recipe_chain(identifier)
+  if pathlist:
+    display_verbose("List of recipe files: %s" % pathlist)
+    return pathlist
+  # Not in the index, let AutoPkg have a go at it
   recipe = autopkg.load_recipe(
     identifier,
     autopkg.get_override_dirs(),
@@ -81,7 +154,6 @@ def parent_recipes(identifier):
     search_github=False,
   )
   # Recipes that don't exist will still have no parents
-  pathlist = []
   if recipe:
     pathlist = recipe.get('PARENT_RECIPES', [])
     pathlist.append(recipe.get('RECIPE_PATH'))
@@ -90,27 +162,45 @@ def parent_recipes(identifier):
   return []
 
 
+def recipe_branch_name(identifier):
+  """Return the name of the branches a recipe's imports are made on."""
+  return identifier.split('.munki')[0]
+
+
 def parse_recipe_name(identifier):
   """Get the name of the recipe."""
   # display_verbose("Calling parse_recipe_name")
-  branch = identifier.split('.munki')[0]
+  branch = recipe_branch_name(identifier)
   # Check to see if branch name already exists
-  current_branches = branch_list()
-  if branch in current_branches:
+  if git_repo().has_branch(branch):
     # If the same name already exists, append a '-2' to it
     branch += '-2'
   return branch
 
 
 # Convenience utilities
+def hostname():
+  """Return the host name used in log lines, looked up once per run."""
+  global HOSTNAME
+  if HOSTNAME is None:
+    try:
+      HOSTNAME = run_cmd(
+        ['/usr/sbin/scutil', '--get', 'HostName']
+      )['stdout'].strip()
+    except OSError:
+      # No scutil, not on macOS
+      HOSTNAME = ''
+    HOSTNAME = HOSTNAME or socket.gethostname()
+  return HOSTNAME
+
+
 def timeprint(message, newline=True):
   """Print out message with a timestamp."""
-  hostname = run_cmd(['/usr/sbin/scutil', '--get', 'HostName'])['stdout']
   tag = 'autopkg_tools'
   current_time = time.strftime("%c")
   content = '%s %s %s: %s' % (
     current_time,
-    hostname.rstrip(),
+    hostname(),
     tag,
     str(message)
   )
@@ -122,42 +212,28 @@ def timeprint(message, newline=True):
 
 def run_cmd(cmd):
   """Run a command and return the output."""
-  proc = subprocess.Popen(
-    cmd,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.PIPE
-  )
-  (out, err) = proc.communicate()
-  results_dict = {
-    'stdout': out,
-    'stderr': err,
-    'status': proc.returncode,
-    'success': proc.returncode == 0
-  }
-  return results_dict
+  return process_tools.run(cmd)
 
 
-def run_live(command):
+def run_live(command, timeout=None, idle_timeout=None):
   """
   Run a subprocess with real-time output.
 
+  If it runs longer than timeout seconds, or prints nothing for idle_timeout
+  seconds, its whole process group is killed and RecipeTimeoutError is
+  raised.
+
   Returns only the return-code.
   """
-  # Validate that command is not a string
-  if isinstance(command, basestring):
-    # Not an array!
-    raise TypeError('Command must be an array')
-  # Run the command
-  proc = subprocess.Popen(command,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.STDOUT)
-  while proc.poll() is None:
-    l = proc.stdout.readline()
-    timeprint(l, newline=False)
-  leftover = proc.stdout.read()
-  for line in leftover.splitlines():
-    timeprint(line)
-  return proc.returncode
+  try:
+    return process_tools.run_live(
+      command,
+      timeout=timeout,
+      idle_timeout=idle_timeout,
+      on_line=lambda job, line: timeprint(line)
+    )
+  except process_tools.ProcessTimeoutError as err:
+    raise RecipeTimeoutError(str(err))
 
 
 def display_verbose(content):
@@ -188,6 +264,77 @@ def read_preferences(args):
     bool(args.arc or get_pref('UseArcanist')) or
     False
   )
+  # Equivalent to --storage
+  prefs_dict['binary_storage'] = (
+    args.storage or
+    get_pref('BinaryStorage') or
+    None
+  )
+  # Equivalent to --timeout
+  prefs_dict['timeout'] = args.timeout
+  if prefs_dict['timeout'] is None:
+    prefs_dict['timeout'] = get_pref('RecipeTimeout')
+  # Equivalent to --idle-timeout
+  prefs_dict['idle_timeout'] = args.idle_timeout
+  if prefs_dict['idle_timeout'] is None:
+    prefs_dict['idle_timeout'] = get_pref('RecipeIdleTimeout')
+  # Equivalent to --batch
+  prefs_dict['batch'] = (
+    bool(args.batch or get_pref('BatchMode')) or
+    False
+  )
+  # Equivalent to --maintain
+  prefs_dict['maintain'] = (
+    bool(args.maintain or get_pref('Maintenance')) or
+    False
+  )
+  # Equivalent to --branch-max-age
+  prefs_dict['branch_max_age'] = args.branch_max_age
+  if prefs_dict['branch_max_age'] is None:
+    prefs_dict['branch_max_age'] = get_pref('BranchMaxAge')
+  if prefs_dict['branch_max_age'] is None:
+    prefs_dict['branch_max_age'] = autopkg_maintenance.MAX_AGE
+  # Equivalent to --push
+  prefs_dict['push_remote'] = (
+    args.push or
+    get_pref('PushRemote') or
+    None
+  )
+  # Equivalent to --shard-weights
+  prefs_dict['shard_weights'] = (
+    args.shard_weights or
+    get_pref('ShardWeights') or
+    None
+  )
+  # Equivalent to --shard-status
+  prefs_dict['shard_status'] = (
+    args.shard_status or
+    get_pref('ShardStatusDir') or
+    None
+  )
+  # Equivalent to --task-spool
+  prefs_dict['task_spool'] = (
+    args.task_spool or
+    get_pref('TaskSpoolDir') or
+    autopkg_tasks.DEFAULT_SPOOL
+  )
+  # Equivalent to --task-digest
+  prefs_dict['task_digest'] = (
+    bool(args.task_digest or get_pref('TaskDigest')) or
+    False
+  )
+  # Equivalent to --report-dir
+  prefs_dict['report_dir'] = (
+    args.report_dir or
+    get_pref('ReportDir') or
+    None
+  )
+  # Equivalent to --history
+  prefs_dict['history_db'] = (
+    args.history or
+    get_pref('HistoryDB') or
+    autopkg_history.DEFAULT_DB
+  )
   return prefs_dict
 
 
@@ -248,31 +395,189 @@ def git_run(arglist):
   return results['stdout']
 
 
+class GitRepo(object):
+  """Cached view of the branches in a git repo.
+
+  Refs are read once, straight from the git directory (loose refs and
+  packed-refs), and the cache is updated in place as branches are created,
+  renamed, deleted or checked out through this object. Anything that fails
+  drops the cache so it is re-read on the next access.
+  """
+
+  def __init__(self, path=None):
+    self.path = path or os.getcwd()
+    self._git_dir = None
+    self._branches = None
+    self._head = None
+
+  @property
+  def git_dir(self):
+    """Absolute path to the .git directory of the repo."""
+    if self._git_dir is None:
+      git_dir = git_run(['rev-parse', '--git-dir']).strip()
+      self._git_dir = os.path.join(self.path, git_dir)
+    return self._git_dir
+
+  def invalidate(self):
+    """Forget the cached refs, so they are re-read on next access."""
+    self._branches = None
+    self._head = None
+
+  def _read_packed_refs(self):
+    """Return the branch names listed in packed-refs."""
+    branches = set()
+    packed_refs = os.path.join(self.git_dir, 'packed-refs')
+    if not os.path.isfile(packed_refs):
+      return branches
+    with open(packed_refs, 'rb') as f:
+      for line in f:
+        if line.startswith('#') or line.startswith('^'):
+          continue
+        parts = line.strip().split(' ', 1)
+        if len(parts) == 2 and parts[1].startswith('refs/heads/'):
+          branches.add(parts[1][len('refs/heads/'):])
+    return branches
+
+  def _read_loose_refs(self):
+    """Return the branch names stored as loose ref files."""
+    branches = set()
+    heads_dir = os.path.join(self.git_dir, 'refs', 'heads')
+    for root, dummy_dirs, files in os.walk(heads_dir):
+      for ref in files:
+        if ref.endswith('.lock'):
+          continue
+        branches.add(
+          os.path.relpath(os.path.join(root, ref), heads_dir)
+        )
+    return branches
+
+  def _read_head(self):
+    """Return the checked out branch name, or None if HEAD is detached."""
+    with open(os.path.join(self.git_dir, 'HEAD'), 'rb') as f:
+      head = f.read().strip()
+    if head.startswith('ref: refs/heads/'):
+      return head[len('ref: refs/heads/'):]
+    return None
+
+  def refresh(self):
+    """Read all branches and HEAD from the git directory."""
+    try:
+      self._branches = self._read_packed_refs() | self._read_loose_refs()
+      self._head = self._read_head()
+    except (IOError, OSError):
+      # Fall back to asking git, in a single process each
+      output = git_run(
+        ['for-each-ref', '--format=%(refname:short)', 'refs/heads']
+      )
+      self._branches = set(output.split())
+      self._head = str(git_run(['symbolic-ref', '--short', 'HEAD']).strip())
+
+  @property
+  def branches(self):
+    """Set of local branch names."""
+    if self._branches is None:
+      self.refresh()
+    return self._branches
+
+  @property
+  def head(self):
+    """Name of the checked out branch."""
+    if self._branches is None:
+      self.refresh()
+    return self._head
+
+  def has_branch(self, branch):
+    """Return True if the local branch exists."""
+    return branch in self.branches
+
+  def checkout(self, branch, new=False, start_point=None):
+    """Check out a branch, optionally creating it from start_point."""
+    gitcmd = ['checkout']
+    if new:
+      gitcmd.append('-b')
+    gitcmd.append(branch)
+    if new and start_point:
+      gitcmd.append(start_point)
+    try:
+      git_run(gitcmd)
+    except GitError:
+      self.invalidate()
+      raise
+    if self._branches is not None:
+      self._branches.add(branch)
+      self._head = branch
+
+  def switched(self, branch):
+    """Record a checkout that happened outside of this object."""
+    if self._branches is not None:
+      self._branches.add(branch)
+      self._head = branch
+
+  def rename_branch(self, old_name, new_name):
+    """Rename a local branch."""
+    try:
+      git_run(['branch', '-m', old_name, new_name])
+    except GitError:
+      self.invalidate()
+      raise
+    if self._branches is not None:
+      self._branches.discard(old_name)
+      self._branches.add(new_name)
+      if self._head == old_name:
+        self._head = new_name
+
+  def delete_branches(self, branches):
+    """Force-delete local branches, all in a single git process."""
+    if not branches:
+      return ''
+    try:
+      results = git_run(['branch', '-D'] + list(branches))
+    except GitError:
+      self.invalidate()
+      raise
+    if self._branches is not None:
+      self._branches.difference_update(branches)
+    return results
+
+
+def git_repo():
+  """Return the GitRepo for the current working directory."""
+  global GIT_REPO
+  if GIT_REPO is None or GIT_REPO.path != os.getcwd():
+    GIT_REPO = GitRepo()
+  return GIT_REPO
+
+
 def current_branch():
   """Return the name of the current git branch."""
-  git_args = ['symbolic-ref', '--short', 'HEAD']
-  return str(git_run(git_args).strip())
+  return git_repo().head
 
 
 def branch_list():
   """Get the list of current git branches."""
-  git_args = ['branch']
-  branch_output = git_run(git_args).rstrip()
-  if branch_output:
-    return [x.strip().strip('* ') for x in branch_output.split('\n')]
-  return []
+  return sorted(git_repo().branches)
 
 
 def create_feature_branch(branch):
   """Create new feature branch."""
   # display_verbose("Calling create_feature_branch: %s" % branch)
-  if current_branch() != 'master':
-    # Switch to master first if we're not already there
-    display_verbose('Switching to master')
-    change_feature_branch('master')
-  # Now create new branch
+  if USE_ARCANIST:
+    if current_branch() != 'master':
+      # Switch to master first if we're not already there
+      display_verbose('Switching to master')
+      change_feature_branch('master')
+    # Now create new branch
+    display_verbose("Creating branch %s" % branch)
+    change_feature_branch(branch, new=True)
+    return
+  # Create the branch from master with a single checkout
   display_verbose("Creating branch %s" % branch)
-  change_feature_branch(branch, new=True)
+  try:
+    git_repo().checkout(branch, new=True, start_point='master')
+  except GitError as e:
+    raise BranchError(
+      "Couldn't switch to '%s': %s" % (branch, e)
+    )
 
 
 def change_feature_branch(branch, new=False):
@@ -282,16 +587,17 @@ def change_feature_branch(branch, new=False):
     arccmd.append(branch)
     results = run_cmd(arccmd)
     if not results['success']:
+      git_repo().invalidate()
       raise BranchError(
         "Couldn't switch to '%s': %s" % (branch, results['stderr'])
       )
+    git_repo().switched(branch)
   else:
-    gitcmd = ['checkout']
-    if new:
-      gitcmd.append('-b')
-    gitcmd.append(branch)
+    if not new and current_branch() == branch:
+      # Already there, nothing to do
+      return
     try:
-      git_run(gitcmd)
+      git_repo().checkout(branch, new=new)
     except GitError as e:
       raise BranchError(
         "Couldn't switch to '%s': %s" % (branch, e)
@@ -303,29 +609,173 @@ def cleanup_branch(branch):
   # Swap back to 'master' first
   change_feature_branch('master')
   # Delete the branch
-  gitcmd = ['branch', '-D', branch]
-  results = git_run(gitcmd)
+  results = git_repo().delete_branches([branch])
   display_verbose("Deleting branch %s: %s" % (branch, results))
 
 
 def rename_branch_version(branch, version):
   """Rename a branch to include the version."""
   new_branch_name = branch + "-%s" % version
-  if new_branch_name in branch_list():
+  if git_repo().has_branch(new_branch_name):
     timeprint("Branch %s already exists" % new_branch_name)
     new_branch_name += '-2'
-  gitcmd = ['branch', '-m', branch, new_branch_name]
-  git_run(gitcmd)
+  git_repo().rename_branch(branch, new_branch_name)
   display_verbose("Renaming %s to %s" % (branch, new_branch_name))
+  return new_branch_name
+
+
+def push_branch(branch):
+  """Push an import branch to PUSH_REMOTE.
+
+  A failed push files a task instead of stopping the run; the commits stay
+  on the local branch, so it can be pushed by hand. Returns True if pushed.
+  """
+  timeprint("Pushing %s to %s" % (branch, PUSH_REMOTE))
+  try:
+    git_run(['push', PUSH_REMOTE, branch])
+  except GitError as err:
+    task_title = "Branch %s could not be pushed to %s." % (
+      branch, PUSH_REMOTE)
+    timeprint("Failure: %s" % task_title)
+    queue_task(task_title, "Error: %s" % err)
+    return False
+  return True
+
+
+def create_run_branch(shard=None):
+  """Create the branch a batch run commits every import to.
+
+  Sharded runs share a run ID, so the shard is part of the branch name to
+  keep the hosts from pushing to the same branch.
+  """
+  branch = 'autopkg-run-%s' % RUN_ID
+  if shard:
+    branch += '-shard%d' % shard[0]
+  if git_repo().has_branch(branch):
+    branch += '-2'
+  timeprint("Committing this run's imports to %s" % branch)
+  create_feature_branch(branch)
+  return branch
+
+
+def finish_run_branch(branch):
+  """Push the run branch if anything was imported, otherwise remove it.
+
+  Returns the number of imports committed to the branch.
+  """
+  commits = int(git_run(['rev-list', '--count', 'master..%s' % branch]))
+  if not commits:
+    timeprint("Nothing was imported, removing %s" % branch)
+    cleanup_branch(branch)
+    return 0
+  timeprint("%d imports committed to %s" % (commits, branch))
+  if PUSH_REMOTE and not USE_ARCANIST:
+    push_branch(branch)
+  change_feature_branch('master')
+  return commits
+
+
+def run_maintenance(max_age, recipes):
+  """Prune stale branches and repack the repo, reporting what changed.
+
+  Only run branches and the branches of the given recipes are pruned,
+  including the -2 and version suffixes they get.
+  """
+  timeprint('Running git maintenance...')
+  prune = []
+  for recipe in recipes:
+    name = recipe_branch_name(recipe)
+    prune.extend([name, name + '-*'])
+  # Time listing branches the way branch_list does, without the cache
+  view = GitRepo(REPO_DIR)
+  try:
+    report = autopkg_maintenance.maintain(
+      REPO_DIR,
+      max_age=max_age,
+      lister=lambda repo: view.refresh(),
+      prune=prune
+    )
+  except autopkg_maintenance.Error as err:
+    # Maintenance can wait for the next run
+    timeprint("Git maintenance failed: %s" % err)
+    return
+  finally:
+    git_repo().invalidate()
+  for line in autopkg_maintenance.report_lines(report):
+    timeprint(line)
 
 
-def create_commit(imported_item):
-  """Create git commit."""
+def munki_repo_dir():
+  """Return the Munki repo directory inside the git repo."""
+  munki_repo = autopkglib.get_pref('MUNKI_REPO')
+  if munki_repo:
+    munki_repo = os.path.realpath(munki_repo)
+    if munki_repo.startswith(os.path.realpath(REPO_DIR)):
+      return munki_repo
+  return REPO_DIR
+
+
+def imported_paths(imported_item, include_pkg=True):
+  """Return the repo paths an imported item may have touched.
+
+  The import summary reports the pkginfo, package and icon relative to their
+  directories in the Munki repo. The metadata directories are included as
+  well so that catalogs, or anything else the import changed, are not missed.
+  Without include_pkg, the package is left out, such as when it was uploaded
+  to binary storage instead.
+  """
+  munki_repo = munki_repo_dir()
+  paths = []
+  for key, subdir in IMPORTED_PATH_KEYS:
+    if key == 'pkg_repo_path' and not include_pkg:
+      continue
+    if imported_item.get(key):
+      paths.append(os.path.join(munki_repo, subdir, imported_item[key]))
+  for subdir in MUNKI_METADATA_DIRS:
+    paths.append(os.path.join(munki_repo, subdir))
+  return paths
+
+
+def changed_paths(pathspecs):
+  """Return the changed and untracked paths under the given pathspecs.
+
+  Only the given paths are examined, so this doesn't scale with the size of
+  the whole repo. Paths are returned relative to the top of the git repo.
+  """
+  gitcmd = ['status', '--porcelain', '-z', '--untracked-files=all', '--']
+  gitcmd.extend(pathspecs)
+  entries = git_run(gitcmd).split('\0')
+  paths = []
+  index = 0
+  while index < len(entries):
+    entry = entries[index]
+    index += 1
+    if len(entry) < 4:
+      continue
+    paths.append(entry[3:])
+    if entry[0] in 'RC':
+      # Staged renames and copies are followed by the original path,
+      # which is already taken care of in the index
+      index += 1
+  return paths
+
+
+def create_commit(imported_item, stored=False):
+  """Create git commit.
+
+  If the package was uploaded to binary storage (stored), only its pkginfo
+  pointer is committed, not the package itself.
+  """
   os.chdir(REPO_DIR)
   timeprint('Adding items...')
-  gitaddcmd = ['add']
-  gitaddcmd.append(REPO_DIR)
-  git_run(gitaddcmd)
+  paths = changed_paths(
+    imported_paths(imported_item, include_pkg=not stored))
+  display_verbose("Changed paths: %s" % paths)
+  if paths:
+    # Status paths are relative to the top of the repo, not REPO_DIR
+    gitaddcmd = ['add', '-A', '--']
+    gitaddcmd.extend(':(top)%s' % path for path in paths)
+    git_run(gitaddcmd)
   # Create the commit
   timeprint('Creating commit...')
   gitcommitcmd = ['commit', '-m']
@@ -343,9 +793,18 @@ def create_task(task_title, task_description):
     return
   # ****
   # Provide code here for filing tickets/tasks to your system
+  # Raise an exception if the task couldn't be filed, so it is retried.
   # ****
 
 
+def queue_task(task_title, task_description):
+  """Queue a task for the background worker, or file it right away."""
+  if TASK_QUEUE:
+    TASK_QUEUE.put(task_title, task_description)
+  else:
+    create_task(task_title, task_description)
+
+
 def imported_task(imported_item):
   """File a task for a package being imported into Munki."""
   task_title = (
@@ -358,7 +817,7 @@ def imported_task(imported_item):
     "Pkginfo Path: %s \n" % imported_item['pkginfo_path'] +
     "Version: %s" % str(imported_item['version'])
   )
-  create_task(task_title, task_description)
+  queue_task(task_title, task_description)
 
 
 def failed_task(failed_items):
@@ -367,30 +826,61 @@ def failed_task(failed_items):
     task_title = "Autopkg recipe %s failed to run." % item['recipe']
     timeprint("Failure: %s" % task_title)
     task_description = "Error: %s" % item['message']
-    create_task(task_title, task_description)
+    queue_task(task_title, task_description)
 
 
 # Middleware functions
 def binary_middleware(imported_item):
-  """Handle any middleware operations on the imported products."""
-  # ****
-  # This code is designed to handle anything you need/want to do
-  # to the imported binaries as part of the commit process.
-  # Upload to Amazon S3, or git-fat, etc.
-  # ****
+  """Handle any middleware operations on the imported products.
+
+  If a BinaryStorage URL is configured, the imported package is uploaded to
+  content-addressed storage and the pointer is recorded in its pkginfo.
+  Other handling (git-fat, etc.) can be added here. Returns True if the
+  package was stored, so it isn't committed.
+  """
+  if not BINARY_STORAGE or not imported_item.get('pkg_repo_path'):
+    return False
+  munki_repo = munki_repo_dir()
+  pkg_path = os.path.join(munki_repo, 'pkgs', imported_item['pkg_repo_path'])
+  pkginfo_path = os.path.join(
+    munki_repo, 'pkgsinfo', imported_item['pkginfo_path']
+  )
+  timeprint('Uploading %s to binary storage...' % pkg_path)
+  try:
+    backend = autopkg_storage.get_backend(BINARY_STORAGE)
+    pointer = autopkg_storage.upload_file(pkg_path, backend)
+  except (autopkg_storage.StorageError, IOError, OSError) as err:
+    raise RunError("Binary upload of %s failed: %s" % (pkg_path, err))
+  if pointer['uploaded']:
+    timeprint('Uploaded %s bytes as %s' % (pointer['size'], pointer['sha256']))
+  else:
+    timeprint('Content already stored as %s' % pointer['sha256'])
+  pkginfo = FoundationPlist.readPlist(pkginfo_path)
+  pkginfo[autopkg_storage.POINTER_KEY] = {
+    'sha256': pointer['sha256'],
+    'size': pointer['size'],
+    'url': pointer['url'],
+  }
+  FoundationPlist.writePlist(pkginfo, pkginfo_path)
+  return True
 
 
 # Autopkg execution functions
-def run_recipe(recipe, report_plist_path, pkg_path=None):
+def run_recipe(recipe, report_plist_path, pkg_path=None, options=None):
   """Execute autopkg on a recipe, creating report plist."""
-  cmd = ['/usr/local/bin/autopkg', 'run', '-v']
+  options = options or {}
+  cmd = [AUTOPKG, 'run', '-v']
   cmd.append(recipe)
   if pkg_path:
     cmd.append('-p')
     cmd.append(pkg_path)
   cmd.append('--report-plist')
   cmd.append(report_plist_path)
-  run_live(cmd)
+  run_live(
+    cmd,
+    timeout=options.get('timeout', RECIPE_TIMEOUT),
+    idle_timeout=options.get('idle_timeout', RECIPE_IDLE_TIMEOUT)
+  )
   # https://github.com/autopkg/autopkg/issues/296
   # Currently, AutoPkg returns the number of failed recipes when it executes
   # so we can't use return code to see if it faulted
@@ -401,67 +891,203 @@ def run_recipe(recipe, report_plist_path, pkg_path=None):
 
 def parse_report_plist(report_plist_path):
   """Parse the report plist path for a dict of the results."""
-  imported_items = []
-  failed_items = []
-  report_data = FoundationPlist.readPlist(report_plist_path)
-  if report_data['summary_results']:
-    # This means something happened
-    munki_results = report_data['summary_results'].get(
-      'munki_importer_summary_result', {}
-    )
-    for imported_item in munki_results.get('data_rows', []):
-      imported_items.append(imported_item)
-  if report_data['failures']:
-    # This means something went wrong
-    for failed_item in report_data['failures']:
-      # For each recipe that failed, file a task
-      failed_items.append(failed_item)
-  return {
-    'imported': imported_items,
-    'failed': failed_items
-  }
+  return autopkg_reports.read_report(report_plist_path)
 
 
-def handle_recipe(recipe, pkg_path=None):
-  """Handle the complete workflow of an autopkg recipe."""
-  display_verbose("Handling %s" % recipe)
-  report_plist_path = os.path.join(
+def run_report_dir():
+  """Return the directory the reports of this run are written to."""
+  report_dir = REPORT_DIR or os.path.join(
     os.path.dirname(autopkglib.get_pref('RECIPE_REPO_DIR')),
-    'autopkg.plist'
+    'reports'
   )
-  # 1. Syncing is no longer implemented
+  return os.path.join(report_dir, str(RUN_ID))
+
+
+def report_plist_path(recipe):
+  """Return the report plist path of a recipe, unique to this run."""
+  report_dir = run_report_dir()
+  if not os.path.isdir(report_dir):
+    os.makedirs(report_dir)
+  path = os.path.join(report_dir, autopkg_reports.report_name(recipe))
+  if os.path.exists(path):
+    # Don't read a report left by an earlier run of the same recipe
+    os.remove(path)
+  return path
+
+
+def run_summary():
+  """Return the summary of this run, which is updated as recipes finish."""
+  global RUN_SUMMARY
+  if RUN_SUMMARY is None:
+    RUN_SUMMARY = autopkg_reports.RunSummary(
+      run_report_dir(), RUN_ID, hostname()
+    )
+  return RUN_SUMMARY
+
+
+# Run history functions
+def downloaded_bytes(download_paths):
+  """Return the total size of the downloaded files that still exist."""
+  total = 0
+  for path in download_paths:
+    if os.path.isfile(path):
+      total += os.path.getsize(path)
+  return total
+
+
+def save_history(record, outcome, results=None):
+  """Finish a run record, and add it to the history and the run summary."""
+  autopkg_history.finish_record(record, outcome)
+  display_verbose(
+    "%s finished in %.1f seconds: %s" % (
+      record['recipe'], record['duration'], outcome)
+  )
+  if HISTORY_DB:
+    try:
+      autopkg_history.record_run(record, HISTORY_DB)
+    except (sqlite3.Error, OSError) as err:
+      # History is informational, never fail the run because of it
+      timeprint("Unable to record run history: %s" % err)
+  try:
+    run_summary().add(record['recipe'], outcome, results, record['duration'])
+  except (IOError, OSError) as err:
+    timeprint("Unable to update run summary: %s" % err)
+
+
+def discard_changes(paths=None):
+  """Throw away anything a killed recipe left in the working tree.
+
+  Untracked files are removed from the metadata directories, and from any
+  other paths given, such as an imported package.
+  """
+  git_run(['reset', '--hard'])
+  munki_repo = munki_repo_dir()
+  git_run(
+    ['clean', '-f', '-d', '--'] +
+    [os.path.join(munki_repo, subdir) for subdir in MUNKI_METADATA_DIRS] +
+    list(paths or [])
+  )
+
+
+def handle_recipe(recipe, pkg_path=None, options=None):
+  """Handle the complete workflow of an autopkg recipe.
+
+  Returns the outcome recorded in the run history.
+  """
+  display_verbose("Handling %s" % recipe)
+  record = autopkg_history.new_record(recipe, RUN_ID, hostname())
+  report_path = report_plist_path(recipe)
+  # 1. Syncing is no longer implemented, but make sure the recipe and its
+  # parents can be found, using the recipe index shared by the whole run
+  if not parent_recipes(recipe):
+    message = "Recipe %s could not be found" % recipe
+    record['failures'] = 1
+    record['failure_message'] = message
+    failed_task([{'recipe': recipe, 'message': message}])
+    save_history(
+      record, autopkg_history.OUTCOME_FAILED,
+      {'imported': [], 'failed': [{'message': message}], 'downloaded': []}
+    )
+    return autopkg_history.OUTCOME_FAILED
   # 2. Parse recipe name for basic item name
-  branchname = parse_recipe_name(recipe)
-  # 3. Create feature branch
-  create_feature_branch(branchname)
+  phase_start = time.time()
+  if BATCH_BRANCH:
+    # Everything goes on the run branch, which is already checked out
+    branchname = BATCH_BRANCH
+  else:
+    branchname = parse_recipe_name(recipe)
+    # 3. Create feature branch
+    create_feature_branch(branchname)
+  record['branch_time'] = time.time() - phase_start
   # 4. Run autopkg for that recipe
-  run_recipe(recipe, report_plist_path, pkg_path)
+  phase_start = time.time()
+  try:
+    run_recipe(recipe, report_path, pkg_path, options)
+  except RecipeTimeoutError as err:
+    # Don't let one hung recipe hold up the rest of the runlist
+    record['autopkg_time'] = time.time() - phase_start
+    record['failures'] = 1
+    record['failure_message'] = str(err)
+    failed_task([{'recipe': recipe, 'message': str(err)}])
+    discard_changes()
+    if not BATCH_BRANCH:
+      cleanup_branch(branchname)
+    save_history(
+      record, autopkg_history.OUTCOME_TIMEOUT,
+      {'imported': [], 'failed': [{'message': str(err)}], 'downloaded': []}
+    )
+    return autopkg_history.OUTCOME_TIMEOUT
+  record['autopkg_time'] = time.time() - phase_start
   # 5. Parse report plist
-  run_results = parse_report_plist(report_plist_path)
+  if os.path.isfile(report_path):
+    run_results = parse_report_plist(report_path)
+  else:
+    run_results = {
+      'imported': [],
+      'failed': [{'recipe': recipe, 'message': 'AutoPkg wrote no report'}],
+      'downloaded': [],
+    }
+  record['bytes_downloaded'] = downloaded_bytes(run_results['downloaded'])
   if not run_results['imported'] and not run_results['failed']:
     # Nothing happened
-    cleanup_branch(branchname)
-    return
+    if not BATCH_BRANCH:
+      cleanup_branch(branchname)
+    save_history(record, autopkg_history.OUTCOME_NOCHANGE, run_results)
+    return autopkg_history.OUTCOME_NOCHANGE
   if run_results['failed']:
     # Item failed, so file a task
+    record['failures'] = len(run_results['failed'])
+    record['failure_message'] = '\n'.join(
+      str(item.get('message')) for item in run_results['failed']
+    )
     failed_task(run_results['failed'])
-    cleanup_branch(branchname)
-    return
+    if BATCH_BRANCH:
+      # Keep a half-finished import out of the next recipe's commit
+      discard_changes()
+    else:
+      cleanup_branch(branchname)
+    save_history(record, autopkg_history.OUTCOME_FAILED, run_results)
+    return autopkg_history.OUTCOME_FAILED
   if run_results['imported']:
     # Item succeeded, so continue.
+    record['version'] = str(run_results['imported'][0]['version'])
+    phase_start = time.time()
     # 6. Run any binary-handling middleware
-    binary_middleware(run_results['imported'][0])
+    try:
+      stored = binary_middleware(run_results['imported'][0])
+    except RunError as err:
+      # Leave nothing of the import behind, and go on to the next recipe
+      record['commit_time'] = time.time() - phase_start
+      record['failures'] = 1
+      record['failure_message'] = str(err)
+      failed_task([{'recipe': recipe, 'message': str(err)}])
+      discard_changes(imported_paths(run_results['imported'][0]))
+      if not BATCH_BRANCH:
+        cleanup_branch(branchname)
+      save_history(
+        record, autopkg_history.OUTCOME_FAILED,
+        {'imported': [], 'failed': [{'message': str(err)}],
+         'downloaded': run_results['downloaded']}
+      )
+      return autopkg_history.OUTCOME_FAILED
     # 7. If any changes occurred, create git commit
-    create_commit(run_results['imported'][0])
-    # 8. Rename branch with version
-    rename_branch_version(
-      branchname,
-      str(run_results['imported'][0]['version'])
-    )
+    create_commit(run_results['imported'][0], stored)
+    if not BATCH_BRANCH:
+      # 8. Rename branch with version
+      branchname = rename_branch_version(
+        branchname,
+        str(run_results['imported'][0]['version'])
+      )
+      if PUSH_REMOTE and not USE_ARCANIST:
+        push_branch(branchname)
+    record['commit_time'] = time.time() - phase_start
     # 9. File a task
     imported_task(run_results['imported'][0])
   # 10. Switch back to master
-  change_feature_branch('master')
+  if not BATCH_BRANCH:
+    change_feature_branch('master')
+  save_history(record, autopkg_history.OUTCOME_IMPORTED, run_results)
+  return autopkg_history.OUTCOME_IMPORTED
 
 
 def parse_recipe_list(file_path):
@@ -483,6 +1109,22 @@ def parse_recipe_list(file_path):
   return recipe_list
 
 
+def recipe_options(entry):
+  """Split a runlist entry into the recipe name and its options.
+
+  Entries are either a recipe name, or a dict with a 'recipe' key and any
+  per-recipe settings, such as 'timeout' and 'idle_timeout' in seconds.
+  """
+  if isinstance(entry, basestring):
+    return (entry, {})
+  options = dict(entry)
+  try:
+    recipe = options.pop('recipe')
+  except KeyError:
+    raise RunlistError("Runlist entry has no recipe: %s" % entry)
+  return (recipe, options)
+
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(
     description='Wrap AutoPkg with git support.')
@@ -513,6 +1155,75 @@ if __name__ == '__main__':
     action='store_true',
     default=False
   )
+  parser.add_argument(
+    '--history', help=('Path to the run history database. Defaults to '
+                       '%s.' % autopkg_history.DEFAULT_DB),
+  )
+  parser.add_argument(
+    '--report-dir',
+    help=('Directory to keep report plists and run summaries in, one '
+          'directory per run. Defaults to reports next to RECIPE_REPO_DIR.'),
+  )
+  parser.add_argument(
+    '--storage', help=('URL of content-addressed storage to upload imported '
+                       'packages to, such as file:///Volumes/binaries.'),
+  )
+  parser.add_argument(
+    '--timeout', type=int,
+    help=('Seconds a recipe may run before it is killed, 0 for no limit. '
+          'Defaults to %s.' % RECIPE_TIMEOUT),
+  )
+  parser.add_argument(
+    '--idle-timeout', type=int,
+    help=('Seconds a recipe may run without output before it is killed, '
+          '0 for no limit. Defaults to %s.' % RECIPE_IDLE_TIMEOUT),
+  )
+  parser.add_argument(
+    '--push', metavar='REMOTE',
+    help='Push each import branch to this git remote.',
+  )
+  parser.add_argument(
+    '--batch', action='store_true', default=False,
+    help=('Commit every import of the run to a single branch, pushed once '
+          'at the end, instead of one branch per recipe.'),
+  )
+  parser.add_argument(
+    '--maintain', action='store_true', default=False,
+    help='After the run, prune stale branches and repack the git repo.',
+  )
+  parser.add_argument(
+    '--branch-max-age', type=int,
+    help=('Days after which unmerged branches are pruned by --maintain, '
+          '0 to keep them. Defaults to %s.' % autopkg_maintenance.MAX_AGE),
+  )
+  parser.add_argument(
+    '--shard', metavar='i/N',
+    help=('Only run the recipes that belong to shard i of N, so N hosts '
+          'can split the runlist.'),
+  )
+  parser.add_argument(
+    '--shard-weights',
+    help=('JSON file of recipe runtimes to balance shards by. Must be the '
+          'same on every host.'),
+  )
+  parser.add_argument(
+    '--shard-status',
+    help='Shared directory to record the status of this shard in.',
+  )
+  parser.add_argument(
+    '--run-id',
+    help=('ID of this run. Defaults to the date for sharded runs, so all '
+          'hosts agree, otherwise to the date and time.'),
+  )
+  parser.add_argument(
+    '--task-spool',
+    help=('Directory tasks are queued in until they are filed. Defaults to '
+          '%s.' % autopkg_tasks.DEFAULT_SPOOL),
+  )
+  parser.add_argument(
+    '--task-digest', action='store_true', default=False,
+    help='File a single summary task at the end of the run.',
+  )
   parser.add_argument(
     '-p', '--pkg', help=('Path to a pkg or dmg to provide to a recipe.\n'
                          'Ignored if you pass in more than once recipe to -r,'
@@ -525,6 +1236,26 @@ if __name__ == '__main__':
   DEV = args.dev
   USE_ARCANIST = prefs_dict.get('use_arcanist', False)
   REPO_DIR = prefs_dict.get('repo_dir')
+  HISTORY_DB = prefs_dict.get('history_db')
+  REPORT_DIR = prefs_dict.get('report_dir')
+  BINARY_STORAGE = prefs_dict.get('binary_storage')
+  if prefs_dict.get('timeout') is not None:
+    RECIPE_TIMEOUT = int(prefs_dict['timeout'])
+  if prefs_dict.get('idle_timeout') is not None:
+    RECIPE_IDLE_TIMEOUT = int(prefs_dict['idle_timeout'])
+  PUSH_REMOTE = prefs_dict.get('push_remote')
+  TASK_QUEUE = autopkg_tasks.TaskQueue(
+    create_task,
+    prefs_dict.get('task_spool'),
+    digest=prefs_dict.get('task_digest', False)
+  )
+  TASK_QUEUE.start()
+  if args.run_id:
+    RUN_ID = args.run_id
+  elif args.shard:
+    RUN_ID = time.strftime('%Y%m%d')
+  else:
+    RUN_ID = time.strftime('%Y%m%d-%H%M%S')
   passed_runlist = prefs_dict.get('runlist', [])
   runlist = []
   pkg_path = None
@@ -546,11 +1277,57 @@ if __name__ == '__main__':
     timeprint('No runlist or recipes passed in! You must provide one.')
     parser.print_help()
     sys.exit(-1)
+  # Every recipe of the runlist, for maintenance, even if sharded
+  recipes = [recipe_options(entry)[0] for entry in runlist]
+  shard = None
+  if args.shard:
+    shard = autopkg_shard.parse_shard(args.shard)
+    weights = None
+    if prefs_dict.get('shard_weights'):
+      weights = autopkg_shard.load_weights(prefs_dict['shard_weights'])
+    total = len(runlist)
+    runlist = autopkg_shard.select_shard(runlist, shard[0], shard[1], weights)
+    timeprint("Shard %d/%d: running %d of %d recipes" % (
+      shard[0], shard[1], len(runlist), total))
+  shard_status = prefs_dict.get('shard_status')
+  if shard and shard_status:
+    autopkg_shard.write_status(
+      shard_status, RUN_ID, shard[0], shard[1],
+      autopkg_shard.STATE_RUNNING, recipes=len(runlist))
   timeprint("Beginning AutoPkg run...")
+  run_start = time.time()
   # Switch to repo directory for git
   timeprint('Changing working directory to git repo...')
   os.chdir(REPO_DIR)
   # Run the recipe list
-  for recipe in runlist:
-    handle_recipe(recipe, pkg_path)
+  if prefs_dict.get('batch'):
+    BATCH_BRANCH = create_run_branch(shard)
+  outcomes = []
+  try:
+    for entry in runlist:
+      (recipe, options) = recipe_options(entry)
+      outcomes.append(handle_recipe(recipe, pkg_path, options))
+    if BATCH_BRANCH:
+      finish_run_branch(BATCH_BRANCH)
+  finally:
+    # Deliver whatever is still queued before exiting
+    timeprint('Filing remaining tasks...')
+    TASK_QUEUE.close()
+    if TASK_QUEUE.failed:
+      timeprint("%d tasks could not be filed and will be retried next run" %
+                len(TASK_QUEUE.failed))
+  if RUN_SUMMARY:
+    RUN_SUMMARY.finish()
+    timeprint("Run summary written to %s" % RUN_SUMMARY.path('.json'))
+  if shard and shard_status:
+    autopkg_shard.write_status(
+      shard_status, RUN_ID, shard[0], shard[1],
+      autopkg_shard.STATE_FINISHED,
+      recipes=len(runlist),
+      duration=time.time() - run_start,
+      imported=outcomes.count(autopkg_history.OUTCOME_IMPORTED),
+      failed=(outcomes.count(autopkg_history.OUTCOME_FAILED) +
+              outcomes.count(autopkg_history.OUTCOME_TIMEOUT)))
+  if prefs_dict.get('maintain'):
+    run_maintenance(int(prefs_dict['branch_max_age']), recipes)
   timeprint("autopkg_runner.py execution complete.")
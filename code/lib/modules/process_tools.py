@@ -0,0 +1,469 @@
+#  Copyright (c) 2015-present, Facebook, Inc.
+#  All rights reserved.
+#
+#  This source code is licensed under the BSD-style license found in the
+#  LICENSE file in the root directory of this source tree. An additional grant
+#  of patent rights can be found in the PATENTS file in the same directory.
+
+"""Functions for running child processes from a single event loop"""
+
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+# Seconds to wait after SIGTERM before killing a process group outright
+KILL_GRACE = 10
+# Longest time the event loop blocks without checking deadlines
+POLL_INTERVAL = 0.5
+READ_SIZE = 65536
+
+
+class ProcessTimeoutError(Exception):
+    """A process ran past its deadline and was killed."""
+
+
+class Job(object):
+    """
+    Job(command, name=None, timeout=None, idle_timeout=None, capture=True,
+        tee=False, prefix=None, on_line=None, merge_stderr=False,
+        output=None, cwd=None, env=None)
+
+    One command to be run by a Runner. command is a list of arguments, or
+    a list of such lists to run as a pipeline. The processes of a job are
+    started in a process group of their own, so they can be killed as one.
+
+    Output is split into lines. Each line is kept in stdout/stderr when
+    capture is True, passed to on_line(job, line) if given, and written to
+    output (sys.stdout by default) when tee is True, with the optional
+    prefix in front of it.
+
+    After the job has run, returncode is set, and timed_out is set to
+    'timeout' or 'idle' if the job was killed for running too long or for
+    printing nothing for too long.
+    """
+
+    def __init__(self, command, name=None, timeout=None, idle_timeout=None,
+                 capture=True, tee=False, prefix=None, on_line=None,
+                 merge_stderr=False, output=None, cwd=None, env=None):
+        if isinstance(command, basestring):
+            raise TypeError('Command must be an array')
+        if command and not isinstance(command[0], basestring):
+            self.pipeline = [list(stage) for stage in command]
+        else:
+            self.pipeline = [list(command)]
+        self.command = command
+        self.name = name or os.path.basename(self.pipeline[0][0])
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.capture = capture
+        self.tee = tee
+        self.prefix = prefix
+        self.on_line = on_line
+        self.merge_stderr = merge_stderr
+        self.output = output
+        self.cwd = cwd
+        self.env = env
+        self.procs = []
+        self.returncode = None
+        self.timed_out = None
+        self.cancelled = False
+        self.start_time = None
+        self.end_time = None
+        self.last_output = None
+        self._lines = {'stdout': [], 'stderr': []}
+        self._pending = {}
+        self._streams = {}
+
+    @property
+    def stdout(self):
+        """Captured standard output."""
+        return ''.join(self._lines['stdout'])
+
+    @property
+    def stderr(self):
+        """Captured standard error."""
+        return ''.join(self._lines['stderr'])
+
+    @property
+    def done(self):
+        """True once every process of the job has exited."""
+        return self.returncode is not None
+
+    def start(self):
+        """
+        start()
+
+        Start every process of the pipeline, chaining stdout to stdin.
+        """
+        self.start_time = self.last_output = time.time()
+        stdin = None
+        pgid = None
+        last = len(self.pipeline) - 1
+        for index, args in enumerate(self.pipeline):
+            if index == last:
+                stderr = subprocess.PIPE
+                if self.merge_stderr:
+                    stderr = subprocess.STDOUT
+            else:
+                # Like envoy, only the last command's stderr is kept
+                stderr = open(os.devnull, 'wb')
+            if pgid is None:
+                preexec = os.setpgrp
+            else:
+                preexec = _join_group(pgid)
+            proc = subprocess.Popen(
+                args,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                cwd=self.cwd,
+                env=self.env,
+                close_fds=True,
+                preexec_fn=preexec
+            )
+            if pgid is None:
+                pgid = proc.pid
+            if stdin is not None:
+                # The next stage owns the read end now
+                stdin.close()
+            if index != last:
+                stderr.close()
+            stdin = proc.stdout
+            self.procs.append(proc)
+        final = self.procs[-1]
+        self._streams[final.stdout.fileno()] = ('stdout', final.stdout)
+        if final.stderr is not None:
+            self._streams[final.stderr.fileno()] = ('stderr', final.stderr)
+        for stream, dummy_fileobj in self._streams.values():
+            self._pending[stream] = ''
+
+    def fds(self):
+        """
+        fds()
+
+        Return the file descriptors still open for reading.
+        """
+        return self._streams.keys()
+
+    def read(self, fd):
+        """
+        read(fd)
+
+        Read what is available on fd, dispatching complete lines.
+        """
+        stream, fileobj = self._streams[fd]
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            fileobj.close()
+            del self._streams[fd]
+            if self._pending[stream]:
+                self._line(stream, self._pending[stream])
+                self._pending[stream] = ''
+            return
+        self.last_output = time.time()
+        lines = (self._pending[stream] + data).split('\n')
+        self._pending[stream] = lines.pop()
+        for line in lines:
+            self._line(stream, line + '\n')
+
+    def _line(self, stream, line):
+        """Capture, tee and report a single line of output."""
+        if self.capture:
+            self._lines[stream].append(line)
+        if self.on_line:
+            self.on_line(self, line.rstrip('\n'))
+        if self.tee:
+            output = self.output or sys.stdout
+            if self.prefix:
+                output.write('%s%s' % (self.prefix, line))
+            else:
+                output.write(line)
+            output.flush()
+
+    def check_deadline(self, now):
+        """
+        check_deadline(now)
+
+        Return 'timeout' or 'idle' if the job is past a deadline.
+        """
+        if self.timeout and now - self.start_time > self.timeout:
+            return 'timeout'
+        if self.idle_timeout and now - self.last_output > self.idle_timeout:
+            return 'idle'
+        return None
+
+    def next_deadline(self):
+        """
+        next_deadline()
+
+        Return the time of the nearest deadline, or None.
+        """
+        deadlines = []
+        if self.timeout:
+            deadlines.append(self.start_time + self.timeout)
+        if self.idle_timeout:
+            deadlines.append(self.last_output + self.idle_timeout)
+        if deadlines:
+            return min(deadlines)
+        return None
+
+    def poll(self):
+        """
+        poll()
+
+        Set returncode once all output is read and all processes exited.
+        """
+        if self._streams:
+            return None
+        if any(proc.poll() is None for proc in self.procs):
+            return None
+        self.returncode = self.procs[-1].returncode
+        self.end_time = time.time()
+        return self.returncode
+
+    def kill(self, grace=KILL_GRACE):
+        """
+        kill(grace=KILL_GRACE)
+
+        Terminate the job's process group, killing it if it doesn't exit
+        within grace seconds.
+        """
+        if not self.procs:
+            return
+        pgid = self.procs[0].pid
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(pgid, sig)
+            except OSError:
+                # Already gone
+                break
+            deadline = time.time() + grace
+            while (any(proc.poll() is None for proc in self.procs) and
+                   time.time() < deadline):
+                time.sleep(0.1)
+            if all(proc.poll() is not None for proc in self.procs):
+                break
+        for proc in self.procs:
+            proc.wait()
+        for dummy_stream, fileobj in self._streams.values():
+            fileobj.close()
+        self._streams = {}
+        self.returncode = self.procs[-1].returncode
+        self.end_time = time.time()
+
+    def result(self):
+        """
+        result()
+
+        Return a dict of stdout (string), stderr (string), status (exit
+        code - int), success (bool - true if the exit code was 0),
+        timed_out and duration.
+        """
+        return {
+            'stdout': self.stdout,
+            'stderr': self.stderr,
+            'status': self.returncode,
+            'success': self.returncode == 0,
+            'timed_out': self.timed_out,
+            'duration': (self.end_time or time.time()) - self.start_time,
+        }
+
+
+def _join_group(pgid):
+    """Return a preexec_fn that moves the child into process group pgid."""
+    def join():
+        try:
+            os.setpgid(0, pgid)
+        except OSError:
+            # The group is already gone, the pipeline is finishing anyway
+            pass
+    return join
+
+
+class Runner(object):
+    """
+    Runner(max_jobs=None)
+
+    Run any number of Jobs concurrently from a single select() loop, at
+    most max_jobs at a time. Jobs are started in the order they are added.
+    """
+
+    def __init__(self, max_jobs=None):
+        self.max_jobs = max_jobs
+        self.queued = []
+        self.running = []
+        self.finished = []
+
+    def add(self, job):
+        """
+        add(job)
+
+        Queue a job to be run.
+        """
+        self.queued.append(job)
+        return job
+
+    def cancel(self, job):
+        """
+        cancel(job)
+
+        Kill a running job, or drop it if it hasn't started.
+        """
+        job.cancelled = True
+        if job in self.queued:
+            self.queued.remove(job)
+            self.finished.append(job)
+        elif job in self.running:
+            job.kill()
+            self.running.remove(job)
+            self.finished.append(job)
+
+    def cancel_all(self):
+        """
+        cancel_all()
+
+        Kill every running job and drop every queued one.
+        """
+        for job in list(self.queued) + list(self.running):
+            self.cancel(job)
+
+    def _start_jobs(self):
+        """Start queued jobs while there are free slots."""
+        while self.queued and (
+                not self.max_jobs or len(self.running) < self.max_jobs):
+            job = self.queued.pop(0)
+            job.start()
+            self.running.append(job)
+
+    def _wait_time(self, now):
+        """Return how long select() may block for."""
+        wait = POLL_INTERVAL
+        for job in self.running:
+            deadline = job.next_deadline()
+            if deadline is not None:
+                wait = min(wait, max(0, deadline - now))
+        return wait
+
+    def step(self):
+        """
+        step()
+
+        Run one iteration of the event loop.
+        """
+        self._start_jobs()
+        fd_jobs = {}
+        for job in self.running:
+            for fd in job.fds():
+                fd_jobs[fd] = job
+        if fd_jobs:
+            ready = select.select(
+                fd_jobs.keys(), [], [], self._wait_time(time.time()))[0]
+        else:
+            # Only waiting for processes to exit
+            time.sleep(0.05)
+            ready = []
+        # Check the deadlines before taking any new output into account
+        now = time.time()
+        for job in list(self.running):
+            reason = job.check_deadline(now)
+            if reason:
+                job.timed_out = reason
+                job.kill()
+                self.running.remove(job)
+                self.finished.append(job)
+        for fd in ready:
+            job = fd_jobs[fd]
+            if job in self.running:
+                job.read(fd)
+        for job in list(self.running):
+            if job.poll() is not None:
+                self.running.remove(job)
+                self.finished.append(job)
+
+    def run(self):
+        """
+        run()
+
+        Run until every job has finished. Returns the list of finished
+        jobs. If interrupted, every job is killed before re-raising.
+        """
+        try:
+            while self.queued or self.running:
+                self.step()
+        except BaseException:
+            self.cancel_all()
+            raise
+        return self.finished
+
+
+def run_job(job):
+    """
+    run_job(job)
+
+    Run a single job to completion and return it.
+    """
+    runner = Runner()
+    runner.add(job)
+    runner.run()
+    return job
+
+
+def run(command, timeout=None, idle_timeout=None, merge_stderr=False,
+        cwd=None, env=None):
+    """
+    run(command, timeout=None, idle_timeout=None, merge_stderr=False)
+
+    Runs the command, capturing its output, and returns a dict of stdout
+    (string), stderr (string), status (exit code - int), success (bool -
+    true if the exit code was 0), timed_out and duration.
+    """
+    job = Job(command, timeout=timeout, idle_timeout=idle_timeout,
+              merge_stderr=merge_stderr, cwd=cwd, env=env)
+    return run_job(job).result()
+
+
+def run_live(command, timeout=None, idle_timeout=None, on_line=None,
+             prefix=None, output=None):
+    """
+    run_live(command, timeout=None, idle_timeout=None, on_line=None)
+
+    Runs the command with stderr merged into stdout, writing output as it
+    arrives (or passing each line to on_line instead). Returns only the
+    return code. Raises ProcessTimeoutError if the command was killed.
+    """
+    job = Job(command, timeout=timeout, idle_timeout=idle_timeout,
+              capture=False, tee=on_line is None, on_line=on_line,
+              prefix=prefix, merge_stderr=True, output=output)
+    run_job(job)
+    if job.timed_out == 'timeout':
+        raise ProcessTimeoutError(
+            "Timed out after %s seconds: %s" % (timeout, ' '.join(
+                job.pipeline[0])))
+    if job.timed_out == 'idle':
+        raise ProcessTimeoutError(
+            "No output for %s seconds: %s" % (idle_timeout, ' '.join(
+                job.pipeline[0])))
+    return job.returncode
+
+
+def run_many(commands, max_jobs=None, timeout=None, idle_timeout=None,
+             tee=True, output=None):
+    """
+    run_many(commands, max_jobs=None, timeout=None, idle_timeout=None)
+
+    Runs several commands concurrently, at most max_jobs at a time. Output
+    is written as it arrives with each line prefixed by the command's index
+    and name, and also captured. Returns the result dicts in command order.
+    """
+    runner = Runner(max_jobs)
+    jobs = []
+    for index, command in enumerate(commands):
+        job = Job(command, timeout=timeout, idle_timeout=idle_timeout,
+                  tee=tee, output=output, merge_stderr=True)
+        job.prefix = '[%d:%s] ' % (index, job.name)
+        jobs.append(runner.add(job))
+    runner.run()
+    return [added.result() for added in jobs]
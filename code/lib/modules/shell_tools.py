@@ -7,9 +7,10 @@
 
 """Functions for interacting with command line utilities"""
 
+import shlex
 import time
 
-import envoy
+import process_tools
 
 
 def sanitize_output(text):
@@ -21,6 +22,25 @@ def sanitize_output(text):
     return text.strip().replace("\n", "").replace("\r", "")
 
 
+def expand_args(command):
+    """
+    expand_args(command)
+
+    Split a command string into a pipeline of argument lists, on unquoted
+    pipes, the same way envoy does
+    """
+    splitter = shlex.shlex(command.encode('utf-8'))
+    splitter.whitespace = '|'
+    splitter.whitespace_split = True
+    stages = []
+    while True:
+        token = splitter.get_token()
+        if not token:
+            break
+        stages.append(shlex.split(token))
+    return stages
+
+
 def run(command, sanitize=True):
     """
     run(command, sanitize=True)
@@ -28,13 +48,29 @@ def run(command, sanitize=True):
     Runs the passed command and returns a dict of stdout (string),
     stderr (string), status (exit code - int)
     and success (bool - true if the exit code of 0)
+
+    A command that can't be started returns status 127, as envoy did
     """
-    result = envoy.run(command)
+    try:
+        result = process_tools.run(expand_args(command))
+    except OSError as e:
+        result = {
+            "stdout": "",
+            "stderr": str(e),
+            "status": 127,
+            "success": False
+        }
     result_dict = {
-        "stdout": sanitize_output(result.std_out) if sanitize else result.std_out,
-        "stderr": sanitize_output(result.std_err) if sanitize else result.std_err,
-        "status": result.status_code,
-        "success": True if result.status_code == 0 else False
+        "stdout": (
+            sanitize_output(result["stdout"]) if sanitize
+            else result["stdout"]
+        ),
+        "stderr": (
+            sanitize_output(result["stderr"]) if sanitize
+            else result["stderr"]
+        ),
+        "status": result["status"],
+        "success": result["success"]
     }
     return result_dict
 